@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal asyncio based IMAP4rev1 and POP3 clients.
+
+Only the commands used by the plugins are implemented. Every phase of a
+probe (connect, greeting, login, ...) has its own timeout, so thousands
+of probes can be kept in flight on a single event loop instead of
+blocking a thread per socket.
+
+The answers of a server can be replayed without a connection:
+
+    >>> class Writer(object) :
+    ...     sent = b""
+    ...     def write(self, data) : self.sent += data
+    ...     async def drain(self) : pass
+    ...     def close(self) : pass
+    >>> def replay(client, answer, call) :
+    ...     async def run() :
+    ...         client.reader = asyncio.StreamReader()
+    ...         client.reader.feed_data(answer)
+    ...         client.writer = Writer()
+    ...         return await call(client)
+    ...     return asyncio.run(run())
+
+    >>> imap = AsyncImapClient()
+    >>> replay(imap, b'* LIST (\\\\HasNoChildren) "/" INBOX\\r\\nA0001 OK done\\r\\n', lambda c : c.list())
+    [b'* LIST (\\\\HasNoChildren) "/" INBOX']
+    >>> replay(imap, b'* 3 EXISTS\\r\\n* OK [UIDNEXT 8]\\r\\nA0002 OK [READ-ONLY] done\\r\\n',
+    ...        lambda c : c.select('INBOX', readonly = True))
+    3
+    >>> imap.writer.sent
+    b'A0002 EXAMINE "INBOX"\\r\\n'
+    >>> replay(imap, b'* SEARCH 5 7\\r\\nA0003 OK done\\r\\n', lambda c : c.uidSearch())
+    [b'5', b'7']
+    >>> replay(imap, b'* 2 FETCH (UID 7 RFC822 {5}\\r\\nHello)\\r\\nA0004 OK done\\r\\n',
+    ...        lambda c : c.uidFetch(b'7'))
+    [(b'* 2 FETCH (UID 7 RFC822 ', b'Hello')]
+    >>> try :
+    ...     replay(imap, b'A0005 NO [AUTHENTICATIONFAILED] nope\\r\\n', lambda c : c.login('u', 'p'))
+    ... except ProtocolError as e :
+    ...     print(e)
+    b'A0005 NO [AUTHENTICATIONFAILED] nope'
+
+    >>> pop = AsyncPopClient()
+    >>> replay(pop, b'+OK 2 messages\\r\\n1 120\\r\\n2 200\\r\\n.\\r\\n', lambda c : c.list())
+    [b'1 120', b'2 200']
+    >>> replay(pop, b'+OK\\r\\nSubject: x\\r\\n\\r\\n..dot\\r\\n.\\r\\n', lambda c : c.retr(1))
+    [b'Subject: x', b'', b'.dot']
+    >>> try :
+    ...     replay(pop, b'-ERR no such message\\r\\n', lambda c : c.retr(3))
+    ... except ProtocolError as e :
+    ...     print(e)
+    b'-ERR no such message'
+
+Requires Python 3.7 or newer.
+"""
+
+#---
+#--- Python
+import asyncio
+import re
+import time
+
+#---
+#--- Plugin Stuff
+import munin_helpers
+import net_helpers
+
+#---
+PHASE_TIMEOUT_SECONDS = 5
+
+IMAP4_PORT = 143
+IMAP4_SSL_PORT = 993
+POP3_PORT = 110
+POP3_SSL_PORT = 995
+
+CRLF = b'\r\n'
+
+_LITERAL_RE = re.compile(br'\{(?P<size>\d+)\}\r\n$')
+_EXISTS_RE = re.compile(br'^\* (?P<count>\d+) EXISTS', re.IGNORECASE)
+
+#---
+class ProtocolError(Exception) :
+    """
+    The server answered with NO/BAD (IMAP) or -ERR (POP3).
+    """
+    pass
+
+
+class _AsyncClient(object) :
+
+    DEFAULT_PORT = None
+    DEFAULT_SSL_PORT = None
+
+    def __init__(self, **keywords) :
+        """
+        @keyword timeout: timeout for every single phase in seconds
+            (default is L{PHASE_TIMEOUT_SECONDS})
+        @type    timeout: float
+
+        @keyword sslContext: context for SSL connections (default is
+            L{net_helpers.createSSLContext}, no certificate verification)
+        @type    sslContext: ssl.SSLContext
+        """
+        self.timeout = keywords.get('timeout', PHASE_TIMEOUT_SECONDS)
+        self.sslContext = keywords.get('sslContext', None)
+        self.reader = None
+        self.writer = None
+        self.welcome = None
+
+    async def _withTimeout(self, coro) :
+        return await asyncio.wait_for(coro, self.timeout)
+
+    async def connect(self, host, **keywords) :
+        """
+        Opens the connection and reads the server greeting.
+
+        @keyword use_ssl: default is True
+        @type    use_ssl: bool
+
+        @keyword port: default depends on the protocol and on use_ssl
+        @type    port: int
+        """
+        use_ssl = keywords.get('use_ssl', True)
+        defaultPort = self.DEFAULT_SSL_PORT if use_ssl else self.DEFAULT_PORT
+        port = keywords.get('port', None) or defaultPort
+        sslContext = None
+        if use_ssl :
+            sslContext = self.sslContext or net_helpers.createSSLContext()
+        (self.reader, self.writer) = await self._withTimeout(
+            asyncio.open_connection(host, port,
+                                    ssl = sslContext,
+                                    server_hostname = host if use_ssl else None))
+        self.welcome = await self._withTimeout(self._readGreeting())
+        return self.welcome
+
+    async def _readLine(self) :
+        line = await self.reader.readline()
+        if not line :
+            raise EOFError("connection closed by server")
+        return line
+
+    async def _send(self, data) :
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def close(self) :
+        if self.writer is not None :
+            self.writer.close()
+            self.writer = None
+
+
+#---
+#--- IMAP
+def quoteImapString(value) :
+    """
+    @rtype: str
+    """
+    return '"%s"' % (value.replace('\\', '\\\\').replace('"', '\\"'),)
+
+
+class AsyncImapClient(_AsyncClient) :
+    """
+    Responses are returned like imaplib does: a list of untagged lines
+    (bytes) where a line containing a literal is given as
+    (lineUpToLiteral, literal) followed by the rest of the line.
+    """
+
+    DEFAULT_PORT = IMAP4_PORT
+    DEFAULT_SSL_PORT = IMAP4_SSL_PORT
+
+    def __init__(self, **keywords) :
+        _AsyncClient.__init__(self, **keywords)
+        self._tagCounter = 0
+
+    async def _readGreeting(self) :
+        line = await self._readLine()
+        if not line.startswith(b'* OK') and not line.startswith(b'* PREAUTH') :
+            raise ProtocolError(line.strip())
+        return line.strip()
+
+    def _nextTag(self) :
+        self._tagCounter += 1
+        return b'A%04d' % (self._tagCounter,)
+
+    async def _readResponse(self, tag) :
+        untagged = []
+        while True :
+            line = await self._readLine()
+            m = _LITERAL_RE.search(line)
+            while m :
+                literal = await self.reader.readexactly(int(m.group('size')))
+                untagged.append((line[:m.start()], literal))
+                line = await self._readLine()
+                m = _LITERAL_RE.search(line)
+            if line.startswith(tag + b' ') :
+                status = line[len(tag) + 1:].split(None, 1)[0].upper()
+                if status != b'OK' :
+                    raise ProtocolError(line.strip())
+                return (status.decode('ascii'), untagged)
+            untagged.append(line.rstrip(CRLF))
+
+    async def command(self, name, *args) :
+        """
+        Sends a tagged command and waits for its completion.
+
+        @return: (status, untaggedResponses)
+        @rtype:  (str, list)
+        """
+        tag = self._nextTag()
+        line = b' '.join([tag, name.encode('ascii')] +
+                         [a.encode('utf-8') for a in args])
+        await self._send(line + CRLF)
+        return await self._withTimeout(self._readResponse(tag))
+
+    async def login(self, user, password) :
+        return await self.command('LOGIN', quoteImapString(user),
+                                  quoteImapString(password))
+
+    async def list(self, reference = '""', pattern = '*') :
+        (typ, data) = await self.command('LIST', reference, pattern)
+        return [line for line in data if line.upper().startswith(b'* LIST')]
+
+    async def select(self, mailbox = 'INBOX', readonly = False) :
+        """
+        @return: number of messages in the mailbox
+        @rtype:  int
+        """
+        name = 'EXAMINE' if readonly else 'SELECT'
+        (typ, data) = await self.command(name, quoteImapString(mailbox))
+        for line in data :
+            m = _EXISTS_RE.match(line) if isinstance(line, bytes) else None
+            if m :
+                return int(m.group('count'))
+        return 0
+
+    async def uidSearch(self, criteria = 'ALL') :
+        """
+        @rtype: [bytes]
+        """
+        (typ, data) = await self.command('UID SEARCH', criteria)
+        uids = []
+        for line in data :
+            if isinstance(line, bytes) and line.upper().startswith(b'* SEARCH') :
+                uids.extend(line.split()[2:])
+        return uids
+
+    async def uidFetch(self, uid, items = '(RFC822)') :
+        """
+        @return: list of (responseLine, literal)
+        @rtype:  [(bytes, bytes)]
+        """
+        if isinstance(uid, bytes) :
+            uid = uid.decode('ascii')
+        (typ, data) = await self.command('UID FETCH', uid, items)
+        return [item for item in data if isinstance(item, tuple)]
+
+    async def logout(self) :
+        try :
+            tag = self._nextTag()
+            await self._send(tag + b' LOGOUT' + CRLF)
+            await self._withTimeout(self._readResponse(tag))
+        finally :
+            self.close()
+
+
+#---
+#--- POP3
+class AsyncPopClient(_AsyncClient) :
+
+    DEFAULT_PORT = POP3_PORT
+    DEFAULT_SSL_PORT = POP3_SSL_PORT
+
+    async def _readGreeting(self) :
+        return await self._readStatus()
+
+    async def _readStatus(self) :
+        line = await self._readLine()
+        if not line.startswith(b'+OK') :
+            raise ProtocolError(line.strip())
+        return line.strip()
+
+    async def _readMultiLine(self) :
+        lines = []
+        while True :
+            line = (await self._readLine()).rstrip(CRLF)
+            if line == b'.' :
+                return lines
+            if line.startswith(b'..') :
+                line = line[1:]
+            lines.append(line)
+
+    async def command(self, line, multiLine = False) :
+        """
+        @return: (statusLine, lines) -- lines is None for single line answers
+        @rtype:  (bytes, [bytes])
+        """
+        await self._send(line.encode('utf-8') + CRLF)
+        status = await self._withTimeout(self._readStatus())
+        lines = None
+        if multiLine :
+            lines = await self._withTimeout(self._readMultiLine())
+        return (status, lines)
+
+    async def user(self, user) :
+        return await self.command('USER %s' % (user,))
+
+    async def pass_(self, password) :
+        return await self.command('PASS %s' % (password,))
+
+    async def list(self) :
+        """
+        @return: like poplib.POP3.list()[1] e.g. [b'1 30738', b'2 4872']
+        @rtype:  [bytes]
+        """
+        (status, lines) = await self.command('LIST', multiLine = True)
+        return lines
+
+    async def retr(self, which) :
+        """
+        @rtype: [bytes]
+        """
+        (status, lines) = await self.command('RETR %s' % (which,), multiLine = True)
+        return lines
+
+    async def quit(self) :
+        try :
+            await self.command('QUIT')
+        finally :
+            self.close()
+
+
+#---
+#--- Probes
+async def probeImapLogin(account, **keywords) :
+    """
+    Asynchronous counterpart of C{check_imap4.measureAccount}.
+
+    @param account: (user, password, host)
+    @type  account: (str, str, str)
+
+    @keyword use_ssl: default is True
+    @type    use_ssl: bool
+
+    @keyword timeout: timeout for every single phase in seconds
+    @type    timeout: float
+
+    @return: login time in milliseconds or one of the MUNIN_VALUE_CANNOT_*
+        constants
+    @rtype:  float
+    """
+    (user, password, host) = account
+    conn = AsyncImapClient(**keywords)
+    try :
+        await conn.connect(host, **keywords)
+    except Exception :
+        conn.close()
+        return munin_helpers.MUNIN_VALUE_CANNOT_CONNECT
+
+    timeprelogin = time.perf_counter()
+    try :
+        await conn.login(user, password)
+    except Exception :
+        conn.close()
+        return munin_helpers.MUNIN_VALUE_CANNOT_LOGIN
+    timepostlogin = time.perf_counter()
+
+    try :
+        await conn.logout()
+    except Exception :
+        pass
+
+    return (timepostlogin - timeprelogin) * 1000
+
+
+async def probePopLogin(account, **keywords) :
+    """
+    Like L{probeImapLogin} but for POP3 (USER/PASS).
+
+    @rtype: float
+    """
+    (user, password, host) = account
+    conn = AsyncPopClient(**keywords)
+    try :
+        await conn.connect(host, **keywords)
+    except Exception :
+        conn.close()
+        return munin_helpers.MUNIN_VALUE_CANNOT_CONNECT
+
+    timeprelogin = time.perf_counter()
+    try :
+        await conn.user(user)
+        await conn.pass_(password)
+    except Exception :
+        conn.close()
+        return munin_helpers.MUNIN_VALUE_CANNOT_LOGIN
+    timepostlogin = time.perf_counter()
+
+    try :
+        await conn.quit()
+    except Exception :
+        pass
+
+    return (timepostlogin - timeprelogin) * 1000
+
+
+async def _runBounded(probe, accounts, maxInFlight, keywords) :
+    semaphore = asyncio.Semaphore(maxInFlight)
+
+    async def limited(account) :
+        async with semaphore :
+            return await probe(account, **keywords)
+
+    return await asyncio.gather(*[limited(account) for account in accounts])
+
+
+def runProbes(probe, accounts, **keywords) :
+    """
+    Runs C{probe(account, **keywords)} for all accounts on one event loop.
+
+    @param probe: e.g. L{probeImapLogin} or L{probePopLogin}
+    @type  probe: coroutine function
+
+    @keyword maxInFlight: upper bound of concurrently open connections
+        (default 1000); all other keywords are passed to C{probe}
+    @type    maxInFlight: int
+
+    @return: results in the same order as C{accounts}
+    @rtype:  list
+    """
+    maxInFlight = keywords.pop('maxInFlight', 1000)
+    return asyncio.run(_runBounded(probe, list(accounts), maxInFlight, keywords))
+
+
+if __name__ == "__main__" :
+    import doctest
+    doctest.testmod()
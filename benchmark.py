@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the plugins and of the probes in the helper modules against
+the local stand-in servers of fake_servers.py.
+
+    python benchmark.py -n 200 -w 8 --latency 0.001
+
+Targets:
+    - 'imap', 'pop3', 'smtp' -- one probe with the helper modules in this
+      process (connect, login, read the newest mail / submit a mail)
+    - 'check_imap4.py', 'check_pop3.py', 'check_both.py' -- a complete
+      run of the plugin in a child process, as Munin would start it
+
+For every target the number of probes per second and the latency
+percentiles are reported.
+"""
+
+from __future__ import print_function
+
+#---
+#--- Python
+import optparse
+import os
+import re
+import smtplib
+import subprocess
+import sys
+import time
+
+#---
+#--- Plugin Stuff
+import fake_servers
+import imap_helpers
+import pool_helpers
+import pop_helpers
+import stats_helpers
+import timing_helpers
+
+#---
+PLUGIN_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+_NEGATIVE_VALUE_RE = re.compile(r'\.value -')
+
+#---
+#--- Probes in this process
+def probeImap(environment) :
+    conn = imap_helpers.TimedIMAP4(environment['IMAP_HOST'],
+                                   port = int(environment['IMAP_PORT']))
+    conn.login(environment['RECEIVING_USERNAME'], environment['RECEIVING_PASSWORD'])
+    imap_helpers.timeSelectAndFetch(conn, conn.timer)
+    conn.logout()
+
+
+def probePop3(environment) :
+    conn = pop_helpers.TimedPOP3(environment['POP3_HOST'],
+                                 port = int(environment['POP3_PORT']))
+    conn.user(environment['RECEIVING_USERNAME'])
+    conn.pass_(environment['RECEIVING_PASSWORD'])
+    pop_helpers.timeStatAndTop(conn, conn.timer)
+    conn.quit()
+
+
+def probeSmtp(environment) :
+    # the subject has to be understood by check_both.py
+    message = fake_servers.composeMessage(time.time(), 1024,
+                                          fromAddress = environment['SENDING_ADDRESS'])
+    conn = smtplib.SMTP(environment['SMTP_HOST'], int(environment['SMTP_PORT']))
+    conn.starttls()
+    conn.login(environment['SENDING_USERNAME'], environment['SENDING_PASSWORD'])
+    conn.sendmail(environment['SENDING_ADDRESS'], [environment['RECEIVING_ADDRESS']], message)
+    conn.quit()
+
+
+PROBES = {
+    'imap' : probeImap,
+    'pop3' : probePop3,
+    'smtp' : probeSmtp,
+}
+
+DEFAULT_TARGETS = ['imap', 'pop3', 'smtp', 'check_imap4.py', 'check_pop3.py', 'check_both.py']
+
+#---
+def runPlugin(script, environment) :
+    """
+    @raise RuntimeError: if the plugin failed or reported an error value
+    """
+    proc = subprocess.Popen([sys.executable, os.path.join(PLUGIN_DIRECTORY, script)],
+                            stdout = subprocess.PIPE,
+                            stderr = subprocess.PIPE,
+                            env = environment)
+    (out, err) = proc.communicate()
+    out = out.decode('utf-8', 'replace')
+    if proc.returncode != 0 or not out or _NEGATIVE_VALUE_RE.search(out) :
+        raise RuntimeError("%s failed (%s): %s" % (script, proc.returncode,
+                                                   (err.decode('utf-8', 'replace') or out).strip()))
+
+
+def runTarget(target, environment, runs, maxWorkers) :
+    """
+    @return: (latencies of the successful runs in ms, number of
+        failures, wall clock time in seconds, first error message)
+    @rtype:  ([float], int, float, str)
+    """
+    if target in PROBES :
+        probe = lambda : PROBES[target](environment)
+    else :
+        childEnvironment = dict(os.environ)
+        childEnvironment.update(environment)
+        probe = lambda : runPlugin(target, childEnvironment)
+
+    def measure(i) :
+        timer = timing_helpers.PhaseTimer()
+        try :
+            probe()
+        except Exception as e :
+            return (None, str(e))
+        return (timer.mark('probe'), None)
+
+    timer = timing_helpers.PhaseTimer()
+    results = pool_helpers.mapBounded(measure, range(runs), maxWorkers = maxWorkers)
+    wallSeconds = timer.mark('total') / 1000.0
+
+    latencies = [ms for (ms, error) in results if error is None]
+    errors = [error for (ms, error) in results if error is not None]
+    return (latencies, len(errors), wallSeconds, errors[0] if errors else None)
+
+
+def printReport(rows) :
+    """
+    @param rows: (target, latencies, failures, wallSeconds)
+    @type  rows: list
+    """
+    print("%-16s %6s %6s %9s %9s %9s %9s %9s" % ("target", "runs", "failed",
+                                                 "probes/s", "mean ms", "p50 ms", "p99 ms", "max ms"))
+    for (target, latencies, failures, wallSeconds) in rows :
+        summary = stats_helpers.summarize(latencies)
+        rate = summary['count'] / wallSeconds if wallSeconds > 0 else 0.0
+        values = ["%9.2f" % (summary[key],) if summary[key] is not None else "%9s" % ("-",)
+                  for key in ['mean', 'p50', 'p99', 'max']]
+        print("%-16s %6d %6d %9.1f %s" % (target, len(latencies) + failures, failures,
+                                          rate, " ".join(values)))
+
+
+def createParser() :
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage = usage)
+    parser.add_option("-n", "--runs",
+                      dest = "runs",
+                      help = "Number of probes per target (default: %default).",
+                      action = "store",
+                      type = "int",
+                      default = 50,
+    )
+    parser.add_option("-w", "--workers",
+                      dest = "max_workers",
+                      help = "Run at most N probes at the same time (default: %default).",
+                      action = "store",
+                      type = "int",
+                      metavar = "N",
+                      default = 1,
+    )
+    parser.add_option("-t", "--target",
+                      dest = "targets",
+                      help = "Benchmark only TARGET, may be given several times (default: %s)." % (", ".join(DEFAULT_TARGETS),),
+                      action = "append",
+                      metavar = "TARGET",
+                      default = [],
+    )
+    fake_servers.addServerOptions(parser)
+    return parser
+
+
+def main():
+    parser = createParser()
+    (options, args) = parser.parse_args()
+
+    targets = options.targets or DEFAULT_TARGETS
+    for target in targets :
+        if target not in PROBES and not os.path.exists(os.path.join(PLUGIN_DIRECTORY, target)) :
+            print("Unknown target '%s'" % (target,))
+            return 2
+
+    try :
+        suite = fake_servers.createSuite(options)
+    except ValueError as E :
+        print(E)
+        parser.print_help()
+        return 2
+    suite.start()
+    environment = suite.getEnvironment(password = options.password or 'secret')
+
+    rows = []
+    try :
+        for target in targets :
+            (latencies, failures, wallSeconds, error) = runTarget(target, environment,
+                                                                  options.runs,
+                                                                  options.max_workers)
+            if error is not None :
+                print("%s: %s" % (target, error), file = sys.stderr)
+            rows.append((target, latencies, failures, wallSeconds))
+    finally :
+        suite.stop()
+
+    printReport(rows)
+    return 0
+
+if __name__ == "__main__":
+    retCode = main()
+    sys.exit(retCode)
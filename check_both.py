@@ -24,24 +24,26 @@ import datetime
 import os
 import socket
 import sys
-import time
+import uuid
 
 #---
 #--- Python (Mail)
-from email.mime.text import MIMEText
 import email.header
 import imaplib
-import poplib
-import smtplib
 
 #---
 #--- Plugin Stuff
 import cli_helpers
+import collector_client
 import imap_helpers
 import mail_helpers
 import munin_helpers
 import nagios_stuff
+import net_helpers
 import pop_helpers
+import smtp_helpers
+import spool_helpers
+import timing_helpers
 
 #---
 #--- Munin Constants (http://munin-monitoring.org/wiki/HowToWritePlugins)
@@ -50,14 +52,95 @@ MONITOR_GRAPH_TITLE = "IMAP-POP-OFFSET regarding latest mail"
 MONITOR_GRAPH_LABEL = "imap_minus_pop"
 MONITOR_MEASURED_VARIABLE = "imap%(ssl)s_minus_pop%(ssl)s_%(user)s_at_%(host)s"
 
+#: Graphs below the main graph in multigraph mode:
+#: (name, title, vlabel, [(fieldName, fieldLabel)])
+MONITOR_SUBGRAPHS = [
+    ("imap_login", "IMAP login time %(user)s@%(host)s", "ms",
+     [("dns", "DNS lookup"), ("connect", "connect"), ("login", "login"),
+      ("tls", "TLS handshake")]),
+    ("pop_login", "POP3 login time %(user)s@%(host)s", "ms",
+     [("dns", "DNS lookup"), ("connect", "connect"), ("login", "login"),
+      ("tls", "TLS handshake")]),
+    ("smtp_submit", "SMTP submit time %(user)s@%(host)s", "ms",
+     [("dns", "DNS lookup"), ("submit", "submit")]),
+]
+
+#: Graph of the time between consecutive Received headers of the test
+#: message; the fields are given by L{getDeliveryHopFields}
+MONITOR_DELIVERY_SUBGRAPH = ("delivery_hops", "Mail delivery time per hop %(user)s@%(host)s", "seconds")
+
+#: Graph of the delivery probe (DELIVERY_PROBE=1)
+MONITOR_DELIVERY_PROBE_SUBGRAPH = ("delivery", "Mail delivery time %(user)s@%(host)s", "seconds",
+                                   [("delivered", "submit until visible via IMAP")])
+
+#: header field with the unique token of the test message
+PROBE_TOKEN_HEADER = 'X-Munin-Probe-Token'
+
+DEFAULT_DELIVERY_TIMEOUT_SECONDS = 60
+DEFAULT_DELIVERY_POLL_SECONDS = 0.25
+
+#: number of hops if DELIVERY_HOP_LABELS is not set
+DEFAULT_DELIVERY_HOPS = 4
+
+#: Graphs of the backends behind a round-robin name (DNS_PROBE_ALL=1),
+#: one field per address: (name, title, host variable, port variable, default ports)
+#: ports of the servers if not the default port of the protocol
+SERVICE_PORT_VARIABLES = ['IMAP_PORT', 'POP3_PORT', 'SMTP_PORT']
+
+MONITOR_BACKEND_SUBGRAPHS = [
+    ("imap_backends", "IMAP backends of %(host)s (connect + TLS)",
+     'IMAP_HOST', 'IMAP_PORT', (imaplib.IMAP4_SSL_PORT, imaplib.IMAP4_PORT)),
+    ("pop_backends", "POP3 backends of %(host)s (connect + TLS)",
+     'POP3_HOST', 'POP3_PORT', (pop_helpers.POP3_SSL_PORT, pop_helpers.POP3_PORT)),
+]
+
 #---
 SOCKET_TIMEOUT_SECONDS = 5
 
+#: the only header fields needed from the newest mail
+HEADER_FIELDS = ['DATE', 'SUBJECT', 'FROM', 'RECEIVED']
+
 #---
 class CLI(cli_helpers.BaseCLI) :
 
     _SINGLETON_INSTANCE = None #: Singleton Pattern
 
+    def createParser(self) :
+        parser = cli_helpers.BaseCLI.createParser(self)
+        # one port cannot serve IMAP, POP3 and SMTP, they are read from
+        # IMAP_PORT, POP3_PORT and SMTP_PORT
+        parser.remove_option("--port")
+        return parser
+
+    def evaluate(self) :
+        cli_helpers.BaseCLI.evaluate(self)
+        self.deliveryTimeout = cli_helpers.getEnvironmentFloat('DELIVERY_TIMEOUT',
+                                                               DEFAULT_DELIVERY_TIMEOUT_SECONDS)
+        self.deliveryPollInterval = cli_helpers.getEnvironmentFloat('DELIVERY_POLL_INTERVAL',
+                                                                    DEFAULT_DELIVERY_POLL_SECONDS)
+        self.dnsCacheTtl = cli_helpers.getEnvironmentFloat('DNS_CACHE_TTL', None)
+        self.servicePorts = dict((envName, cli_helpers.getEnvironmentInteger(envName, None))
+                                 for envName in SERVICE_PORT_VARIABLES)
+
+    def GetDeliveryTimeout(self) :
+        return self.deliveryTimeout
+
+    def GetDeliveryPollInterval(self) :
+        return self.deliveryPollInterval
+
+    def GetDnsCacheTtl(self) :
+        return self.dnsCacheTtl
+
+    def GetServicePort(self, envName) :
+        """
+        @param envName: one of L{SERVICE_PORT_VARIABLES}
+        @type  envName: str
+
+        @return: None if the default port of the protocol should be used
+        @rtype:  int
+        """
+        return self.servicePorts[envName]
+
     def MapNagiosReturnCode(self, nagiosReturnCode) :
         """
         @param nagiosReturnCode: Following values are specified
@@ -102,7 +185,7 @@ def HandleSuccessfulLogin(cli, connImapTriple, connPopTriple) :
     toAddress = os.environ.get('RECEIVING_ADDRESS', None)
     fromAddress = os.environ.get('SENDING_ADDRESS', None)
     smtpServer = os.environ.get('SMTP_HOST', None)
-    smtpPort = os.environ.get('SMTP_PORT', 25)
+    smtpPort = cli.GetServicePort('SMTP_PORT') or 25
     smtpUser = os.environ.get('SENDING_USERNAME', None)
     smtpPassword = os.environ.get('SENDING_PASSWORD', None)
     if None in [toAddress, fromAddress,
@@ -113,19 +196,36 @@ def HandleSuccessfulLogin(cli, connImapTriple, connPopTriple) :
         sys.exit(1)
         return
 
+    token = None
+    uidNext = None
+    if ShouldProbeDelivery() :
+        # wait for exactly this message instead of reading the newest one
+        token = uuid.uuid4().hex
+    if token is not None :
+        # the test message gets this UID or a higher one
+        uidNext = imap_helpers.getUidNext(iConn, 'INBOX')
+
     if 1 :
-        sendTestMessageWithTimestamp(toAddress, fromAddress,
-                                     smtpServer, smtpPort,
-                                     smtpUser, smtpPassword, now)
+        smtpTimer = timing_helpers.PhaseTimer()
+        submitStart = timing_helpers.clock()
+        submitDelay = sendTestMessageWithTimestamp(toAddress, fromAddress,
+                                                   smtpServer, smtpPort,
+                                                   smtpUser, smtpPassword, now,
+                                                   timer = smtpTimer,
+                                                   token = token)
         latestSmtp = now
 
+    deliveryDelay = None
+    if token is not None :
+        deliveryDelay = measureDelivery(iConn, uidNext, token, submitStart,
+                                        timeout = cli.GetDeliveryTimeout(),
+                                        pollInterval = cli.GetDeliveryPollInterval())
+
     # IMAP
-    if cli.IsVerbose() :
-        imapValue = printImapMailboxContent(iConn)
+    imapValue = printImapMailboxContent(iConn)
 
     # POP
-    if cli.IsVerbose() :
-        popValue = printPopMailboxContent(pConn)
+    popValue = printPopMailboxContent(pConn)
 
     mailDict = {}
     for (prot, newestMailObj) in zip(["imap", "pop"], [imapValue, popValue]) :
@@ -140,7 +240,7 @@ def HandleSuccessfulLogin(cli, connImapTriple, connPopTriple) :
         fromAddress = mail_helpers.getFromAddress(fromField)
 
         try :
-            timestamp = decomposeSubjectLine(subject)
+            timestamp = mail_helpers.decomposeSubjectLine(subject)
         except Exception as E :
             print("Exception while decomposing subject line: %s" % (E,), file=sys.stderr)
             sys.exit(5)
@@ -198,18 +298,214 @@ def HandleSuccessfulLogin(cli, connImapTriple, connPopTriple) :
     # see the following website for Multigraph Plugins
     # http://guide.munin-monitoring.org/en/latest/plugin/multigraphing.html
 
-    # theValue = iLoginDelay
-    # theValue = iConnectDelayd
     theValue = deltaSeconds
 
     HandleMeasureCommand(cli, theValue + 10.0)
 
+    if cli.ShouldPrintMultigraph() :
+        imapValues = {"connect" : iConnectDelay, "login" : iLoginDelay,
+                      "dns" : iConn.timer.GetDuration('resolve')}
+        imapValues.update(getTlsHandshakeValues(iConn))
+        popValues = {"connect" : pConnectDelay, "login" : pLoginDelay,
+                     "dns" : pConn.timer.GetDuration('resolve')}
+        popValues.update(getTlsHandshakeValues(pConn))
+        hopMessage = getHopMessage(iConn, uidNext, token, deliveryDelay, imapValue)
+        hopDelays = mail_helpers.getReceivedHopDelays(hopMessage) if hopMessage is not None else []
+        hopFieldNames = [fieldName for (fieldName, fieldLabel) in getDeliveryHopFields()]
+        subgraphValues = {
+            "imap_login" : imapValues,
+            "pop_login" : popValues,
+            "smtp_submit" : {"submit" : submitDelay,
+                             "dns" : smtpTimer.GetDuration('resolve')},
+            "delivery_hops" : dict(zip(hopFieldNames, hopDelays)),
+            "delivery" : {"delivered" : deliveryDelay},
+        }
+        HandleSubgraphMeasureCommand(cli, subgraphValues)
+        if ShouldProbeAllAddresses() :
+            HandleBackendMeasureCommand(cli)
+
     # Logout
     iConn.logout()
     pConn.quit()
 
     return cli.MapNagiosReturnCode(nagios_stuff.NAGIOS_RC_OK)
 
+def measureDelivery(conn, uidNext, token, submitStart, **keywords) :
+    """
+    Waits until the test message with the token is visible in the INBOX,
+    with IDLE if the server supports it and DELIVERY_IDLE is not 0.
+
+    @param uidNext: UIDNEXT of the INBOX before the message was submitted
+    @type  uidNext: int
+
+    @param submitStart: L{timing_helpers.clock} when the submission started
+    @type  submitStart: float
+
+    @keyword timeout: seconds (default is L{DEFAULT_DELIVERY_TIMEOUT_SECONDS},
+        the plugin reads DELIVERY_TIMEOUT)
+    @type    timeout: float
+
+    @keyword pollInterval: longest poll interval of servers without IDLE
+        in seconds (default is L{DEFAULT_DELIVERY_POLL_SECONDS}, the
+        plugin reads DELIVERY_POLL_INTERVAL)
+    @type    pollInterval: float
+
+    @return: seconds from the start of the submission until the server
+        reported the message, None on timeout
+    @rtype:  float
+    """
+    timeout = keywords.get('timeout', DEFAULT_DELIVERY_TIMEOUT_SECONDS)
+    pollInterval = keywords.get('pollInterval', DEFAULT_DELIVERY_POLL_SECONDS)
+    if uidNext is None :
+        print("IMAP server does not report UIDNEXT, cannot wait for the test message.", file=sys.stderr)
+        return None
+    arrival = imap_helpers.waitForHeaderValue(conn, uidNext, PROBE_TOKEN_HEADER, token,
+                                              timeout = timeout,
+                                              pollInterval = pollInterval,
+                                              useIdle = None if os.environ.get('DELIVERY_IDLE', '1') == '1' else False)
+    if arrival is None :
+        print("Test message did not arrive within %s seconds." % (timeout,), file=sys.stderr)
+        return None
+    return arrival - submitStart
+
+
+def getProbeMessageHeaders(conn, uidNext, token) :
+    """
+    Looks for the test message of this run among the messages that arrived
+    since uidNext was read, by its token (DELIVERY_PROBE=1).
+
+    @param uidNext: UIDNEXT of the INBOX before the message was submitted
+    @type  uidNext: int
+
+    @return: the header fields Received and L{PROBE_TOKEN_HEADER}, None if
+        the message has not arrived (yet)
+    @rtype:  email.message.Message
+    """
+    if uidNext is None :
+        return None
+    conn.select('INBOX', readonly = True)
+    headers = imap_helpers.fetchNewHeaders(conn, uidNext, ['RECEIVED', PROBE_TOKEN_HEADER])
+    for uid in sorted(headers) :
+        if (headers[uid][PROBE_TOKEN_HEADER] or '').strip() == token :
+            return headers[uid]
+    return None
+
+
+def getHopMessage(conn, uidNext, token, deliveryDelay, newestMailObj) :
+    """
+    The message whose Received headers give the delivery hops: the test
+    message of this run if the delivery probe waited for it, otherwise the
+    newest test message that had already arrived, as for the IMAP-POP
+    offset. The message submitted in this run is usually still on its
+    way at that point.
+
+    @param deliveryDelay: result of L{measureDelivery}, None if the probe
+        did not run or timed out
+    @type  deliveryDelay: float
+
+    @param newestMailObj: newest message of the INBOX
+    @type  newestMailObj: email.message.Message
+
+    @return: None if no test message is available
+    @rtype:  email.message.Message
+    """
+    if token is not None and deliveryDelay is not None :
+        probeMessage = getProbeMessageHeaders(conn, uidNext, token)
+        if probeMessage is not None :
+            return probeMessage
+    subject = (newestMailObj["SUBJECT"] or '').strip()
+    if not subject.startswith(mail_helpers.SUBJECT_PREFIX) :
+        return None
+    return newestMailObj
+
+
+def getTlsHandshakeValues(conn) :
+    """
+    The handshake time as 'tls'. Always a full handshake: the TLS session
+    cache lives only as long as this process, which makes a single
+    connection per server.
+
+    @type conn: L{imap_helpers.TimedIMAP4} | L{pop_helpers.TimedPOP3}
+
+    @rtype: dict
+    """
+    tlsDelay = conn.timer.GetDuration('tls')
+    if tlsDelay is None :
+        return {}
+    return {"tls" : tlsDelay}
+
+def ShouldProbeDelivery() :
+    """
+    @return: True if the plugin should wait for its own test message
+        (environment variable DELIVERY_PROBE=1)
+    @rtype:  bool
+    """
+    return os.environ.get('DELIVERY_PROBE', '0') == '1'
+
+#---
+#--- Name resolution
+def configureResolverCache(cli) :
+    """
+    The IMAP, POP3 and SMTP connections share one resolver cache. Its
+    lifetime is taken from DNS_CACHE_TTL (seconds), and it is kept in the
+    file DNS_CACHE_FILE between runs if that is set.
+    """
+    net_helpers.configureResolverCache(ttl = cli.GetDnsCacheTtl(),
+                                       path = os.environ.get('DNS_CACHE_FILE', None) or None)
+
+
+def ShouldProbeAllAddresses() :
+    """
+    @return: True if every address of the IMAP and POP3 host should be
+        measured (environment variable DNS_PROBE_ALL=1)
+    @rtype:  bool
+    """
+    return os.environ.get('DNS_PROBE_ALL', '0') == '1'
+
+
+def iterBackendSubgraphs(cli) :
+    """
+    @return: (subgraph, title, host, port) for every backend graph whose
+        host is configured
+    @rtype:  iterator
+    """
+    for (subgraph, title, hostVar, portVar, defaultPorts) in MONITOR_BACKEND_SUBGRAPHS :
+        host = os.environ.get(hostVar, None)
+        if not host :
+            continue
+        (sslPort, plainPort) = defaultPorts
+        port = cli.GetServicePort(portVar) or (sslPort if cli.ShouldUseSSL() else plainPort)
+        yield (subgraph, title % locals(), host, port)
+
+def getDeliveryHopFields() :
+    """
+    The hops are named by the environment variable DELIVERY_HOP_LABELS
+    (comma separated, e.g. 'content filter,LMTP delivery'); otherwise
+    L{DEFAULT_DELIVERY_HOPS} hops are numbered.
+
+    @return: (fieldName, fieldLabel) of every hop
+    @rtype:  [(str, str)]
+    """
+    labelText = os.environ.get('DELIVERY_HOP_LABELS', None)
+    if labelText :
+        labels = [label.strip() for label in labelText.split(',')]
+    else :
+        labels = ["hop %d" % (i,) for i in range(1, DEFAULT_DELIVERY_HOPS + 1)]
+    return [("hop%d" % (i,), label) for (i, label) in enumerate(labels, 1)]
+
+
+def getMonitorSubgraphs() :
+    """
+    @return: L{MONITOR_SUBGRAPHS}, the delivery hop graph and the graph
+        of the delivery probe if enabled
+    @rtype:  [(name, title, vlabel, [(fieldName, fieldLabel)])]
+    """
+    (subgraph, graphTitle, graphLabel) = MONITOR_DELIVERY_SUBGRAPH
+    subgraphs = MONITOR_SUBGRAPHS + [(subgraph, graphTitle, graphLabel, getDeliveryHopFields())]
+    if ShouldProbeDelivery() :
+        subgraphs.append(MONITOR_DELIVERY_PROBE_SUBGRAPH)
+    return subgraphs
+
 #---
 #--- Munin-Format
 def getMuninVariableName(cli) :
@@ -221,6 +517,14 @@ def getMuninVariableName(cli) :
     return variableName
 
 
+def getMuninSubgraphName(cli, subgraph) :
+    """
+    Subgraphs are nested below the main graph, so they do not collide
+    with the graphs of check_imap4.py and check_pop3.py.
+    """
+    return "%s.%s" % (getMuninVariableName(cli), subgraph)
+
+
 #---
 #--- Munin-Inhalt
 def HandleMeasureCommand(cli, theValue) :
@@ -229,9 +533,45 @@ def HandleMeasureCommand(cli, theValue) :
     @rtype:  int
     """
     variableName = getMuninVariableName(cli)
+    if cli.ShouldPrintMultigraph() :
+        munin_helpers.printMultigraph(variableName)
     print("%(variableName)s.value %(theValue).2f" % locals())
 
 
+def HandleSubgraphMeasureCommand(cli, subgraphValues) :
+    """
+    @param subgraphValues: subgraph name -> field name -> value
+        (see L{getMonitorSubgraphs})
+    @type  subgraphValues: dict
+    """
+    for (subgraph, graphTitle, graphLabel, fields) in getMonitorSubgraphs() :
+        munin_helpers.printMultigraph(getMuninSubgraphName(cli, subgraph))
+        values = subgraphValues.get(subgraph, {})
+        for (fieldName, fieldLabel) in fields :
+            fieldValue = munin_helpers.formatValue(values.get(fieldName, None))
+            print("%(fieldName)s.value %(fieldValue)s" % locals())
+
+
+def HandleBackendMeasureCommand(cli) :
+    """
+    Measures all addresses of the hosts concurrently, one field per address.
+    """
+    for (subgraph, graphTitle, host, port) in iterBackendSubgraphs(cli) :
+        munin_helpers.printMultigraph(getMuninSubgraphName(cli, subgraph))
+        try :
+            delays = net_helpers.measureAddresses(host, port,
+                                                  use_ssl = cli.ShouldUseSSL(),
+                                                  timeout = SOCKET_TIMEOUT_SECONDS)
+        except socket.error :
+            delays = {}
+        for (address, delay) in sorted(delays.items()) :
+            if delay is None :
+                delay = munin_helpers.MUNIN_VALUE_CANNOT_CONNECT
+            fieldName = munin_helpers.getFieldName(address)
+            fieldValue = munin_helpers.formatValue(delay)
+            print("%(fieldName)s.value %(fieldValue)s" % locals())
+
+
 def HandleConfigCommand(cli) :
     """
     For development of a Multigraph Plugin see:
@@ -246,7 +586,10 @@ def HandleConfigCommand(cli) :
     variableName = getMuninVariableName(cli)
     lowerLimit = munin_helpers.MUNIN_VALUE_MINIMUM
 
-    if 1 : # single graph plugin
+    if cli.ShouldPrintMultigraph() :
+        munin_helpers.printMultigraph(variableName)
+
+    if 1 : # main graph
         print("graph_title %(graphTitle)s" % locals())
         print("graph_vlabel %(graphLabel)s" % locals())
         if 1 :
@@ -259,61 +602,46 @@ def HandleConfigCommand(cli) :
 
         print("%(variableName)s.label %(graphLabel)s" % locals())
 
-    else : # multigraph plugin
-        print("""multigraph if_bytes
-graph_title $host interface traffic
-graph_order recv send
-graph_args --base 1000
-graph_vlabel bits in (-) / out (+) per \${graph_period}
-graph_category network
-graph_info This graph shows the total traffic for $host
-
-send.info Bits sent/received by $host
-recv.label recv
-recv.type DERIVE
-recv.graph no
-recv.cdef recv,8,*
-recv.min 0
-send.label bps
-send.type DERIVE
-send.negative recv
-send.cdef send,8,*
-send.min 0
-
-multigraph if_errors
-graph_title $host interface errors
-graph_order recv send
-graph_args --base 1000
-graph_vlabel errors in (-) / out (+) per \${graph_period}
-graph_category network
-graph_info This graph shows the total errors for $host
-
-send.info Errors in outgoing/incoming traffic on $host
-recv.label recv
-recv.type DERIVE
-recv.graph no
-recv.cdef recv,8,*
-recv.min 0
-send.label bps
-send.type DERIVE
-send.negative recv
-send.cdef send,8,*
-send.min 0""")
+    if cli.ShouldPrintMultigraph() :
+        user = cli.GetUser()
+        host = cli.GetHostname()
+        for (subgraph, subgraphTitle, subgraphLabel, fields) in getMonitorSubgraphs() :
+            munin_helpers.printMultigraph(getMuninSubgraphName(cli, subgraph))
+            print("graph_title %s" % (subgraphTitle % locals(),))
+            print("graph_vlabel %(subgraphLabel)s" % locals())
+            print("graph_args --base 1000 --lower-limit 0")
+            print("graph_scale no")
+            for (fieldName, fieldLabel) in fields :
+                print("%(fieldName)s.label %(fieldLabel)s" % locals())
+                print("%(fieldName)s.min 0" % locals())
+
+    if cli.ShouldPrintMultigraph() and ShouldProbeAllAddresses() :
+        for (subgraph, subgraphTitle, host, port) in iterBackendSubgraphs(cli) :
+            try :
+                addresses = net_helpers.getAddresses(host, port)
+            except socket.error :
+                addresses = []
+            munin_helpers.printMultigraph(getMuninSubgraphName(cli, subgraph))
+            print("graph_title %(subgraphTitle)s" % locals())
+            print("graph_vlabel ms")
+            print("graph_args --base 1000 --lower-limit %(lowerLimit)f" % locals())
+            print("graph_scale no")
+            for address in sorted(addresses) :
+                fieldName = munin_helpers.getFieldName(address)
+                print("%(fieldName)s.label %(address)s" % locals())
 
     return 0
 
 def GetImapConnection(cli, host, user, password, use_ssl) :
     DO_RAISE = True
 
-    timepreconnect = time.time()
+    timer = timing_helpers.PhaseTimer()
 
     try:
         import socket
         socket.setdefaulttimeout(SOCKET_TIMEOUT_SECONDS)
-        if use_ssl:
-            M = imaplib.IMAP4_SSL(host = host)
-        else:
-            M = imaplib.IMAP4(host)
+        M = imap_helpers.TimedIMAP4(host, use_ssl = use_ssl, timer = timer,
+                                    port = cli.GetServicePort('IMAP_PORT'))
     except Exception as e:
         if DO_RAISE :
             raise
@@ -322,8 +650,6 @@ def GetImapConnection(cli, host, user, password, use_ssl) :
                     "CRITICAL: Could not connect to %s: %s" % (host, e))
         return None
 
-    timeprelogin = time.time()
-
     try:
         M.login(user, password)
     except Exception as e:
@@ -334,9 +660,8 @@ def GetImapConnection(cli, host, user, password, use_ssl) :
                     "CRITICAL: IMAP Login not Successful: %s" % e)
         return None
 
-    timepostlogin = time.time()
-    connectDelay = (timeprelogin - timepreconnect) * 1000
-    loginDelay = (timepostlogin - timeprelogin) * 1000
+    connectDelay = timer.GetTotal(timing_helpers.SERVER_CONNECT_PHASES)
+    loginDelay = timer.GetDuration('login')
 
     return (M, connectDelay, loginDelay)
 
@@ -344,15 +669,13 @@ def GetImapConnection(cli, host, user, password, use_ssl) :
 def GetPopConnection(cli, host, user, password, use_ssl) :
     DO_RAISE = True
 
-    timepreconnect = time.time()
+    timer = timing_helpers.PhaseTimer()
 
     try:
         import socket
         socket.setdefaulttimeout(SOCKET_TIMEOUT_SECONDS)
-        if use_ssl:
-            M = poplib.POP3_SSL(host = host) # default port is 995
-        else:
-    	    M = poplib.POP3(host) # default port is 110
+        M = pop_helpers.TimedPOP3(host, use_ssl = use_ssl, timer = timer,
+                                  port = cli.GetServicePort('POP3_PORT')) # default port is 995 / 110
     except Exception as e:
         if DO_RAISE :
             raise
@@ -361,7 +684,8 @@ def GetPopConnection(cli, host, user, password, use_ssl) :
                     "CRITICAL: Could not connect to %s: %s" % (host, e))
         return None
 
-    timeprelogin = time.time()
+    connectDelay = timer.GetTotal(timing_helpers.SERVER_CONNECT_PHASES)
+    timer.skip()
 
     try:
         M.user(user)
@@ -373,9 +697,7 @@ def GetPopConnection(cli, host, user, password, use_ssl) :
                     HandleMeasureCommand,
                     "CRITICAL: POP3 Login not Successful: %s" % e)
 
-    timepostlogin = time.time()
-    connectDelay = (timeprelogin - timepreconnect) * 1000
-    loginDelay = (timepostlogin - timeprelogin) * 1000
+    loginDelay = timer.mark('login')
 
     return (M, connectDelay, loginDelay)
 
@@ -401,7 +723,8 @@ def printImapMailboxContent(conn) :
     newestMailObj = None
     for id, emailObj in imap_helpers.iterMailboxContent(conn, mailbox,
                                                         uniqueIdentifier = True,
-                                                        newestFirst = True) :
+                                                        newestFirst = True,
+                                                        headerFields = HEADER_FIELDS) :
         if 0 :
             print("ID = %(id)s" % locals())
         newestMailObj = emailObj
@@ -421,13 +744,11 @@ def printPopMailboxContent(conn) :
     """
     Reads the latest mail via POP.
     """
-    msgList = pop_helpers.listMessages(conn)
-    numMessages = len(msgList)
-    if 0 :
-        print("There are %i messages (via POP)." % (numMessages,))
     newestMailObj = None
 
-    for (sid, emailObj) in pop_helpers.iterMessages(conn, msgList, newestFirst = True) :
+    newest = pop_helpers.getNewestHeaders(conn)
+    if newest is not None :
+        (sid, emailObj) = newest
         if 0 :
             print("ID = %r" % (sid,))
             for headerType, headerTrunc in mail_helpers.iterEmailHeaders(emailObj, truncateAt = 70) :
@@ -436,9 +757,7 @@ def printPopMailboxContent(conn) :
                     print("    %-30s %s" % (headerType, headerDisplay,))
             print() # empty line
 
-
         newestMailObj = emailObj
-        break
 
     # show informations of the newest mail
     if newestMailObj is None :
@@ -469,36 +788,10 @@ def printPopMailboxContent(conn) :
 
     return newestMailObj
 
-SUBJECT_PREFIX = "Testmessage "
-
-def composeSubjectLine(now) :
-    """
-    @param now: the current timestamp
-    @type  now: datetime.datetime
-    """
-    timestamp = now.isoformat()
-    return "%s%s" % (SUBJECT_PREFIX, timestamp)
-
-
-def decomposeSubjectLine(subjectLine) :
-    """
-    @param subject: content of the subject field
-    @type  subject: str
-
-    @raise ValueError: on bad formatted subject line
-
-    @rtype: datetime.datetime
-    """
-    timestamp = subjectLine[len(SUBJECT_PREFIX):]
-    formatString = "%Y-%m-%dT%H:%M:%S.%f"
-    ts = datetime.datetime.strptime(timestamp, formatString)
-    return ts
-
-
 def sendTestMessageWithTimestamp(toAddress, fromAddress,
                                  smtpServer, smtpPort,
                                  smtpUser, smtpPassword,
-                                 now) :
+                                 now, **keywords) :
     """
     @param toAddress, fromAddress: sender and receiver
     @type  toAddress, fromAddress: str
@@ -515,21 +808,46 @@ def sendTestMessageWithTimestamp(toAddress, fromAddress,
 
     @param now: the current timestamp
     @type  now: datetime.datetime
-    """
-    msg = MIMEText("This is an automatic generated test message.\n\nPlease contact david-lukas.mueller@itz.uni-halle.de for details.")
-    msg['Subject'] = composeSubjectLine(now)
-    msg['From'] = fromAddress
-    msg['To'] = toAddress
 
-    s = smtplib.SMTP(smtpServer, smtpPort)
-    s.starttls() # (220, 'OK')
-    s.login(smtpUser, smtpPassword) # (235, 'Authentication succeeded')
-    s.sendmail(fromAddress, [toAddress], msg.as_string())
+    @keyword timer: receives the phases in L{timing_helpers.SMTP_PHASES}
+        (default is a new L{timing_helpers.PhaseTimer})
+    @type    timer: L{timing_helpers.PhaseTimer}
+
+    @keyword token: unique value of the header L{PROBE_TOKEN_HEADER}, to
+        find exactly this message again
+    @type    token: str
+
+    @return: time from connecting to the end of QUIT in milliseconds,
+        without the name resolution
+    @rtype:  float
+    """
+    headers = {}
+    token = keywords.get('token', None)
+    if token is not None :
+        headers[PROBE_TOKEN_HEADER] = token
+    message = smtp_helpers.composeTestMessage(fromAddress, toAddress,
+                                              mail_helpers.composeSubjectLine(now),
+                                              headers = headers)
+
+    timer = keywords.get('timer', None) or timing_helpers.PhaseTimer()
+    s = smtp_helpers.TimedSMTP(smtpServer, smtpPort, timer = timer,
+                               timeout = SOCKET_TIMEOUT_SECONDS)
+    smtp_helpers.startSession(s, smtpUser, smtpPassword) # (235, 'Authentication succeeded')
+    smtp_helpers.submitMessage(s, fromAddress, [toAddress], message)
     s.quit()
-    return
+    timer.mark('quit')
+    return timer.GetTotal(timing_helpers.SMTP_PHASES[1:])
 
 def main():
 
+    if spool_helpers.isActive() :
+        # 'acquire' probes into the spool, 'spoolfetch' reads it
+        return spool_helpers.main(main)
+
+    if collector_client.isActive() :
+        # only read the latest results of the collector daemon
+        return collector_client.main()
+
     defaultHostname = os.environ.get('IMAP_HOST', None)
 
     cli = CLI.GetInstance(hostname = defaultHostname,
@@ -541,6 +859,8 @@ def main():
     except Exception as E :
         return cli_helpers.HandleInvalidArguments(cli, E)
 
+    configureResolverCache(cli)
+
     if cli.IsConfigMode() :
         return HandleConfigCommand(cli)
 
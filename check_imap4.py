@@ -15,12 +15,13 @@
 # warranty of merchantability or fitness for a particular purpose.
 # See "LICENSE.GPL" in the source distribution for more information.
 
+from __future__ import print_function
+
 #---
 #--- Python
 import os
 import socket
 import sys
-import time
 
 #---
 #--- Python (Mail)
@@ -29,9 +30,15 @@ import imaplib
 #---
 #--- Plugin Stuff
 import cli_helpers
+import collector_client
+import spool_helpers
 import nagios_stuff
 import munin_helpers
 import imap_helpers
+import net_helpers
+import pool_helpers
+import stats_helpers
+import timing_helpers
 
 #---
 #--- Munin Constants (http://munin-monitoring.org/wiki/HowToWritePlugins)
@@ -40,6 +47,18 @@ MONITOR_GRAPH_TITLE = "IMAP login time"
 MONITOR_GRAPH_LABEL = "imap_login_time"
 MONITOR_MEASURED_VARIABLE = "imap%(ssl)s_login_time_%(user)s_at_%(host)s"
 
+MONITOR_PHASES_GRAPH_TITLE = "IMAP phases %(user)s@%(host)s"
+MONITOR_PHASES_GRAPH = "imap%(ssl)s_phases_%(user)s_at_%(host)s"
+
+MONITOR_DISTRIBUTION_GRAPH_TITLE = "IMAP login time distribution %(user)s@%(host)s"
+MONITOR_DISTRIBUTION_GRAPH = "imap%(ssl)s_login_distribution_%(user)s_at_%(host)s"
+
+MONITOR_TLS_GRAPH_TITLE = "IMAP TLS handshakes %(user)s@%(host)s"
+MONITOR_TLS_GRAPH = "imap%(ssl)s_tls_%(user)s_at_%(host)s"
+
+MONITOR_ACCOUNTS_TLS_GRAPH_TITLE = "IMAP TLS handshakes of the account list"
+MONITOR_ACCOUNTS_TLS_GRAPH = "imaps_tls_accounts"
+
 #---
 SOCKET_TIMEOUT_SECONDS = 5
 
@@ -48,6 +67,87 @@ class CLI(cli_helpers.BaseCLI) :
 
     _SINGLETON_INSTANCE = None #: Singleton Pattern
 
+    def createParser(self) :
+        parser = cli_helpers.BaseCLI.createParser(self)
+        parser.add_option("-a", "--accounts",
+                          dest = "accounts_file",
+                          help = "Check all accounts listed in FILE (one 'username password [hostname]' per line) concurrently. If not specified content of environment variable 'IMAP_ACCOUNTS_FILE' will be used.",
+                          action = "store",
+                          type = "string",
+                          metavar = "FILE",
+                          default = os.environ.get('IMAP_ACCOUNTS_FILE', None),
+        )
+
+        parser.add_option("-w", "--workers",
+                          dest = "max_workers",
+                          help = "Check at most N accounts at the same time (default: %d). If not specified content of environment variable 'IMAP_WORKERS' will be used." % (pool_helpers.DEFAULT_MAX_WORKERS,),
+                          action = "store",
+                          type = "int",
+                          metavar = "N",
+                          default = None,
+        )
+
+        parser.add_option("--async",
+                          dest = "use_async",
+                          help = "Check the accounts on a single asyncio event loop instead of a thread pool. '--workers' limits the number of open connections then. Requires Python 3.7.",
+                          action = "store_true",
+                          default = False,
+        )
+
+        parser.add_option("--pipeline",
+                          dest = "use_pipeline",
+                          help = "Send LOGIN together with the initial CAPABILITY command, saving one round trip. The measured login time then only contains the processing time of the server. If not specified content of environment variable 'IMAP_PIPELINE' will be used.",
+                          action = "store_true",
+                          default = os.environ.get('IMAP_PIPELINE', '0') == '1',
+        )
+
+        parser.add_option("--backends",
+                          dest = "probe_backends",
+                          help = "Resolve all addresses of the host and log in at every backend concurrently (the host name is still used for SNI). Prints one value per backend. If not specified content of environment variable 'IMAP_BACKENDS' will be used.",
+                          action = "store_true",
+                          default = os.environ.get('IMAP_BACKENDS', '0') == '1',
+        )
+
+        cli_helpers.addSamplesOption(parser)
+        return parser
+
+    def evaluate(self) :
+        cli_helpers.BaseCLI.evaluate(self)
+        if self._options.max_workers is None :
+            self._options.max_workers = cli_helpers.getEnvironmentInteger('IMAP_WORKERS',
+                                                                          pool_helpers.DEFAULT_MAX_WORKERS)
+
+    def GetAccounts(self) :
+        """
+        The account list is read from the file given by '--accounts' or
+        from the environment variable 'IMAP_ACCOUNTS' (accounts separated
+        by newlines or semicolons).
+
+        @return: None if only a single account should be checked
+        @rtype:  [(user, password, host)]
+        """
+        accountsFile = self._options.accounts_file
+        if accountsFile :
+            return cli_helpers.readAccountList(accountsFile,
+                                               hostname = self.GetHostname())
+        accountsText = os.environ.get('IMAP_ACCOUNTS', None)
+        if accountsText :
+            return cli_helpers.parseAccountList(accountsText.replace(';', '\n'),
+                                                hostname = self.GetHostname())
+        return None
+
+    def GetMaxWorkers(self) :
+        return self._options.max_workers
+
+    def ShouldUseAsync(self) :
+        return self._options.use_async
+
+    def ShouldPipeline(self) :
+        return self._options.use_pipeline
+
+    def ShouldProbeBackends(self) :
+        return self._options.probe_backends
+
     def MapNagiosReturnCode(self, nagiosReturnCode) :
         """
         @param nagiosReturnCode: Following values are specified
@@ -62,18 +162,35 @@ class CLI(cli_helpers.BaseCLI) :
         return nagiosReturnCode
 
 
-def HandleSuccessfulLogin(cli, conn, connectDelay, loginDelay) :
+def HandleSuccessfulLogin(cli, conn, connectDelay, loginDelay, timer = None) :
     """
     @param conn: the IMAP connection
 
     @param connectDelay, loginDelay: Timing
     @type  connectDelay, loginDelay: float
 
+    @param timer: phases of the check (only used for multigraph output)
+    @type  timer: L{timing_helpers.PhaseTimer}
+
     @return: final exit code
     @rtype:  int
     """
 
-    HandleMeasureCommand(cli, loginDelay)
+    if cli.ShouldPrintMultigraph() :
+        try :
+            imap_helpers.timeSelectAndFetch(conn, timer)
+        except Exception :
+            pass
+
+    tlsStats = stats_helpers.TLSHandshakeStats()
+    tlsStats.recordConnection(conn)
+
+    histogram = None
+    if cli.GetSamples() > 1 :
+        histogram = measureSamples(cli, loginDelay, tlsStats)
+        loginDelay = histogram.percentile(0.50)
+
+    HandleMeasureCommand(cli, loginDelay, timer, histogram, tlsStats)
     #HandleMeasureCommand(cli, connectDelayd)
 
     if cli.IsVerbose() :
@@ -86,25 +203,292 @@ def HandleSuccessfulLogin(cli, conn, connectDelay, loginDelay) :
     return cli.MapNagiosReturnCode(nagios_stuff.NAGIOS_RC_OK)
 
 
+def measureAccount(account, use_ssl, port = None, address = None, pipeline = False, tlsStats = None) :
+    """
+    Connects and logs in with a single account. Called from worker
+    threads, so nothing is printed here.
+
+    @param account: (user, password, host)
+    @type  account: (str, str, str)
+
+    @param port: None for the default port
+    @type  port: int
+
+    @param address: connect to this address of host (one backend of a
+        round-robin name) instead of resolving host
+    @type  address: str
+
+    @param pipeline: send LOGIN together with CAPABILITY (see '--pipeline')
+    @type  pipeline: bool
+
+    @param tlsStats: records the TLS handshake of the connection
+    @type  tlsStats: L{stats_helpers.TLSHandshakeStats}
+
+    @return: login time in milliseconds or one of the MUNIN_VALUE_CANNOT_*
+        constants
+    @rtype:  float
+    """
+    (user, password, host) = account
+
+    # accounts on the same host resume the TLS session of each other
+    timer = timing_helpers.PhaseTimer()
+
+    try:
+        M = imap_helpers.TimedIMAP4(host, use_ssl = use_ssl, port = port, timer = timer,
+                                    address = address,
+                                    login = (user, password) if pipeline else None)
+    except Exception:
+        return munin_helpers.MUNIN_VALUE_CANNOT_CONNECT
+
+    if tlsStats is not None :
+        tlsStats.recordConnection(M)
+
+    try:
+        M.login(user, password)
+    except Exception:
+        M.shutdown()
+        return munin_helpers.MUNIN_VALUE_CANNOT_LOGIN
+
+    loginDelay = timer.GetDuration('login')
+
+    try:
+        M.logout()
+    except Exception:
+        pass
+
+    return loginDelay
+
+
+def measureSamples(cli, firstLoginDelay, tlsStats = None) :
+    """
+    Logs in another L{CLI.GetSamples} - 1 times, one after another.
+    Failed logins are not part of the distribution, they are counted as
+    failed samples.
+
+    @param firstLoginDelay: the login time of the regular check
+    @type  firstLoginDelay: float
+
+    @param tlsStats: records the TLS handshakes of the samples, which
+        resume the session of the regular check
+    @type  tlsStats: L{stats_helpers.TLSHandshakeStats}
+
+    @rtype: L{stats_helpers.LatencyHistogram}
+    """
+    account = (cli.GetUser(), cli.GetPassword(), cli.GetHostname())
+    histogram = stats_helpers.LatencyHistogram()
+    histogram.record(firstLoginDelay)
+    stats_helpers.recordSamples(histogram,
+                                lambda : measureAccount(account, cli.ShouldUseSSL(), cli.GetPort(),
+                                                        pipeline = cli.ShouldPipeline(),
+                                                        tlsStats = tlsStats),
+                                cli.GetSamples() - 1)
+    return histogram
+
+
+def HandleAccountList(cli, accounts) :
+    """
+    Checks all accounts concurrently and prints one value per account.
+
+    @param accounts: result of L{CLI.GetAccounts}
+    @type  accounts: [(user, password, host)]
+
+    @return: final exit code
+    @rtype:  int
+    """
+    use_ssl = cli.ShouldUseSSL()
+    port = cli.GetPort()
+    pipeline = cli.ShouldPipeline()
+    tlsStats = stats_helpers.TLSHandshakeStats()
+
+    if cli.ShouldUseAsync() :
+        # without CAPABILITY the LOGIN is the first command anyway, so
+        # there is nothing to pipeline; asyncio measures no TLS phase
+        import async_helpers
+        values = async_helpers.runProbes(async_helpers.probeImapLogin,
+                                         accounts,
+                                         use_ssl = use_ssl,
+                                         port = port,
+                                         timeout = SOCKET_TIMEOUT_SECONDS,
+                                         maxInFlight = cli.GetMaxWorkers())
+    else :
+        socket.setdefaulttimeout(SOCKET_TIMEOUT_SECONDS)
+        values = pool_helpers.mapBounded(lambda account : measureAccount(account, use_ssl, port,
+                                                                         pipeline = pipeline,
+                                                                         tlsStats = tlsStats),
+                                         accounts,
+                                         maxWorkers = cli.GetMaxWorkers())
+
+    rc = nagios_stuff.NAGIOS_RC_OK
+    for variableName, theValue in zip(getAccountVariableNames(accounts, use_ssl), values) :
+        printMeasuredValue(variableName, theValue)
+        if theValue < 0 :
+            rc = nagios_stuff.NAGIOS_RC_CRITICAL
+
+    if cli.ShouldPrintMultigraph() and use_ssl :
+        # the accounts of a host resume the TLS sessions of each other
+        munin_helpers.printMultigraph(MONITOR_ACCOUNTS_TLS_GRAPH)
+        munin_helpers.printTLSGraphValues(tlsStats.getValues())
+
+    return cli.MapNagiosReturnCode(rc)
+
+
+def getBackendAddresses(cli) :
+    """
+    @raise socket.error: if the host cannot be resolved
+
+    @return: all addresses of the host, sorted
+    @rtype:  [str]
+    """
+    port = cli.GetPort() or (imaplib.IMAP4_SSL_PORT if cli.ShouldUseSSL() else imaplib.IMAP4_PORT)
+    return sorted(net_helpers.getAddresses(cli.GetHostname(), port))
+
+
+def HandleBackends(cli) :
+    """
+    Logs in at every address of the host concurrently and prints one
+    value per backend, so a single slow node behind a load balancer does
+    not disappear in the average.
+
+    @return: final exit code
+    @rtype:  int
+    """
+    user = cli.GetUser()
+    host = cli.GetHostname()
+    use_ssl = cli.ShouldUseSSL()
+    port = cli.GetPort()
+
+    socket.setdefaulttimeout(SOCKET_TIMEOUT_SECONDS)
+    try :
+        addresses = getBackendAddresses(cli)
+    except socket.error as e :
+        return cli_helpers.HandleCannotConnectError(cli,
+                    HandleMeasureCommand,
+                    "CRITICAL: Could not resolve %s: %s" % (host, e))
+
+    account = (user, cli.GetPassword(), host)
+    values = pool_helpers.mapBounded(lambda address : measureAccount(account, use_ssl, port, address,
+                                                                     cli.ShouldPipeline()),
+                                     addresses,
+                                     maxWorkers = cli.GetMaxWorkers())
+
+    rc = nagios_stuff.NAGIOS_RC_OK
+    for address, theValue in zip(addresses, values) :
+        printMeasuredValue(getMuninBackendVariableName(cli, address), theValue)
+        if theValue < 0 :
+            rc = nagios_stuff.NAGIOS_RC_CRITICAL
+
+    return cli.MapNagiosReturnCode(rc)
+
+
 #---
 #--- Munin-Format
+def getMuninVariableNameFor(user, fullhost, use_ssl) :
+    host = fullhost.split(".")[0]
+    ssl = "s" if use_ssl else ""
+    variableName = MONITOR_MEASURED_VARIABLE % locals()
+    return variableName
+
+
+def getAccountVariableNames(accounts, use_ssl) :
+    """
+    Valid and unique field names for an account list: users like 'a.b'
+    and 'a-b' both become 'a_b', the later ones get a number appended.
+
+        >>> getAccountVariableNames([('a.b', 'x', 'mail.example.org'), ('a-b', 'x', 'mail')], True)
+        ['imaps_login_time_a_b_at_mail', 'imaps_login_time_a_b_at_mail_2']
+
+    @param accounts: result of L{CLI.GetAccounts}
+    @type  accounts: [(user, password, host)]
+
+    @rtype: [str]
+    """
+    variableNames = []
+    for (user, password, host) in accounts :
+        variableName = munin_helpers.getFieldName(getMuninVariableNameFor(user, host, use_ssl))
+        candidate = variableName
+        number = 1
+        while candidate in variableNames :
+            number += 1
+            candidate = "%s_%d" % (variableName, number)
+        variableNames.append(candidate)
+    return variableNames
+
+
+def getMuninBackendVariableName(cli, address) :
+    return munin_helpers.getFieldName("%s_%s" % (getMuninVariableName(cli), address))
+
+
 def getMuninVariableName(cli) :
+    return getMuninVariableNameFor(cli.GetUser(),
+                                   cli.GetHostname(),
+                                   cli.ShouldUseSSL())
+
+
+def getMuninPhasesGraphName(cli) :
     host = cli.GetHostname().split(".")[0]
     ssl = "s" if cli.ShouldUseSSL() else ""
     user = cli.GetUser()
-    variableName = MONITOR_MEASURED_VARIABLE % locals()
-    return variableName
+    return MONITOR_PHASES_GRAPH % locals()
+
+
+def getMuninTLSGraphName(cli) :
+    host = cli.GetHostname().split(".")[0]
+    ssl = "s" if cli.ShouldUseSSL() else ""
+    user = cli.GetUser()
+    return MONITOR_TLS_GRAPH % locals()
+
+
+def getMuninDistributionGraphName(cli) :
+    host = cli.GetHostname().split(".")[0]
+    ssl = "s" if cli.ShouldUseSSL() else ""
+    user = cli.GetUser()
+    return MONITOR_DISTRIBUTION_GRAPH % locals()
 
 
 #---
 #--- Munin-Inhalt
-def HandleMeasureCommand(cli, theValue) :
+def printMeasuredValue(variableName, theValue) :
+    print("%(variableName)s.value %(theValue).2f" % locals())
+
+
+def HandleMeasureCommand(cli, theValue, timer = None, histogram = None, tlsStats = None) :
     """
+    @param timer: phases of the check (only used for multigraph output)
+    @type  timer: L{timing_helpers.PhaseTimer}
+
+    @param histogram: login times of all samples (only used for
+        multigraph output with more than one sample)
+    @type  histogram: L{stats_helpers.LatencyHistogram}
+
+    @param tlsStats: TLS handshakes of the check and its samples (only
+        used for multigraph output with SSL)
+    @type  tlsStats: L{stats_helpers.TLSHandshakeStats}
+
     @return: final exit code
     @rtype:  int
     """
     variableName = getMuninVariableName(cli)
-    print "%(variableName)s.value %(theValue).2f" % locals()
+    if cli.ShouldPrintMultigraph() :
+        munin_helpers.printMultigraph(variableName)
+    printMeasuredValue(variableName, theValue)
+
+    if cli.ShouldPrintMultigraph() :
+        if timer is None :
+            timer = timing_helpers.PhaseTimer()
+        munin_helpers.printMultigraph(getMuninPhasesGraphName(cli))
+        munin_helpers.printPhaseGraphValues(timer, timing_helpers.IMAP_PHASES)
+
+        if cli.GetSamples() > 1 :
+            if histogram is None :
+                histogram = stats_helpers.LatencyHistogram()
+            munin_helpers.printMultigraph(getMuninDistributionGraphName(cli))
+            munin_helpers.printSummaryGraphValues(histogram.summarize())
+
+        if cli.ShouldUseSSL() :
+            if tlsStats is None :
+                tlsStats = stats_helpers.TLSHandshakeStats()
+            munin_helpers.printMultigraph(getMuninTLSGraphName(cli))
+            munin_helpers.printTLSGraphValues(tlsStats.getValues())
 
 
 def HandleConfigCommand(cli) :
@@ -114,39 +498,94 @@ def HandleConfigCommand(cli) :
     """
     graphTitle = MONITOR_GRAPH_TITLE
     graphLabel = MONITOR_GRAPH_LABEL
-    variableName = getMuninVariableName(cli)
     lowerLimit = munin_helpers.MUNIN_VALUE_MINIMUM
+    accounts = cli.GetAccounts()
+    probeBackends = accounts is None and cli.ShouldProbeBackends()
+    isMultigraph = cli.ShouldPrintMultigraph() and accounts is None and not probeBackends
 
-    print "graph_title %(graphTitle)s" % locals()
-    print "graph_vlabel %(graphLabel)s" % locals()
-    if 1 :
-        print "graph_args --base 1000 --lower-limit %(lowerLimit)f" % locals()
-        print "graph_scale no"
-
-    if 0 :
-        print "%(variableName)s.warning 10" % locals()
-        print "%(variableName)s.critical 120" % locals()
+    if isMultigraph :
+        munin_helpers.printMultigraph(getMuninVariableName(cli))
 
-    print "%(variableName)s.label %(graphLabel)s" % locals()
+    print("graph_title %(graphTitle)s" % locals())
+    print("graph_vlabel %(graphLabel)s" % locals())
+    if 1 :
+        print("graph_args --base 1000 --lower-limit %(lowerLimit)f" % locals())
+        print("graph_scale no")
+
+    if probeBackends :
+        host = cli.GetHostname()
+        user = cli.GetUser()
+        try :
+            addresses = getBackendAddresses(cli)
+        except socket.error :
+            addresses = []
+        for address in addresses :
+            variableName = getMuninBackendVariableName(cli, address)
+            print("%(variableName)s.label %(user)s@%(host)s (%(address)s)" % locals())
+    elif accounts is None :
+        variableName = getMuninVariableName(cli)
+
+        if 0 :
+            print("%(variableName)s.warning 10" % locals())
+            print("%(variableName)s.critical 120" % locals())
+
+        print("%(variableName)s.label %(graphLabel)s" % locals())
+    else :
+        use_ssl = cli.ShouldUseSSL()
+        for (user, password, host), variableName in zip(accounts, getAccountVariableNames(accounts, use_ssl)) :
+            print("%(variableName)s.label %(user)s@%(host)s" % locals())
+        if cli.ShouldPrintMultigraph() and use_ssl :
+            munin_helpers.printMultigraph(MONITOR_ACCOUNTS_TLS_GRAPH)
+            munin_helpers.printTLSGraphConfig(MONITOR_ACCOUNTS_TLS_GRAPH_TITLE)
+
+    if isMultigraph :
+        user = cli.GetUser()
+        host = cli.GetHostname()
+        munin_helpers.printMultigraph(getMuninPhasesGraphName(cli))
+        munin_helpers.printPhaseGraphConfig(MONITOR_PHASES_GRAPH_TITLE % locals(),
+                                            timing_helpers.IMAP_PHASES,
+                                            timing_helpers.PHASE_LABELS)
+
+        if cli.GetSamples() > 1 :
+            munin_helpers.printMultigraph(getMuninDistributionGraphName(cli))
+            munin_helpers.printSummaryGraphConfig(MONITOR_DISTRIBUTION_GRAPH_TITLE % locals(),
+                                                  cli.GetSamples())
+
+        if cli.ShouldUseSSL() :
+            munin_helpers.printMultigraph(getMuninTLSGraphName(cli))
+            munin_helpers.printTLSGraphConfig(MONITOR_TLS_GRAPH_TITLE % locals())
     return 0
 
 
 def main():
 
+    if spool_helpers.isActive() :
+        # 'acquire' probes into the spool, 'spoolfetch' reads it
+        return spool_helpers.main(main)
+
+    if collector_client.isActive() :
+        # only read the latest results of the collector daemon
+        return collector_client.main()
+
     defaultHostname = os.environ.get('IMAP_HOST', None)
 
     cli = CLI.GetInstance(hostname = defaultHostname,
                           usernameVar = 'RECEIVING_USERNAME',
-                          passwordVar = 'RECEIVING_PASSWORD')
+                          passwordVar = 'RECEIVING_PASSWORD',
+                          portVar = 'IMAP_PORT')
 
     try:
         cli.evaluate()
+        accounts = cli.GetAccounts()
     except Exception as E :
         return cli_helpers.HandleInvalidArguments(cli, E)
 
     if cli.IsConfigMode() :
         return HandleConfigCommand(cli)
 
+    if accounts is not None :
+        return HandleAccountList(cli, accounts)
+
     user = cli.GetUser()
     host = cli.GetHostname()
     password = cli.GetPassword()
@@ -155,34 +594,34 @@ def main():
     if None in [user, password, host] :
         return cli_helpers.HandleMissingArguments(cli)
 
-    timepreconnect = time.time()
+    if cli.ShouldProbeBackends() :
+        return HandleBackends(cli)
+
+    timer = timing_helpers.PhaseTimer()
+    handleMeasureCommand = lambda cli, theValue : HandleMeasureCommand(cli, theValue, timer)
 
     try:
-        import socket
         socket.setdefaulttimeout(SOCKET_TIMEOUT_SECONDS)
-        if use_ssl:
-            M = imaplib.IMAP4_SSL(host = host)
-        else:
-            M = imaplib.IMAP4(host)
+        pipelinedLogin = (user, password) if cli.ShouldPipeline() else None
+        M = imap_helpers.TimedIMAP4(host, use_ssl = use_ssl, timer = timer,
+                                    port = cli.GetPort(),
+                                    login = pipelinedLogin)
     except Exception as e:
         return cli_helpers.HandleCannotConnectError(cli,
-                    HandleMeasureCommand,
+                    handleMeasureCommand,
                     "CRITICAL: Could not connect to %s: %s" % (host, e))
 
-    timeprelogin = time.time()
-
     try:
         M.login(user, password)
     except Exception as e:
         return cli_helpers.HandleCannotLoginError(cli,
-                    HandleMeasureCommand,
+                    handleMeasureCommand,
                     "CRITICAL: IMAP Login not Successful: %s" % e)
 
-    timepostlogin = time.time()
-    connectDelay = (timeprelogin - timepreconnect) * 1000
-    loginDelay = (timepostlogin - timeprelogin) * 1000
+    loginDelay = timer.GetDuration('login')
+    connectDelay = timer.GetTotal(timing_helpers.CONNECT_PHASES)
 
-    return HandleSuccessfulLogin(cli, M, connectDelay, loginDelay)
+    return HandleSuccessfulLogin(cli, M, connectDelay, loginDelay, timer)
 
 if __name__ == "__main__":
     retCode = main()
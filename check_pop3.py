@@ -15,25 +15,26 @@
 # warranty of merchantability or fitness for a particular purpose.
 # See "LICENSE.GPL" in the source distribution for more information.
 
+from __future__ import print_function
+
 #---
 #--- Python
 
 import os
 import socket
 import sys
-import time
-
-#---
-#--- Python (Mail)
-import poplib
 
 #---
 #--- Plugin Stuff
 import cli_helpers
+import collector_client
+import spool_helpers
 import nagios_stuff
 import munin_helpers
 import pop_helpers
 import mail_helpers
+import stats_helpers
+import timing_helpers
 
 #---
 #--- Munin Constants (http://munin-monitoring.org/wiki/HowToWritePlugins)
@@ -42,6 +43,12 @@ MONITOR_GRAPH_TITLE = "POP3 login time"
 MONITOR_GRAPH_LABEL = "pop3_login_time"
 MONITOR_MEASURED_VARIABLE = "pop%(ssl)s_login_time_%(user)s_at_%(host)s"
 
+MONITOR_PHASES_GRAPH_TITLE = "POP3 phases %(user)s@%(host)s"
+MONITOR_PHASES_GRAPH = "pop%(ssl)s_phases_%(user)s_at_%(host)s"
+
+MONITOR_DISTRIBUTION_GRAPH_TITLE = "POP3 login time distribution %(user)s@%(host)s"
+MONITOR_DISTRIBUTION_GRAPH = "pop%(ssl)s_login_distribution_%(user)s_at_%(host)s"
+
 #---
 SOCKET_TIMEOUT_SECONDS = 5
 
@@ -50,6 +57,10 @@ class CLI(cli_helpers.BaseCLI) :
 
     _SINGLETON_INSTANCE = None #: Singleton Pattern
 
+    def createParser(self) :
+        parser = cli_helpers.BaseCLI.createParser(self)
+        cli_helpers.addSamplesOption(parser)
+        return parser
 
     def MapNagiosReturnCode(self, nagiosReturnCode) :
         """
@@ -68,31 +79,50 @@ class CLI(cli_helpers.BaseCLI) :
 def printMailboxContent(conn) :
     msgList = pop_helpers.listMessages(conn)
     numMessages = len(msgList)
-    print "There are %i messages (via POP)." % (numMessages,)
+    print("There are %i messages (via POP)." % (numMessages,))
     for (sid, emailObj) in pop_helpers.iterMessages(conn, msgList) :
         #emailObj = email.message_from_string(rawMail)
         for headerType, headerTrunc in mail_helpers.iterEmailHeaders(emailObj, truncateAt = 70) :
             if mail_helpers.IsBaseHeader(headerType) :
                 headerDisplay = mail_helpers.RemoveLineBreaks(headerTrunc)
-                print "    %-30s %s" % (headerType, headerDisplay,)
-        print
+                print("    %-30s %s" % (headerType, headerDisplay,))
+        print()
 
-def HandleSuccessfulLogin(cli, conn, connectDelay, loginDelay) :
+def HandleSuccessfulLogin(cli, conn, connectDelay, loginDelay, timer = None) :
     """
     @param conn: the IMAP connection
 
     @param connectDelay, loginDelay: Timing
     @type  connectDelay, loginDelay: float
 
+    @param timer: phases of the check (only used for multigraph output)
+    @type  timer: L{timing_helpers.PhaseTimer}
+
     @return: final exit code
     @rtype:  int
     """
 
-    HandleMeasureCommand(cli, loginDelay)
+    if cli.ShouldPrintMultigraph() :
+        try :
+            pop_helpers.timeStatAndTop(conn, timer)
+        except Exception :
+            pass
+
+    histogram = None
+    if cli.GetSamples() > 1 :
+        if cli.IsVerbose() :
+            printMailboxContent(conn)
+        # most servers lock the maildrop for the session (RFC 1939) and
+        # refuse further logins with -ERR [IN-USE] until it ends
+        conn.quit()
+        histogram = measureSamples(cli, loginDelay)
+        loginDelay = histogram.percentile(0.50)
+        HandleMeasureCommand(cli, loginDelay, timer, histogram)
+        return nagios_stuff.NAGIOS_RC_OK
+
+    HandleMeasureCommand(cli, loginDelay, timer, histogram)
     #HandleMeasureCommand(cli, connectDelayd)
 
-    import email.header
-
     if cli.IsVerbose() :
         #try:
         printMailboxContent(conn)
@@ -100,12 +130,62 @@ def HandleSuccessfulLogin(cli, conn, connectDelay, loginDelay) :
         #    print "CRITICAL: POP3 Cannot retrieve stat: %s" % e
         #    return nagios_stuff.NAGIOS_RC_CRITICAL
         #finally :
-        conn.quit
         #print "OK POP3 Login Successful. N messages: ", numMessages
 
+    conn.quit()
     return nagios_stuff.NAGIOS_RC_OK
 
 
+def measureLogin(cli) :
+    """
+    Connects and logs in once more.
+
+    @return: login time in milliseconds or one of the MUNIN_VALUE_CANNOT_*
+        constants
+    @rtype:  float
+    """
+    timer = timing_helpers.PhaseTimer()
+    try:
+        M = pop_helpers.TimedPOP3(cli.GetHostname(), use_ssl = cli.ShouldUseSSL(), timer = timer,
+                                  port = cli.GetPort())
+    except Exception:
+        return munin_helpers.MUNIN_VALUE_CANNOT_CONNECT
+
+    try:
+        timer.skip()
+        M.user(cli.GetUser())
+        M.pass_(cli.GetPassword())
+    except Exception:
+        M.close()
+        return munin_helpers.MUNIN_VALUE_CANNOT_LOGIN
+
+    loginDelay = timer.mark('login')
+
+    try:
+        M.quit()
+    except Exception:
+        pass
+
+    return loginDelay
+
+
+def measureSamples(cli, firstLoginDelay) :
+    """
+    Logs in another L{CLI.GetSamples} - 1 times, one after another.
+    Failed logins are not part of the distribution, they are counted as
+    failed samples.
+
+    @param firstLoginDelay: the login time of the regular check
+    @type  firstLoginDelay: float
+
+    @rtype: L{stats_helpers.LatencyHistogram}
+    """
+    histogram = stats_helpers.LatencyHistogram()
+    histogram.record(firstLoginDelay)
+    stats_helpers.recordSamples(histogram, lambda : measureLogin(cli), cli.GetSamples() - 1)
+    return histogram
+
+
 #---
 #--- Munin Format
 def getMuninVariableName(cli) :
@@ -116,15 +196,50 @@ def getMuninVariableName(cli) :
     return variableName
 
 
+def getMuninPhasesGraphName(cli) :
+    host = cli.GetHostname().split(".")[0]
+    ssl = "s" if cli.ShouldUseSSL() else ""
+    user = cli.GetUser()
+    return MONITOR_PHASES_GRAPH % locals()
+
+
+def getMuninDistributionGraphName(cli) :
+    host = cli.GetHostname().split(".")[0]
+    ssl = "s" if cli.ShouldUseSSL() else ""
+    user = cli.GetUser()
+    return MONITOR_DISTRIBUTION_GRAPH % locals()
+
+
 #---
 #--- Munin-Inhalt
-def HandleMeasureCommand(cli, theValue) :
+def HandleMeasureCommand(cli, theValue, timer = None, histogram = None) :
     """
+    @param timer: phases of the check (only used for multigraph output)
+    @type  timer: L{timing_helpers.PhaseTimer}
+
+    @param histogram: login times of all samples (only used for
+        multigraph output with more than one sample)
+    @type  histogram: L{stats_helpers.LatencyHistogram}
+
     @return: final exit code
     @rtype:  int
     """
     variableName = getMuninVariableName(cli)
-    print "%(variableName)s.value %(theValue).2f" % locals()
+    if cli.ShouldPrintMultigraph() :
+        munin_helpers.printMultigraph(variableName)
+    print("%(variableName)s.value %(theValue).2f" % locals())
+
+    if cli.ShouldPrintMultigraph() :
+        if timer is None :
+            timer = timing_helpers.PhaseTimer()
+        munin_helpers.printMultigraph(getMuninPhasesGraphName(cli))
+        munin_helpers.printPhaseGraphValues(timer, timing_helpers.POP3_PHASES)
+
+        if cli.GetSamples() > 1 :
+            if histogram is None :
+                histogram = stats_helpers.LatencyHistogram()
+            munin_helpers.printMultigraph(getMuninDistributionGraphName(cli))
+            munin_helpers.printSummaryGraphValues(histogram.summarize())
 
 
 def HandleConfigCommand(cli) :
@@ -135,28 +250,53 @@ def HandleConfigCommand(cli) :
     graphTitle = MONITOR_GRAPH_TITLE
     graphLabel = MONITOR_GRAPH_LABEL
     variableName = getMuninVariableName(cli)
-    lowerLimit = MUNIN_VALUE_MINIMUM
+    lowerLimit = munin_helpers.MUNIN_VALUE_MINIMUM
 
-    print "graph_title %(graphTitle)s" % locals()
-    print "graph_vlabel %(graphLabel)s" % locals()
+    if cli.ShouldPrintMultigraph() :
+        munin_helpers.printMultigraph(variableName)
+
+    print("graph_title %(graphTitle)s" % locals())
+    print("graph_vlabel %(graphLabel)s" % locals())
     if 1 :
-        print "graph_args --base 1000 --lower-limit %(lowerLimit)f" % locals()
-        print "graph_scale no"
+        print("graph_args --base 1000 --lower-limit %(lowerLimit)f" % locals())
+        print("graph_scale no")
 
     if 0 :
-        print "%(variableName)s.warning 10" % locals()
-        print "%(variableName)s.critical 120" % locals()
-
-    print "%(variableName)s.label %(graphLabel)s" % locals()
+        print("%(variableName)s.warning 10" % locals())
+        print("%(variableName)s.critical 120" % locals())
+
+    print("%(variableName)s.label %(graphLabel)s" % locals())
+
+    if cli.ShouldPrintMultigraph() :
+        user = cli.GetUser()
+        host = cli.GetHostname()
+        munin_helpers.printMultigraph(getMuninPhasesGraphName(cli))
+        munin_helpers.printPhaseGraphConfig(MONITOR_PHASES_GRAPH_TITLE % locals(),
+                                            timing_helpers.POP3_PHASES,
+                                            timing_helpers.PHASE_LABELS)
+
+        if cli.GetSamples() > 1 :
+            munin_helpers.printMultigraph(getMuninDistributionGraphName(cli))
+            munin_helpers.printSummaryGraphConfig(MONITOR_DISTRIBUTION_GRAPH_TITLE % locals(),
+                                                  cli.GetSamples())
     return 0
 
 def main():
 
+    if spool_helpers.isActive() :
+        # 'acquire' probes into the spool, 'spoolfetch' reads it
+        return spool_helpers.main(main)
+
+    if collector_client.isActive() :
+        # only read the latest results of the collector daemon
+        return collector_client.main()
+
     defaultHostname = os.environ.get('IMAP_HOST', None)
 
     cli = CLI.GetInstance(hostname = defaultHostname,
                           usernameVar = 'RECEIVING_USERNAME',
-                          passwordVar = 'RECEIVING_PASSWORD')
+                          passwordVar = 'RECEIVING_PASSWORD',
+                          portVar = 'POP3_PORT')
 
     try:
         cli.evaluate()
@@ -174,22 +314,21 @@ def main():
     if None in [user, password, host] :
         return cli_helpers.HandleMissingArguments(cli)
 
-    timepreconnect = time.time()
+    timer = timing_helpers.PhaseTimer()
+    handleMeasureCommand = lambda cli, theValue : HandleMeasureCommand(cli, theValue, timer)
 
     try:
-        import socket
         socket.setdefaulttimeout(SOCKET_TIMEOUT_SECONDS)
-        if use_ssl:
-            M = poplib.POP3_SSL(host=host) # default port is 995
-        else:
-    	    M = poplib.POP3(host) # default port is 110
+        M = pop_helpers.TimedPOP3(host, use_ssl = use_ssl, timer = timer,
+                                  port = cli.GetPort()) # default port is 995 / 110
+        if cli.ShouldPrintMultigraph() :
+            pop_helpers.getCapabilities(M)
+            timer.mark('capability')
     except Exception as e:
         return cli_helpers.HandleCannotConnectError(cli,
-                    HandleMeasureCommand,
+                    handleMeasureCommand,
                     "CRITICAL: POP3 Connection not Successful: %s" % e)
 
-    timeprelogin = time.time()
-
     try:
         M.user(user)
         # '+OK password required for user "xyz"'
@@ -197,14 +336,13 @@ def main():
         # '+OK mailbox "xyz" has 5 messages (47919 octets) H migmx123'
     except Exception as e:
         return cli_helpers.HandleCannotLoginError(cli,
-                    HandleMeasureCommand,
+                    handleMeasureCommand,
                     "CRITICAL: POP3 Login not Successful: %s" % e)
 
-    timepostlogin = time.time()
-    connectDelay = (timeprelogin - timepreconnect) * 1000
-    loginDelay = (timepostlogin - timeprelogin) * 1000
+    loginDelay = timer.mark('login')
+    connectDelay = timer.GetTotal(timing_helpers.CONNECT_PHASES)
 
-    return HandleSuccessfulLogin(cli, M, connectDelay, loginDelay)
+    return HandleSuccessfulLogin(cli, M, connectDelay, loginDelay, timer)
 
 if __name__ == "__main__":
     retCode = main()
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: set fileencoding=utf-8 :
+# vi:si:et:sw=4:sts=4:ts=4
+# -*- Mode: Python -*-
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+
+from __future__ import print_function
+
+#---
+#--- Python
+import datetime
+import os
+import smtplib
+import socket
+import sys
+
+#---
+#--- Plugin Stuff
+import cli_helpers
+import collector_client
+import mail_helpers
+import munin_helpers
+import nagios_stuff
+import smtp_helpers
+import spool_helpers
+import stats_helpers
+import timing_helpers
+
+#---
+#--- Munin Constants (http://munin-monitoring.org/wiki/HowToWritePlugins)
+
+MONITOR_GRAPH_TITLE = "SMTP submission time"
+MONITOR_GRAPH_LABEL = "smtp_submit_time"
+MONITOR_MEASURED_VARIABLE = "smtp_submit_time_%(user)s_at_%(host)s"
+
+MONITOR_PHASES_GRAPH_TITLE = "SMTP phases %(user)s@%(host)s"
+MONITOR_PHASES_GRAPH = "smtp_phases_%(user)s_at_%(host)s"
+
+MONITOR_THROUGHPUT_GRAPH_TITLE = "SMTP submission rate %(user)s@%(host)s"
+MONITOR_THROUGHPUT_GRAPH = "smtp_throughput_%(user)s_at_%(host)s"
+
+MONITOR_DISTRIBUTION_GRAPH_TITLE = "SMTP message submission time distribution %(user)s@%(host)s"
+MONITOR_DISTRIBUTION_GRAPH = "smtp_message_distribution_%(user)s_at_%(host)s"
+
+#---
+SOCKET_TIMEOUT_SECONDS = 5
+
+#: phases of the submission time (the main value)
+SUBMIT_PHASES = ['connect', 'greeting', 'ehlo', 'starttls', 'auth', 'mail', 'rcpt', 'data', 'message']
+
+#---
+class CLI(cli_helpers.BaseCLI) :
+
+    _SINGLETON_INSTANCE = None #: Singleton Pattern
+
+    def createParser(self) :
+        parser = cli_helpers.BaseCLI.createParser(self)
+        parser.add_option("-f", "--from",
+                          dest = "from_address",
+                          help = "Send the test messages from ADDRESS. If not specified content of environment variable 'SENDING_ADDRESS' will be used.",
+                          action = "store",
+                          type = "string",
+                          metavar = "ADDRESS",
+                          default = os.environ.get('SENDING_ADDRESS', None),
+        )
+
+        parser.add_option("-r", "--recipient",
+                          dest = "to_address",
+                          help = "Send the test messages to ADDRESS. If not specified content of environment variable 'RECEIVING_ADDRESS' will be used.",
+                          action = "store",
+                          type = "string",
+                          metavar = "ADDRESS",
+                          default = os.environ.get('RECEIVING_ADDRESS', None),
+        )
+
+        parser.add_option("-b", "--burst",
+                          dest = "burst",
+                          help = "Send N messages over the same authenticated session and report the sustained submission rate (default: 1). If not specified content of environment variable 'SMTP_BURST' will be used.",
+                          action = "store",
+                          type = "int",
+                          metavar = "N",
+                          default = None,
+        )
+
+        parser.add_option("--no-starttls",
+                          dest = "use_starttls",
+                          help = "Submit without STARTTLS, e.g. on a trusted local port.",
+                          action = "store_false",
+                          default = os.environ.get('SMTP_STARTTLS', '1') == '1',
+        )
+        return parser
+
+    def evaluate(self) :
+        cli_helpers.BaseCLI.evaluate(self)
+        if self._options.burst is None :
+            self._options.burst = cli_helpers.getEnvironmentInteger('SMTP_BURST', 1)
+
+    def GetFromAddress(self) :
+        return self._options.from_address
+
+    def GetToAddress(self) :
+        return self._options.to_address
+
+    def GetBurst(self) :
+        return max(1, self._options.burst)
+
+    def ShouldUseStartTls(self) :
+        return self._options.use_starttls
+
+
+def HandleSuccessfulLogin(cli, conn, timer) :
+    """
+    Submits the test message(s) on the authenticated session.
+
+    @type conn: L{smtp_helpers.TimedSMTP}
+
+    @return: final exit code
+    @rtype:  int
+    """
+    fromAddress = cli.GetFromAddress()
+    toAddress = cli.GetToAddress()
+    burst = cli.GetBurst()
+
+    def composeMessage() :
+        subject = mail_helpers.composeSubjectLine(datetime.datetime.now())
+        return smtp_helpers.composeTestMessage(fromAddress, toAddress, subject)
+
+    rate = None
+    histogram = None
+    try :
+        smtp_helpers.submitMessage(conn, fromAddress, [toAddress], composeMessage())
+        submitDelay = timer.GetTotal(SUBMIT_PHASES)
+
+        if burst > 1 :
+            # the phases graph shows the first message, the others are
+            # counted for the rate and the distribution (MAIL FROM until
+            # the final reply of every message)
+            histogram = stats_helpers.LatencyHistogram()
+            histogram.record(timer.GetTotal(timing_helpers.SMTP_MESSAGE_PHASES))
+            burstTimer = timing_helpers.PhaseTimer()
+            for i in range(burst - 1) :
+                conn.timer = timing_helpers.PhaseTimer()
+                smtp_helpers.submitMessage(conn, fromAddress, [toAddress], composeMessage())
+                histogram.record(conn.timer.GetTotal(timing_helpers.SMTP_MESSAGE_PHASES))
+            burstSeconds = (timer.GetTotal(timing_helpers.SMTP_MESSAGE_PHASES) + burstTimer.mark('burst')) / 1000.0
+            rate = burst / burstSeconds if burstSeconds > 0 else None
+            conn.timer = timer
+    except (smtplib.SMTPException, socket.error) as e :
+        # the login worked, so this is no MUNIN_VALUE_CANNOT_LOGIN; the
+        # run has no submission time
+        print("CRITICAL: SMTP submission not successful: %s" % (e,), file=sys.stderr)
+        try :
+            conn.quit()
+        except (smtplib.SMTPException, socket.error) :
+            conn.close()
+        HandleMeasureCommand(cli, None, timer)
+        return nagios_stuff.NAGIOS_RC_CRITICAL
+
+    try :
+        conn.quit()
+        timer.mark('quit')
+    except (smtplib.SMTPException, socket.error) :
+        pass
+
+    HandleMeasureCommand(cli, submitDelay, timer, rate, histogram)
+    return cli.MapNagiosReturnCode(nagios_stuff.NAGIOS_RC_OK)
+
+
+#---
+#--- Munin Format
+def getMuninGraphName(cli, graphNameFormat) :
+    host = cli.GetHostname().split(".")[0]
+    user = cli.GetUser()
+    return graphNameFormat % locals()
+
+
+def getMuninVariableName(cli) :
+    return getMuninGraphName(cli, MONITOR_MEASURED_VARIABLE)
+
+
+#---
+#--- Munin-Inhalt
+def HandleMeasureCommand(cli, theValue, timer = None, rate = None, histogram = None) :
+    """
+    @param theValue: submission time in milliseconds, None if the
+        submission failed after the login
+    @type  theValue: float
+
+    @param timer: phases of the check (only used for multigraph output)
+    @type  timer: L{timing_helpers.PhaseTimer}
+
+    @param rate: messages per second of a burst (only used for
+        multigraph output)
+    @type  rate: float
+
+    @param histogram: submission times of the messages of a burst (only
+        used for multigraph output)
+    @type  histogram: L{stats_helpers.LatencyHistogram}
+
+    @return: final exit code
+    @rtype:  int
+    """
+    variableName = getMuninVariableName(cli)
+    if cli.ShouldPrintMultigraph() :
+        munin_helpers.printMultigraph(variableName)
+    print("%s.value %s" % (variableName, munin_helpers.formatValue(theValue)))
+
+    if cli.ShouldPrintMultigraph() :
+        if timer is None :
+            timer = timing_helpers.PhaseTimer()
+        munin_helpers.printMultigraph(getMuninGraphName(cli, MONITOR_PHASES_GRAPH))
+        munin_helpers.printPhaseGraphValues(timer, timing_helpers.SMTP_PHASES)
+
+        if cli.GetBurst() > 1 :
+            munin_helpers.printMultigraph(getMuninGraphName(cli, MONITOR_THROUGHPUT_GRAPH))
+            print("rate.value %s" % (munin_helpers.formatValue(rate),))
+
+            if histogram is None :
+                histogram = stats_helpers.LatencyHistogram()
+            munin_helpers.printMultigraph(getMuninGraphName(cli, MONITOR_DISTRIBUTION_GRAPH))
+            munin_helpers.printSummaryGraphValues(histogram.summarize())
+
+
+def HandleConfigCommand(cli) :
+    """
+    @return: final exit code
+    @rtype:  int
+    """
+    graphTitle = MONITOR_GRAPH_TITLE
+    graphLabel = MONITOR_GRAPH_LABEL
+    variableName = getMuninVariableName(cli)
+    lowerLimit = munin_helpers.MUNIN_VALUE_MINIMUM
+
+    if cli.ShouldPrintMultigraph() :
+        munin_helpers.printMultigraph(variableName)
+
+    print("graph_title %(graphTitle)s" % locals())
+    print("graph_vlabel %(graphLabel)s" % locals())
+    print("graph_args --base 1000 --lower-limit %(lowerLimit)f" % locals())
+    print("graph_scale no")
+    print("%(variableName)s.label %(graphLabel)s" % locals())
+
+    if cli.ShouldPrintMultigraph() :
+        user = cli.GetUser()
+        host = cli.GetHostname()
+        munin_helpers.printMultigraph(getMuninGraphName(cli, MONITOR_PHASES_GRAPH))
+        munin_helpers.printPhaseGraphConfig(MONITOR_PHASES_GRAPH_TITLE % locals(),
+                                            timing_helpers.SMTP_PHASES,
+                                            timing_helpers.PHASE_LABELS)
+
+        if cli.GetBurst() > 1 :
+            munin_helpers.printMultigraph(getMuninGraphName(cli, MONITOR_THROUGHPUT_GRAPH))
+            print("graph_title %s" % (MONITOR_THROUGHPUT_GRAPH_TITLE % locals(),))
+            print("graph_vlabel messages per second")
+            print("graph_args --base 1000 --lower-limit 0")
+            print("rate.label messages per second")
+            print("rate.min 0")
+
+            munin_helpers.printMultigraph(getMuninGraphName(cli, MONITOR_DISTRIBUTION_GRAPH))
+            munin_helpers.printSummaryGraphConfig(MONITOR_DISTRIBUTION_GRAPH_TITLE % locals(),
+                                                  cli.GetBurst())
+    return 0
+
+def main():
+
+    if spool_helpers.isActive() :
+        # 'acquire' probes into the spool, 'spoolfetch' reads it
+        return spool_helpers.main(main)
+
+    if collector_client.isActive() :
+        # only read the latest results of the collector daemon
+        return collector_client.main()
+
+    defaultHostname = os.environ.get('SMTP_HOST', None)
+
+    cli = CLI.GetInstance(hostname = defaultHostname,
+                          usernameVar = 'SENDING_USERNAME',
+                          passwordVar = 'SENDING_PASSWORD',
+                          portVar = 'SMTP_PORT')
+
+    try:
+        cli.evaluate()
+    except Exception as E:
+        return cli_helpers.HandleInvalidArguments(cli, E)
+
+    if cli.IsConfigMode() :
+        return HandleConfigCommand(cli)
+
+    user = cli.GetUser()
+    host = cli.GetHostname()
+    password = cli.GetPassword()
+
+    if None in [user, password, host, cli.GetFromAddress(), cli.GetToAddress()] :
+        return cli_helpers.HandleMissingArguments(cli)
+
+    timer = timing_helpers.PhaseTimer()
+    handleMeasureCommand = lambda cli, theValue : HandleMeasureCommand(cli, theValue, timer)
+
+    try:
+        M = smtp_helpers.TimedSMTP(host, cli.GetPort() or smtp_helpers.SMTP_SUBMISSION_PORT,
+                                   timer = timer,
+                                   timeout = SOCKET_TIMEOUT_SECONDS)
+    except Exception as e:
+        return cli_helpers.HandleCannotConnectError(cli,
+                    handleMeasureCommand,
+                    "CRITICAL: SMTP Connection not Successful: %s" % e)
+
+    try:
+        smtp_helpers.startSession(M, user, password,
+                                  use_starttls = cli.ShouldUseStartTls())
+    except Exception as e:
+        return cli_helpers.HandleCannotLoginError(cli,
+                    handleMeasureCommand,
+                    "CRITICAL: SMTP Login not Successful: %s" % e)
+
+    return HandleSuccessfulLogin(cli, M, timer)
+
+if __name__ == "__main__":
+    retCode = main()
+    sys.exit(retCode)
@@ -13,6 +13,14 @@ import os
 import nagios_stuff
 import munin_helpers
 
+#---
+#: see L{collector_client.main}
+COLLECTOR_EPILOG = ("If the environment variable 'COLLECTOR_SOCKET' is set, the latest results "
+                    "of the collector daemon (collector.py) are printed instead of probing the "
+                    "server. They are taken from the job named by the environment variable "
+                    "'COLLECTOR_JOB', otherwise from the job named like the plugin, i.e. the "
+                    "symlink in /etc/munin/plugins (e.g. 'imap_login_time', not 'check_imap4.py').")
+
 #---
 class BaseCLI(object) :
 
@@ -25,6 +33,10 @@ class BaseCLI(object) :
             hostname of the service under test.
         @type    usernameVar, passwordVar: str
 
+        @keyword portVar: Name of the environment variable holding the
+            port of the service under test (default: protocol default).
+        @type    portVar: str
+
         @keyword hostname: default value for server hostname
         @type    hostname: str
         """
@@ -32,17 +44,20 @@ class BaseCLI(object) :
         # Names of some environment variables
         self._ENV_NAME_USER = keywords.get('usernameVar', None)
         self._ENV_NAME_PASS = keywords.get('passwordVar', None)
+        self._ENV_NAME_PORT = keywords.get('portVar', None)
 
         self._options = None
         self._args = None
         self.user = None
         self.host = None
         self.password = None
+        self.port = None
         self.use_ssl = None
 
         # take default values from environment variables
         self.defaultUsername = os.environ.get(self._ENV_NAME_USER, None)
         self.defaultPassword = os.environ.get(self._ENV_NAME_PASS, None)
+        self.defaultPort = os.environ.get(self._ENV_NAME_PORT, None) if self._ENV_NAME_PORT else None
         self.defaultHostname = keywords.get('hostname', None)
 
         self.parser = self.createParser()
@@ -62,9 +77,26 @@ class BaseCLI(object) :
     def GetPassword(self) :
         return self.password
 
+    def GetPort(self) :
+        """
+        @return: None for the default port of the protocol
+        @rtype:  int
+        """
+        return self.port
+
     def ShouldUseSSL(self) :
         return self.use_ssl
 
+    def ShouldPrintMultigraph(self) :
+        return self._options.multigraph
+
+    def GetSamples(self) :
+        """
+        @return: number of measurements per run (see L{addSamplesOption})
+        @rtype:  int
+        """
+        return max(1, getattr(self._options, 'samples', 1))
+
     def MapNagiosReturnCode(self, nagiosReturnCode) :
         """
         @param nagiosReturnCode: Following values are specified
@@ -106,7 +138,7 @@ class BaseCLI(object) :
 
     def createParser(self) :
         usage = "usage: %prog [options] [config]"
-        parser = optparse.OptionParser(usage = usage)
+        parser = optparse.OptionParser(usage = usage, epilog = COLLECTOR_EPILOG)
         parser.add_option("-u", "--user",
                           dest = "user",
                           help = "Login as USER. If not specified content of environment variable '%s' will be used." % (self._ENV_NAME_USER,),
@@ -134,6 +166,15 @@ class BaseCLI(object) :
                           default = self.defaultHostname,
         )
 
+        parser.add_option("-P", "--port",
+                          dest = "port",
+                          help = "Connect to PORT instead of the default port of the protocol. If not specified content of environment variable '%s' will be used." % (self._ENV_NAME_PORT,),
+                          action = "store",
+                          type = "int",
+                          metavar = "PORT",
+                          default = self.defaultPort,
+        )
+
         parser.add_option("-s", "--secure",
                           dest = "use_ssl",
                           help = "secure connection with SSL/TLS",
@@ -147,6 +188,13 @@ class BaseCLI(object) :
                           action = "store_true",
         )
 
+        parser.add_option("-m", "--multigraph",
+                          dest = "multigraph",
+                          help = "Print a Munin multigraph with additional graphs (e.g. the duration of every phase of the check). If not specified content of environment variable 'MULTIGRAPH' will be used ('1' = active).",
+                          action = "store_true",
+                          default = os.environ.get('MULTIGRAPH', '0') == '1',
+        )
+
         return parser
 
     def evaluate(self) :
@@ -155,8 +203,12 @@ class BaseCLI(object) :
         self.user = options.user
         self.password = options.password
         self.host = options.host
+        self.port = int(options.port) if options.port else None
         self.use_ssl = options.use_ssl
 
+        if getattr(options, 'samples', 1) is None :
+            options.samples = getEnvironmentInteger('SAMPLES', 1)
+
         self._args = args
         self._options = options
 
@@ -164,6 +216,101 @@ class BaseCLI(object) :
             print("'%s' with '%s' -> '%s'" % (self.user, self.password, self.host))
 
 
+def getEnvironmentInteger(envName, default) :
+    """
+    Numeric option defaults are read in L{BaseCLI.evaluate}, not while
+    the parser is built, so a malformed value ends in
+    L{HandleInvalidArguments} like a malformed option.
+
+    @raise ValueError: if the variable is set but not an integer
+
+    @rtype: int
+    """
+    value = os.environ.get(envName, None)
+    if not value :
+        return default
+    try :
+        return int(value)
+    except ValueError :
+        raise ValueError("Environment variable '%s' is not an integer: %r" % (envName, value))
+
+
+def getEnvironmentFloat(envName, default) :
+    """
+    Like L{getEnvironmentInteger} for numbers like seconds.
+
+    @raise ValueError: if the variable is set but not a number
+
+    @rtype: float
+    """
+    value = os.environ.get(envName, None)
+    if not value :
+        return default
+    try :
+        return float(value)
+    except ValueError :
+        raise ValueError("Environment variable '%s' is not a number: %r" % (envName, value))
+
+
+def addSamplesOption(parser) :
+    """
+    Option of the plugins that can repeat their measurement in one run.
+
+    @type parser: optparse.OptionParser
+    """
+    parser.add_option("-k", "--samples",
+                      dest = "samples",
+                      help = "Measure K times one after another and report the median; the multigraph also shows minimum, percentiles and maximum (default: 1). If not specified content of environment variable 'SAMPLES' will be used.",
+                      action = "store",
+                      type = "int",
+                      metavar = "K",
+                      default = None,
+    )
+
+
+def parseAccountList(text, **keywords) :
+    """
+    Every non-empty line describes one account::
+
+        # comment
+        username password [hostname]
+
+    @keyword hostname: used for lines without hostname
+    @type    hostname: str
+
+    @raise ValueError: on lines with less than two or more than three fields
+
+    @return: list of (user, password, host)
+    @rtype:  [(str, str, str)]
+    """
+    defaultHostname = keywords.get('hostname', None)
+    accounts = []
+    for lineNo, line in enumerate(text.splitlines(), 1) :
+        line = line.strip()
+        if not line or line.startswith('#') :
+            continue
+        fields = line.split()
+        if len(fields) == 2 and defaultHostname is not None :
+            fields.append(defaultHostname)
+        if len(fields) != 3 :
+            raise ValueError("bad account in line %i: expected 'username password [hostname]'" % (lineNo,))
+        accounts.append(tuple(fields))
+    return accounts
+
+
+def readAccountList(path, **keywords) :
+    """
+    Reads an account list (see L{parseAccountList}) from a file.
+
+    @keyword hostname: used for lines without hostname
+    @type    hostname: str
+
+    @rtype: [(str, str, str)]
+    """
+    with open(path) as f :
+        return parseAccountList(f.read(), **keywords)
+
+
 def HandleInvalidArguments(cli, E) :
     """
     @param cli: Command Line Arguments
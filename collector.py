@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE.GPL" in the source distribution for more information.
+"""
+Collector daemon: runs the plugins on its own schedule and keeps their
+latest output, so a Munin fetch (see collector_client.py) only has to
+read it from a Unix socket.
+
+    python collector.py -c /etc/munin/imap-collector.ini -S /run/munin-imap-collector.sock
+
+With '--metrics-port' the same results are served to Prometheus at
+http://localhost:PORT/metrics.
+"""
+
+from __future__ import print_function
+
+#---
+#--- Python
+import optparse
+import os
+import socket
+import sys
+
+#---
+#--- Plugin Stuff
+import collector_client
+import collector_helpers
+
+#---
+def createParser() :
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage = usage)
+    parser.add_option("-c", "--config",
+                      dest = "config_file",
+                      help = "Read the jobs from FILE (INI format, one section per job). If not specified content of environment variable 'COLLECTOR_CONFIG' will be used.",
+                      action = "store",
+                      type = "string",
+                      metavar = "FILE",
+                      default = os.environ.get('COLLECTOR_CONFIG', None),
+    )
+
+    parser.add_option("-S", "--socket",
+                      dest = "socket_path",
+                      help = "Answer requests on the Unix socket PATH (default: %default).",
+                      action = "store",
+                      type = "string",
+                      metavar = "PATH",
+                      default = os.environ.get(collector_client.ENV_SOCKET, None) or collector_client.DEFAULT_SOCKET_PATH,
+    )
+
+    parser.add_option("--metrics-port",
+                      dest = "metrics_port",
+                      help = "Serve the latest results in OpenMetrics format at http://ADDRESS:PORT/metrics. If not specified content of environment variable 'COLLECTOR_METRICS_PORT' will be used.",
+                      action = "store",
+                      type = "int",
+                      metavar = "PORT",
+                      default = os.environ.get('COLLECTOR_METRICS_PORT', None),
+    )
+
+    parser.add_option("--metrics-address",
+                      dest = "metrics_address",
+                      help = "Listen for scrapes on ADDRESS, '0.0.0.0' for all IPv4 addresses (default: %default).",
+                      action = "store",
+                      type = "string",
+                      metavar = "ADDRESS",
+                      default = os.environ.get('COLLECTOR_METRICS_ADDRESS', '127.0.0.1'),
+    )
+    return parser
+
+
+def main():
+    parser = createParser()
+    (options, args) = parser.parse_args()
+
+    if options.config_file is None :
+        parser.print_help()
+        return 2
+
+    try :
+        jobs = collector_helpers.readJobConfig(options.config_file)
+    except (IOError, ValueError) as E :
+        print(E)
+        return 2
+
+    collector = collector_helpers.Collector(jobs)
+    if options.metrics_port :
+        try :
+            collector.serveMetrics(options.metrics_address, int(options.metrics_port))
+        except socket.error as E :
+            print("Cannot listen on %s:%s: %s" % (options.metrics_address, options.metrics_port, E))
+            return 2
+    try :
+        collector.serveForever(options.socket_path)
+    except KeyboardInterrupt :
+        pass
+    return 0
+
+if __name__ == "__main__":
+    retCode = main()
+    sys.exit(retCode)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Thin Munin plugin that prints the latest results of the collector daemon
+(see collector.py) instead of probing the mail server itself.
+
+Link it under the name of a job of the collector, e.g.::
+
+    ln -s /path/to/collector_client.py /etc/munin/plugins/imap_login_time
+
+    # /etc/munin/plugin-conf.d/imap
+    [imap_login_time]
+    env.COLLECTOR_SOCKET /run/munin-imap-collector.sock
+
+The plugins (check_imap4.py etc.) ask the collector the same way if
+COLLECTOR_SOCKET is set. Called under another name than the job, e.g.
+directly as check_imap4.py, set COLLECTOR_JOB to the name of the job.
+
+Only modules of the standard library are imported, so a fetch takes
+about as long as starting the interpreter.
+"""
+
+from __future__ import print_function
+
+#---
+#--- Python
+import os
+import socket
+import sys
+
+#---
+ENV_SOCKET = 'COLLECTOR_SOCKET' #: path of the Unix socket of the collector
+ENV_JOB = 'COLLECTOR_JOB'       #: name of the job (default: name of the plugin)
+
+DEFAULT_SOCKET_PATH = '/tmp/munin-imap-collector.sock'
+SOCKET_TIMEOUT_SECONDS = 5
+
+#---
+def isActive() :
+    """
+    @return: True if the plugins should ask the collector instead of
+        probing themselves
+    @rtype:  bool
+    """
+    return bool(os.environ.get(ENV_SOCKET, None))
+
+
+def queryCollector(command, jobName, **keywords) :
+    """
+    Sends a single request line (e.g. 'fetch imap_login_time') and reads
+    the answer until the collector closes the connection.
+
+    @param command: 'fetch', 'config' or 'list'
+    @type  command: str
+
+    @keyword socketPath: default is the content of the environment
+        variable 'COLLECTOR_SOCKET' or L{DEFAULT_SOCKET_PATH}
+    @type    socketPath: str
+
+    @keyword timeout: default is L{SOCKET_TIMEOUT_SECONDS}
+    @type    timeout: float
+
+    @raise socket.error: if the collector is not running
+
+    @return: the answer of the collector (Munin output of the job)
+    @rtype:  bytes
+    """
+    socketPath = keywords.get('socketPath', None) or \
+                 os.environ.get(ENV_SOCKET, None) or DEFAULT_SOCKET_PATH
+    timeout = keywords.get('timeout', SOCKET_TIMEOUT_SECONDS)
+
+    request = (" ".join([command] + ([jobName] if jobName else [])) + "\n").encode('utf-8')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try :
+        sock.settimeout(timeout)
+        sock.connect(socketPath)
+        sock.sendall(request)
+        chunks = []
+        while True :
+            chunk = sock.recv(65536)
+            if not chunk :
+                break
+            chunks.append(chunk)
+    finally :
+        sock.close()
+    return b"".join(chunks)
+
+
+def main(argv = None) :
+    """
+    @param argv: default is sys.argv; the job is named after argv[0]
+        unless the environment variable 'COLLECTOR_JOB' is set
+    @type  argv: [str]
+
+    @return: final exit code, 1 if the collector does not know the job
+        or has no current result of it
+    @rtype:  int
+    """
+    if argv is None :
+        argv = sys.argv
+    jobName = os.environ.get(ENV_JOB, None) or os.path.basename(argv[0])
+    command = 'config' if 'config' in argv[1:] else 'fetch'
+
+    try :
+        answer = queryCollector(command, jobName)
+    except (socket.error, socket.timeout) as e :
+        sys.stderr.write("Could not query collector: %s\n" % (e,))
+        return 1
+
+    if answer.startswith(b"#") :
+        # e.g. "# Unknown job 'check_imap4.py'"; Munin must not take it for output
+        sys.stderr.write("%s (set %s to the name of the job)\n"
+                         % (answer.decode('utf-8', 'replace').strip(), ENV_JOB))
+        return 1
+    if not answer :
+        sys.stderr.write("No current %s of job '%s' from the collector\n" % (command, jobName))
+        return 1
+
+    # Python 3: write bytes to the underlying binary buffer
+    getattr(sys.stdout, 'buffer', sys.stdout).write(answer)
+    return 0
+
+if __name__ == "__main__":
+    retCode = main()
+    sys.exit(retCode)
@@ -0,0 +1,668 @@
+# -*- coding: utf-8 -*-
+"""
+Building blocks of the collector daemon (see collector.py): jobs run the
+plugins on their own schedule, a L{ResultStore} keeps the latest output
+and a Unix socket server hands it out to L{collector_client}.
+"""
+
+from __future__ import print_function
+from builtins import object
+
+#---
+#--- Python
+import collections
+import http.server
+import os
+import shlex
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+try :
+    import configparser
+except ImportError : # Python 2
+    import ConfigParser as configparser
+
+#---
+#--- Plugin Stuff
+import collector_client
+import imap_helpers
+import metrics_helpers
+import munin_helpers
+import stats_helpers
+import timing_helpers
+
+#---
+DEFAULT_INTERVAL_SECONDS = 300
+DEFAULT_TIMEOUT_SECONDS = 60
+DEFAULT_LOGIN_INTERVAL_SECONDS = 900
+SESSION_SOCKET_TIMEOUT_SECONDS = 5
+
+#: the window of the NOOP distribution moves on in steps of 1/N interval
+SAMPLE_WINDOW_SLOTS = 10
+
+#: relative plugin paths in job commands are resolved against this directory
+PLUGIN_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+#: prefix of the job options that set environment variables (as in munin's plugin-conf.d)
+ENV_OPTION_PREFIX = 'env.'
+
+#---
+class ResultStore(object) :
+    """
+    Latest output of every job, separately for 'config' and 'fetch', and
+    counters of the runs since the start. Thread safe.
+
+        >>> store = ResultStore()
+        >>> store.update('imap', 'fetch', "multigraph g\\nlogin.value -100.00\\n", timestamp = 1000)
+        >>> store.countRun('imap', failed = False)
+        >>> store.countRun('imap', failed = True)
+        >>> sorted(store.getCounters().items())
+        [(('failures', 'imap'), 1), (('probe_errors', 'imap', 'g', 'login', 'cannot_login'), 1), (('runs', 'imap'), 2)]
+        >>> store.get('imap', 'fetch')
+        (1000, 'multigraph g\\nlogin.value -100.00\\n')
+        >>> store.get('imap', 'config') is None
+        True
+    """
+
+    def __init__(self) :
+        self._lock = threading.Lock()
+        self._results = {}
+        self._counters = {}
+
+    def update(self, jobName, kind, text, **keywords) :
+        """
+        @param kind: 'config' or 'fetch'
+        @type  kind: str
+
+        @keyword timestamp: time of the measurement (default: now)
+        @type    timestamp: float
+        """
+        timestamp = keywords.get('timestamp', None) or time.time()
+        with self._lock :
+            self._results[(jobName, kind)] = (timestamp, text)
+            if kind != 'fetch' :
+                return
+            # failed probes (see munin_helpers.MUNIN_VALUE_ERRORS)
+            for (graphName, fieldName, value) in munin_helpers.iterFieldValues(text) :
+                reason = munin_helpers.MUNIN_VALUE_ERRORS.get(value, None)
+                if reason is not None :
+                    self._increment(('probe_errors', jobName, graphName or jobName, fieldName, reason))
+
+    def countRun(self, jobName, failed) :
+        """
+        @param failed: True if the job did not deliver values
+        @type  failed: bool
+        """
+        with self._lock :
+            self._increment(('runs', jobName))
+            if failed :
+                self._increment(('failures', jobName))
+
+    def _increment(self, key) :
+        self._counters[key] = self._counters.get(key, 0) + 1
+
+    def getCounters(self) :
+        """
+        @return: key mapped to count; keys are ('runs', job),
+            ('failures', job) and ('probe_errors', job, graph, field,
+            reason)
+        @rtype:  dict
+        """
+        with self._lock :
+            return dict(self._counters)
+
+    def get(self, jobName, kind) :
+        """
+        @return: None if the job did not deliver any output yet
+        @rtype:  (float, str)
+        """
+        with self._lock :
+            return self._results.get((jobName, kind), None)
+
+
+class ScriptJob(object) :
+    """
+    Runs a plugin script in a child process and stores what it prints.
+    """
+
+    def __init__(self, name, command, **keywords) :
+        """
+        @param command: command line, e.g. 'check_imap4.py -m'; a script
+            ending in '.py' is run with the interpreter of the collector
+            and looked up in L{PLUGIN_DIRECTORY} if the path is relative
+        @type  command: str
+
+        @keyword interval: seconds between two runs
+            (default is L{DEFAULT_INTERVAL_SECONDS})
+        @type    interval: float
+
+        @keyword timeout: a run taking longer gets killed
+            (default is L{DEFAULT_TIMEOUT_SECONDS})
+        @type    timeout: float
+
+        @keyword maxAge: results older than this are not handed out any
+            more, so Munin records 'U' instead of a stale value
+            (default is three intervals)
+        @type    maxAge: float
+
+        @keyword environment: additional environment variables
+        @type    environment: dict
+        """
+        self.name = name
+        self.command = command
+        self.interval = keywords.get('interval', DEFAULT_INTERVAL_SECONDS)
+        self.timeout = keywords.get('timeout', DEFAULT_TIMEOUT_SECONDS)
+        self.maxAge = keywords.get('maxAge', None) or 3 * self.interval
+        self.environment = keywords.get('environment', {})
+
+    def getArgv(self, *args) :
+        argv = shlex.split(self.command)
+        if argv[0].endswith('.py') :
+            scriptPath = os.path.join(PLUGIN_DIRECTORY, argv[0])
+            argv = [sys.executable, scriptPath] + argv[1:]
+        return argv + list(args)
+
+    def getEnvironment(self) :
+        environment = dict(os.environ)
+        # the plugin has to probe itself instead of asking us
+        environment.pop(collector_client.ENV_SOCKET, None)
+        environment.update(self.environment)
+        return environment
+
+    def run(self, *args) :
+        """
+        @return: output of the plugin or None if it had to be killed
+        @rtype:  str
+        """
+        proc = subprocess.Popen(self.getArgv(*args),
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE,
+                                env = self.getEnvironment())
+        killer = threading.Timer(self.timeout, proc.kill)
+        killer.start()
+        try :
+            (out, err) = proc.communicate()
+        finally :
+            killer.cancel()
+        if proc.returncode < 0 :
+            return None
+        # the plugins exit with the Nagios return code, the output is valid anyway
+        return out.decode('utf-8', 'replace')
+
+    def collect(self, store) :
+        """
+        Runs the plugin once and stores its output. The config is only
+        requested until the plugin delivered it once.
+
+        @type store: L{ResultStore}
+        """
+        if store.get(self.name, 'config') is None :
+            config = self.run('config')
+            if config is not None :
+                store.update(self.name, 'config', config)
+
+        timestamp = time.time()
+        values = self.run()
+        if values is None :
+            raise RuntimeError("plugin killed after %s seconds" % (self.timeout,))
+        store.update(self.name, 'fetch', values, timestamp = timestamp)
+
+
+class ImapSessionJob(object) :
+    """
+    Keeps an IMAP session open across probe cycles. Every interval the
+    round trip time of a NOOP is measured, connect and login only every
+    login interval (or when the session died), which spares the
+    authentication backend.
+
+    With a sample interval the NOOP is sent that often instead, and the
+    distribution of the round trips of the last interval is reported
+    (minimum, percentiles and maximum), so the tail latency between two
+    Munin runs is not lost.
+
+    The TLS fields tell if the last login resumed the session of the one
+    before and how long its handshake took.
+
+    The account is taken from the same environment variables as used by
+    check_imap4.py (IMAP_HOST, IMAP_PORT, RECEIVING_USERNAME,
+    RECEIVING_PASSWORD).
+    """
+
+    FIELDS = [
+        ('noop', "NOOP round trip"),
+        ('connect', "connect"),
+        ('login', "LOGIN"),
+    ] + munin_helpers.TLS_FIELDS
+
+    def __init__(self, name, **keywords) :
+        """
+        @keyword interval: seconds between two NOOPs
+            (default is L{DEFAULT_INTERVAL_SECONDS})
+        @type    interval: float
+
+        @keyword loginInterval: seconds between two measurements of
+            connect and login (default is L{DEFAULT_LOGIN_INTERVAL_SECONDS})
+        @type    loginInterval: float
+
+        @keyword sampleInterval: seconds between two NOOPs if they should
+            be sent more often than every interval (default is None)
+        @type    sampleInterval: float
+
+        @keyword timeout: socket timeout
+            (default is L{SESSION_SOCKET_TIMEOUT_SECONDS})
+        @type    timeout: float
+
+        @keyword maxAge: see L{ScriptJob}
+        @type    maxAge: float
+
+        @keyword environment: overrides os.environ
+        @type    environment: dict
+        """
+        self.name = name
+        self.interval = keywords.get('interval', DEFAULT_INTERVAL_SECONDS)
+        self.loginInterval = keywords.get('loginInterval', DEFAULT_LOGIN_INTERVAL_SECONDS)
+        self.maxAge = keywords.get('maxAge', None) or 3 * self.interval
+        self.sampleInterval = keywords.get('sampleInterval', None)
+        #: (start, histogram) of the last SAMPLE_WINDOW_SLOTS parts of the interval
+        self.sampleSlots = collections.deque()
+        self.windowSeconds = self.interval
+        if self.sampleInterval :
+            # the collector runs the job every sample interval
+            self.interval = self.sampleInterval
+        environment = dict(os.environ)
+        environment.update(keywords.get('environment', {}))
+
+        self.host = environment.get('IMAP_HOST', None)
+        self.user = environment.get('RECEIVING_USERNAME', None)
+        if None in [self.host, self.user] :
+            raise ValueError("job '%s' needs IMAP_HOST and RECEIVING_USERNAME" % (name,))
+        port = environment.get('IMAP_PORT', None)
+        self.session = imap_helpers.ImapSession(self.host, self.user,
+                                                environment.get('RECEIVING_PASSWORD', None),
+                                                port = int(port) if port else None,
+                                                timeout = keywords.get('timeout', SESSION_SOCKET_TIMEOUT_SECONDS))
+        self.nextLogin = 0
+        self.connectDelay = None
+        self.loginDelay = None
+        self.tlsStats = stats_helpers.TLSHandshakeStats()
+
+    def getFields(self) :
+        """
+        @return: (field name, label)
+        @rtype:  [(str, str)]
+        """
+        fields = list(self.FIELDS)
+        if self.sampleInterval :
+            fields += [("noop_%s" % (key,), "NOOP round trip %s" % (munin_helpers.SUMMARY_LABELS[key],))
+                       for key in munin_helpers.SUMMARY_FIELDS]
+        return fields
+
+    def getConfig(self) :
+        lowerLimit = munin_helpers.MUNIN_VALUE_MINIMUM
+        lines = [
+            "graph_title IMAP session %s@%s" % (self.user, self.host),
+            "graph_vlabel ms",
+            "graph_args --base 1000 --lower-limit %f" % (lowerLimit,),
+            "graph_scale no",
+        ]
+        if self.sampleInterval :
+            lines.append("graph_info NOOP every %g seconds, distribution of the last %g seconds."
+                         % (self.sampleInterval, self.windowSeconds))
+        for (fieldName, fieldLabel) in self.getFields() :
+            lines.append("%s.label %s" % (fieldName, fieldLabel))
+        return "\n".join(lines) + "\n"
+
+    def recordSample(self, timestamp, noopDelay) :
+        """
+        Adds a NOOP round trip to the distribution.
+        """
+        slotSeconds = self.windowSeconds / float(SAMPLE_WINDOW_SLOTS)
+        slots = self.sampleSlots
+        if not slots or timestamp >= slots[-1][0] + slotSeconds :
+            slots.append((timestamp, stats_helpers.LatencyHistogram()))
+        slots[-1][1].record(noopDelay)
+
+    def getSampleSummary(self, timestamp) :
+        """
+        Drops the slots that are older than the window.
+
+        @rtype: dict (see L{stats_helpers.LatencyHistogram.summarize})
+        """
+        slots = self.sampleSlots
+        while slots and slots[0][0] <= timestamp - self.windowSeconds :
+            slots.popleft()
+        histogram = stats_helpers.LatencyHistogram()
+        for (start, slotHistogram) in self.sampleSlots :
+            histogram.merge(slotHistogram)
+        return histogram.summarize()
+
+    def measureLogin(self) :
+        self.loginDelay = None
+        self.tlsStats = stats_helpers.TLSHandshakeStats()
+        try :
+            timer = self.session.connect()
+        except Exception :
+            self.connectDelay = munin_helpers.MUNIN_VALUE_CANNOT_CONNECT
+            return
+        self.connectDelay = timer.GetTotal(timing_helpers.CONNECT_PHASES)
+        self.tlsStats.recordConnection(self.session.conn)
+        try :
+            self.loginDelay = self.session.login()
+        except Exception :
+            self.loginDelay = munin_helpers.MUNIN_VALUE_CANNOT_LOGIN
+
+    def collect(self, store) :
+        """
+        @type store: L{ResultStore}
+        """
+        if store.get(self.name, 'config') is None :
+            store.update(self.name, 'config', self.getConfig())
+
+        timestamp = time.time()
+        if timestamp >= self.nextLogin or not self.session.isOpen() :
+            self.measureLogin()
+            self.nextLogin = timestamp + self.loginInterval
+
+        noopDelay = None
+        if self.session.isOpen() :
+            try :
+                noopDelay = self.session.noop()
+            except Exception :
+                noopDelay = munin_helpers.MUNIN_VALUE_CANNOT_CONNECT
+
+        values = {'noop' : noopDelay, 'connect' : self.connectDelay, 'login' : self.loginDelay}
+        values.update(self.tlsStats.getValues())
+        if self.sampleInterval :
+            if noopDelay is not None and noopDelay >= 0 :
+                self.recordSample(timestamp, noopDelay)
+            summary = self.getSampleSummary(timestamp)
+            for key in munin_helpers.SUMMARY_FIELDS :
+                values["noop_%s" % (key,)] = summary[key]
+        text = "".join("%s.value %s\n" % (fieldName, munin_helpers.formatValue(values[fieldName]))
+                       for (fieldName, fieldLabel) in self.getFields())
+        store.update(self.name, 'fetch', text, timestamp = timestamp)
+
+
+def createJob(name, options) :
+    """
+    @param options: options of the job's section (see L{readJobConfig})
+    @type  options: dict
+
+    @raise ValueError: on missing or bad options
+
+    @rtype: L{ScriptJob} | L{ImapSessionJob}
+    """
+    environment = dict((key[len(ENV_OPTION_PREFIX):], value)
+                       for (key, value) in options.items()
+                       if key.startswith(ENV_OPTION_PREFIX))
+    keywords = {
+        'interval' : float(options.get('interval', DEFAULT_INTERVAL_SECONDS)),
+        'maxAge' : float(options.get('maxage', 0)),
+        'environment' : environment,
+    }
+    if 'timeout' in options :
+        keywords['timeout'] = float(options['timeout'])
+
+    jobType = options.get('type', 'script')
+    if jobType == 'script' :
+        if 'command' not in options :
+            raise ValueError("job '%s' has no command" % (name,))
+        return ScriptJob(name, options['command'], **keywords)
+    if jobType == 'imap-session' :
+        keywords['loginInterval'] = float(options.get('login_interval', DEFAULT_LOGIN_INTERVAL_SECONDS))
+        if 'sample_interval' in options :
+            keywords['sampleInterval'] = float(options['sample_interval'])
+        return ImapSessionJob(name, **keywords)
+    raise ValueError("job '%s' has unknown type '%s'" % (name, jobType))
+
+
+def readJobConfig(path) :
+    """
+    Every section of the INI file describes one job::
+
+        [imap_login_time]
+        command = check_imap4.py -m
+        interval = 60
+        env.IMAP_HOST = imap.example.org
+        env.RECEIVING_USERNAME = monitor
+
+        [imap_session]
+        type = imap-session
+        interval = 30
+        login_interval = 900
+        env.IMAP_HOST = imap.example.org
+
+    Options:
+        - type -- 'script' (default) or 'imap-session' (L{ImapSessionJob})
+        - command -- plugin command line of 'script' jobs (required)
+        - interval, timeout, maxage, login_interval, sample_interval, env.*
+
+    @raise ValueError: if the file is malformed or a job is incomplete
+
+    @rtype: [L{ScriptJob} | L{ImapSessionJob}]
+    """
+    parser = configparser.RawConfigParser()
+    parser.optionxform = str # keep the case of environment variables
+    with open(path) as f :
+        try :
+            if hasattr(parser, 'read_file') :
+                parser.read_file(f)
+            else : # Python 2
+                parser.readfp(f)
+        except configparser.Error as e :
+            raise ValueError(str(e))
+
+    return [createJob(section, dict(parser.items(section)))
+            for section in parser.sections()]
+
+
+#---
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler) :
+
+    def do_GET(self) :
+        if self.path.split('?')[0] != '/metrics' :
+            self.send_error(404)
+            return
+        openMetrics = metrics_helpers.acceptsOpenMetrics(self.headers.get('Accept', None))
+        body = self.server.collector.formatMetrics(openMetrics).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', metrics_helpers.OPENMETRICS_CONTENT_TYPE if openMetrics
+                                         else metrics_helpers.PROMETHEUS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) :
+        pass # every scrape would be logged
+
+
+class _HttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer) :
+    daemon_threads = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler) :
+
+    def handle(self) :
+        words = self.rfile.readline(1024).decode('utf-8', 'replace').split()
+        answer = self.server.collector.answer(words)
+        self.wfile.write(answer.encode('utf-8'))
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer) :
+    daemon_threads = True
+
+
+class Collector(object) :
+    """
+    Runs every job in its own thread and answers the requests of
+    L{collector_client} from the L{ResultStore}.
+
+    Requests are single lines:
+        - 'fetch <job>' -- latest values of the job
+        - 'config <job>' -- Munin config of the job
+        - 'list' -- names of all jobs
+
+    The same results can be scraped by Prometheus (see L{serveMetrics}).
+    """
+
+    def __init__(self, jobs) :
+        """
+        @type jobs: [L{ScriptJob} | L{ImapSessionJob}]
+        """
+        self.jobs = dict((job.name, job) for job in jobs)
+        self.store = ResultStore()
+        self._stopEvent = threading.Event()
+        self._threads = []
+
+    def answer(self, words) :
+        """
+        @param words: the request line split into words
+        @type  words: [str]
+
+        @rtype: str
+        """
+        if words == ['list'] :
+            return " ".join(sorted(self.jobs)) + "\n"
+        if len(words) != 2 or words[0] not in ('fetch', 'config') :
+            return "# Unknown command\n"
+
+        (kind, jobName) = words
+        job = self.jobs.get(jobName, None)
+        if job is None :
+            return "# Unknown job '%s'\n" % (jobName,)
+        result = self.store.get(jobName, kind)
+        if result is None :
+            return ""
+        (timestamp, text) = result
+        if kind == 'fetch' and time.time() - timestamp > job.maxAge :
+            return ""
+        return text
+
+    def getMetricFamilies(self) :
+        """
+        The latest values of all jobs (without stale results, unknown
+        values and the values of failed probes) and the counters of the
+        L{ResultStore}. Only reads the store, so scrapes never start a
+        probe.
+
+            >>> collector = Collector([ScriptJob('imap', 'check_imap4.py', interval = 60),
+            ...                        ScriptJob('old', 'check_pop3.py', interval = 60)])
+            >>> collector.store.update('imap', 'fetch', "login.value 12.50\\nconnect.value -200.00\\ntls.value U\\n")
+            >>> collector.store.update('old', 'fetch', "login.value 1.00\\n", timestamp = 1000)
+            >>> collector.store.countRun('imap', failed = False)
+            >>> for family in collector.getMetricFamilies() : # doctest: +ELLIPSIS
+            ...     for (labels, value) in family.samples :
+            ...         print(family.name, " ".join("%s=%s" % item for item in sorted(labels.items())), value)
+            munin_value field=login graph=imap job=imap 12.5
+            munin_collector_result_timestamp_seconds job=imap ...
+            munin_collector_result_timestamp_seconds job=old 1000
+            munin_collector_runs job=imap 1
+            munin_probe_errors field=connect graph=imap job=imap reason=cannot_connect 1
+
+        The stale result of 'old' only shows in its timestamp.
+
+        @rtype: [L{metrics_helpers.MetricFamily}]
+        """
+        values = metrics_helpers.MetricFamily('munin_value', 'gauge',
+                     "Latest value of a field of the Munin output of the job (times in ms).")
+        timestamps = metrics_helpers.MetricFamily('munin_collector_result_timestamp_seconds', 'gauge',
+                         "Time of the latest measurement of the job.")
+        now = time.time()
+        for jobName in sorted(self.jobs) :
+            result = self.store.get(jobName, 'fetch')
+            if result is None :
+                continue
+            (timestamp, text) = result
+            timestamps.add({'job' : jobName}, timestamp)
+            if now - timestamp > self.jobs[jobName].maxAge :
+                continue
+            for (graphName, fieldName, value) in munin_helpers.iterFieldValues(text) :
+                if value is None or value in munin_helpers.MUNIN_VALUE_ERRORS :
+                    continue
+                values.add({'job' : jobName, 'graph' : graphName or jobName, 'field' : fieldName}, value)
+
+        runs = metrics_helpers.MetricFamily('munin_collector_runs', 'counter',
+                   "Runs of the job since the collector started.")
+        failures = metrics_helpers.MetricFamily('munin_collector_failures', 'counter',
+                       "Runs of the job that did not deliver values.")
+        probeErrors = metrics_helpers.MetricFamily('munin_probe_errors', 'counter',
+                          "Fields reported as failed probe (could not connect or log in).")
+        counters = self.store.getCounters()
+        for key in sorted(counters) :
+            if key[0] == 'runs' :
+                runs.add({'job' : key[1]}, counters[key])
+            elif key[0] == 'failures' :
+                failures.add({'job' : key[1]}, counters[key])
+            elif key[0] == 'probe_errors' :
+                (kind, jobName, graphName, fieldName, reason) = key
+                probeErrors.add({'job' : jobName, 'graph' : graphName, 'field' : fieldName,
+                                 'reason' : reason}, counters[key])
+        return [values, timestamps, runs, failures, probeErrors]
+
+    def formatMetrics(self, openMetrics = True) :
+        """
+        @rtype: str
+        """
+        return metrics_helpers.formatMetrics(self.getMetricFamilies(), openMetrics)
+
+    def _runJob(self, job) :
+        while not self._stopEvent.is_set() :
+            started = time.time()
+            failed = False
+            try :
+                job.collect(self.store)
+            except Exception as e :
+                failed = True
+                print("job '%s' failed: %s" % (job.name, e), file = sys.stderr)
+            self.store.countRun(job.name, failed)
+            self._stopEvent.wait(max(0, started + job.interval - time.time()))
+
+    def start(self) :
+        for job in self.jobs.values() :
+            thread = threading.Thread(target = self._runJob, args = (job,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) :
+        self._stopEvent.set()
+
+    def serveMetrics(self, address, port) :
+        """
+        Answers scrapes of http://address:port/metrics in a background
+        thread, in OpenMetrics format if the scraper asks for it.
+
+        @return: the server, call shutdown() to stop it
+        @rtype:  http.server.HTTPServer
+        """
+        server = _HttpServer((address, port), _MetricsRequestHandler)
+        server.collector = self
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def serveForever(self, socketPath) :
+        """
+        Starts the jobs and answers requests on the Unix socket until
+        interrupted.
+        """
+        if os.path.exists(socketPath) :
+            os.remove(socketPath) # left over from a previous run
+        server = _UnixServer(socketPath, _RequestHandler)
+        server.collector = self
+        self.start()
+        try :
+            server.serve_forever()
+        finally :
+            self.stop()
+            server.server_close()
+            os.remove(socketPath)
+
+
+if __name__ == "__main__" :
+    import doctest
+    doctest.testmod()
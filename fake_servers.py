@@ -0,0 +1,1246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in servers for IMAP4rev1, POP3 and SMTP (with STARTTLS), so
+the plugins can be run and benchmarked without real credentials.
+
+All servers share one L{MailStore}: mails submitted via SMTP show up in
+the INBOX of IMAP and POP3. Every command can be slowed down by an
+artificial latency. Any credentials are accepted unless a password is
+given.
+
+    python fake_servers.py --message-count 1000 --message-size 20000 \\
+        --latency 0.002 --command-latency LOGIN=0.05
+
+Only the commands used by the plugins are implemented.
+"""
+
+from __future__ import print_function
+from builtins import object, range
+
+#---
+#--- Python
+import base64
+import datetime
+import email.utils
+import optparse
+import os
+import re
+import select
+import socket
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+#---
+CRLF = b"\r\n"
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_MESSAGE_COUNT = 10
+DEFAULT_MESSAGE_SIZE = 2048
+DEFAULT_MAILBOXES = ['INBOX', 'Sent', 'Trash']
+
+#: same prefix as used by mail_helpers.composeSubjectLine
+SUBJECT_PREFIX = "Testmessage "
+
+IMAP_CAPABILITIES = ['IMAP4rev1', 'LITERAL+', 'ESEARCH', 'LIST-STATUS', 'IDLE']
+
+#: during IDLE the client is checked for DONE at least this often
+IDLE_CHECK_SECONDS = 0.05
+
+SERVER_NAMES = ['imap', 'imaps', 'pop3', 'pop3s', 'smtp']
+
+_LITERAL_RE = re.compile(br'\{(?P<size>\d+)(?P<plus>\+?)\}$')
+
+#---
+#--- Messages
+def composeMessage(timestamp, size, **keywords) :
+    """
+    @param timestamp: used for the Date and Subject header
+    @type  timestamp: float
+
+    @param size: approximate size of the message in bytes
+    @type  size: int
+
+    @keyword fromAddress: default is 'monitor@example.org'
+    @type    fromAddress: str
+
+    @rtype: bytes
+    """
+    fromAddress = keywords.get('fromAddress', 'monitor@example.org')
+    dateString = email.utils.formatdate(timestamp, localtime = True)
+    subject = SUBJECT_PREFIX + datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%dT%H:%M:%S.%f")
+    headers = [
+        "Received: from localhost (localhost [127.0.0.1]) by fake-mx with LMTP; %s" % (dateString,),
+        "Received: from fake-submission (localhost [127.0.0.1]) by fake-mx with ESMTPS; %s" % (dateString,),
+        "Date: %s" % (dateString,),
+        "From: <%s>" % (fromAddress,),
+        "To: <%s>" % (fromAddress,),
+        "Subject: %s" % (subject,),
+        "Message-ID: <%.6f@fake-mx>" % (timestamp,),
+        "Content-Type: text/plain; charset=us-ascii",
+    ]
+    head = ("\r\n".join(headers) + "\r\n\r\n").encode('ascii')
+    bodyLine = b"x" * 76 + CRLF
+    lineCount = max(1, (size - len(head)) // len(bodyLine))
+    return head + bodyLine * lineCount
+
+
+def splitMessage(message) :
+    """
+    @return: (header block including the empty line, body)
+    @rtype:  (bytes, bytes)
+    """
+    index = message.find(CRLF + CRLF)
+    if index < 0 :
+        return (message, b"")
+    return (message[:index + 4], message[index + 4:])
+
+
+def selectHeaderFields(header, fieldNames) :
+    """
+    @return: the header lines (with continuation lines) of the given
+        fields followed by an empty line, like BODY[HEADER.FIELDS (...)]
+    @rtype:  bytes
+    """
+    wanted = set(name.upper() for name in fieldNames)
+    selected = []
+    keep = False
+    for line in header.split(CRLF) :
+        if not line :
+            continue
+        if line[:1] in (b" ", b"\t") :
+            if keep :
+                selected.append(line)
+            continue
+        keep = line.split(b":", 1)[0].strip().upper() in wanted
+        if keep :
+            selected.append(line)
+    return b"".join(line + CRLF for line in selected) + CRLF
+
+
+class MailStore(object) :
+    """
+    Mailboxes with messages and UIDs shared by all servers. Thread safe.
+    """
+
+    def __init__(self, **keywords) :
+        """
+        @keyword messageCount: number of generated messages in the INBOX
+            (default is L{DEFAULT_MESSAGE_COUNT})
+        @type    messageCount: int
+
+        @keyword messageSize: size of the generated messages in bytes
+            (default is L{DEFAULT_MESSAGE_SIZE})
+        @type    messageSize: int
+
+        @keyword mailboxes: default is L{DEFAULT_MAILBOXES}
+        @type    mailboxes: [str]
+        """
+        messageCount = keywords.get('messageCount', DEFAULT_MESSAGE_COUNT)
+        messageSize = keywords.get('messageSize', DEFAULT_MESSAGE_SIZE)
+        self.uidValidity = int(time.time())
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._mailboxes = {}
+        self._nextUid = {}
+        self._lockedMaildrops = set()
+        for name in keywords.get('mailboxes', DEFAULT_MAILBOXES) :
+            self._mailboxes[name] = []
+            self._nextUid[name] = 1
+
+        now = time.time()
+        for i in range(messageCount) :
+            self.append('INBOX', composeMessage(now - 60 * (messageCount - i), messageSize))
+
+    def getMailboxNames(self) :
+        with self._lock :
+            return sorted(self._mailboxes)
+
+    def hasMailbox(self, name) :
+        with self._lock :
+            return name in self._mailboxes
+
+    def append(self, mailbox, message) :
+        """
+        @return: UID of the new message
+        @rtype:  int
+        """
+        with self._lock :
+            uid = self._nextUid[mailbox]
+            self._nextUid[mailbox] = uid + 1
+            self._mailboxes[mailbox].append((uid, message))
+            self._changed.notify_all()
+            return uid
+
+    def waitForChange(self, mailbox, knownCount, timeout) :
+        """
+        Returns as soon as the mailbox does not contain knownCount
+        messages any more, at the latest after timeout seconds.
+        """
+        with self._changed :
+            if len(self._mailboxes[mailbox]) == knownCount :
+                self._changed.wait(timeout)
+
+    def getMessages(self, mailbox) :
+        """
+        @return: snapshot of the mailbox, the position in the list is the
+            sequence number - 1
+        @rtype:  [(int, bytes)]
+        """
+        with self._lock :
+            return list(self._mailboxes[mailbox])
+
+    def getNextUid(self, mailbox) :
+        with self._lock :
+            return self._nextUid[mailbox]
+
+    def lockMaildrop(self, user) :
+        """
+        @return: False if another POP3 session holds the maildrop of user
+        @rtype:  bool
+        """
+        with self._lock :
+            if user in self._lockedMaildrops :
+                return False
+            self._lockedMaildrops.add(user)
+            return True
+
+    def unlockMaildrop(self, user) :
+        with self._lock :
+            self._lockedMaildrops.discard(user)
+
+
+#---
+#--- Servers
+class Latency(object) :
+    """
+    Artificial delay before a command is answered.
+    """
+
+    def __init__(self, default = 0.0, perCommand = None) :
+        """
+        @param default: seconds for all commands not in perCommand
+        @type  default: float
+
+        @param perCommand: command name (e.g. 'LOGIN', 'UID FETCH',
+            'RETR', 'DATA') mapped to seconds
+        @type  perCommand: dict
+        """
+        self.default = default
+        self.perCommand = dict((name.upper(), seconds)
+                               for (name, seconds) in (perCommand or {}).items())
+
+    def getSeconds(self, command) :
+        command = command.upper()
+        if command in self.perCommand :
+            return self.perCommand[command]
+        return self.perCommand.get(command.split(" ")[-1], self.default)
+
+    def wait(self, command) :
+        seconds = self.getSeconds(command)
+        if seconds > 0 :
+            time.sleep(seconds)
+
+
+def parseCommandLatencies(specs) :
+    """
+    @param specs: e.g. ['LOGIN=0.05', 'UID FETCH=0.01']
+    @type  specs: [str]
+
+    @raise ValueError: on malformed specs
+
+    @rtype: dict
+    """
+    perCommand = {}
+    for spec in specs :
+        (name, sep, seconds) = spec.partition('=')
+        if not sep :
+            raise ValueError("bad command latency '%s': expected COMMAND=SECONDS" % (spec,))
+        perCommand[name.strip().upper()] = float(seconds)
+    return perCommand
+
+
+def createSelfSignedCertificate(directory) :
+    """
+    Creates a key and a certificate for 'localhost' with the openssl
+    command line tool.
+
+    @return: (certFile, keyFile)
+    @rtype:  (str, str)
+    """
+    certFile = os.path.join(directory, 'cert.pem')
+    keyFile = os.path.join(directory, 'key.pem')
+    with open(os.devnull, 'w') as devnull :
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                               '-nodes', '-subj', '/CN=localhost', '-days', '7',
+                               '-keyout', keyFile, '-out', certFile],
+                              stdout = devnull, stderr = devnull)
+    return (certFile, keyFile)
+
+
+def createServerSSLContext(certFile, keyFile) :
+    """
+    @rtype: ssl.SSLContext
+    """
+    protocol = getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23)
+    context = ssl.SSLContext(protocol)
+    context.load_cert_chain(certFile, keyFile)
+    return context
+
+
+class FakeServer(socketserver.ThreadingTCPServer) :
+
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 512
+
+    def __init__(self, address, handlerClass, store, **keywords) :
+        """
+        @type store: L{MailStore}
+
+        @keyword latency: default is no latency
+        @type    latency: L{Latency}
+
+        @keyword sslContext: needed for implicit TLS and STARTTLS
+        @type    sslContext: ssl.SSLContext
+
+        @keyword implicitTls: wrap the connection in TLS before the
+            greeting (IMAPS, POP3S); default is False
+        @type    implicitTls: bool
+
+        @keyword password: if given only this password is accepted
+        @type    password: str
+
+        @keyword deliveryDelay: seconds until a mail submitted via SMTP
+            shows up in the INBOX; default is 0
+        @type    deliveryDelay: float
+
+        @keyword capabilities: IMAP capabilities (default is
+            L{IMAP_CAPABILITIES})
+        @type    capabilities: [str]
+
+        @keyword lockMaildrop: refuse a second POP3 login of the same user
+            with -ERR [IN-USE], like most servers do (RFC 1939); default
+            is False
+        @type    lockMaildrop: bool
+        """
+        self.store = store
+        self.latency = keywords.get('latency', None) or Latency()
+        self.sslContext = keywords.get('sslContext', None)
+        self.implicitTls = keywords.get('implicitTls', False)
+        self.password = keywords.get('password', None)
+        self.deliveryDelay = keywords.get('deliveryDelay', 0)
+        self.capabilities = keywords.get('capabilities', None) or IMAP_CAPABILITIES
+        self.lockMaildrop = keywords.get('lockMaildrop', False)
+        socketserver.ThreadingTCPServer.__init__(self, address, handlerClass)
+
+    def isPasswordAccepted(self, password) :
+        if isinstance(password, bytes) :
+            password = password.decode('utf-8', 'replace')
+        return self.password is None or password == self.password
+
+
+class _BaseHandler(socketserver.StreamRequestHandler) :
+
+    def setup(self) :
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.server.implicitTls :
+            self.request = self.server.sslContext.wrap_socket(self.request, server_side = True)
+        socketserver.StreamRequestHandler.setup(self)
+        self.isTls = self.server.implicitTls
+
+    def isInputPending(self, timeout = 0) :
+        """
+        @param timeout: wait at most this many seconds for data
+        @type  timeout: float
+
+        @return: True if the client sent data that was not read yet;
+            only reliable while the client waits for an answer, so nothing
+            can be buffered in self.rfile
+        @rtype:  bool
+        """
+        if self.isTls and self.connection.pending() :
+            return True
+        (readable, writable, errors) = select.select([self.connection], [], [], timeout)
+        return bool(readable)
+
+    def startTls(self) :
+        self.wfile.flush()
+        self.request = self.server.sslContext.wrap_socket(self.request, server_side = True)
+        self.connection = self.request
+        self.rfile = self.request.makefile('rb', -1)
+        self.wfile = self.request.makefile('wb', 0)
+        self.isTls = True
+
+    def readLine(self) :
+        line = self.rfile.readline(65536)
+        if not line :
+            raise EOFError("connection closed by client")
+        return line.rstrip(CRLF)
+
+    def send(self, lines) :
+        """
+        Writes all lines of a response at once.
+
+        @type lines: [bytes]
+        """
+        self.wfile.write(b"".join(line + CRLF for line in lines))
+        self.wfile.flush()
+
+    def handle(self) :
+        try :
+            self.serve()
+        except (EOFError, socket.error, ssl.SSLError) :
+            pass
+
+    def serve(self) :
+        raise NotImplementedError
+
+
+#---
+#--- IMAP
+def quoteImapString(value) :
+    """
+    @type  value: bytes
+    @rtype: bytes
+    """
+    return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+def tokenizeImapArguments(line) :
+    """
+    Splits the arguments of an IMAP command. Quoted strings are
+    unquoted, parenthesized lists are kept as they are and brackets are
+    part of the atom, e.g. BODY.PEEK[HEADER.FIELDS (DATE FROM)].
+
+    @type  line: bytes
+    @rtype: [bytes]
+    """
+    tokens = []
+    i = 0
+    n = len(line)
+    while i < n :
+        c = line[i:i + 1]
+        if c == b" " :
+            i += 1
+        elif c == b'"' :
+            j = i + 1
+            chars = []
+            while j < n and line[j:j + 1] != b'"' :
+                if line[j:j + 1] == b"\\" :
+                    j += 1
+                chars.append(line[j:j + 1])
+                j += 1
+            tokens.append(b"".join(chars))
+            i = j + 1
+        else :
+            j = i
+            depth = 0
+            while j < n :
+                c = line[j:j + 1]
+                if c in (b"(", b"[") :
+                    depth += 1
+                elif c in (b")", b"]") :
+                    depth -= 1
+                elif c == b" " and depth == 0 :
+                    break
+                j += 1
+            tokens.append(line[i:j])
+            i = j
+    return tokens
+
+
+def parseSequenceSet(sequenceSet, largest) :
+    """
+    @param sequenceSet: e.g. b'1:3,7,10:*'
+    @type  sequenceSet: bytes
+
+    @param largest: value of '*'
+    @type  largest: int
+
+    @return: predicate for numbers in the set
+    @rtype:  callable
+    """
+    ranges = []
+    for part in sequenceSet.split(b",") :
+        bounds = [largest if b == b"*" else int(b) for b in part.split(b":")]
+        ranges.append((min(bounds), max(bounds)))
+    return lambda number : any(low <= number <= high for (low, high) in ranges)
+
+
+class ImapHandler(_BaseHandler) :
+
+    def serve(self) :
+        self.selected = None
+        self.readonly = False
+        self.knownExists = 0
+        self.send([b"* OK [CAPABILITY " + self.getCapabilities() + b"] fake IMAP4rev1 server ready"])
+        while True :
+            (tag, name, args) = self.readCommand()
+            self.tag = tag
+            self.server.latency.wait(name)
+            method = getattr(self, 'do_' + name.replace(" ", "_"), None)
+            if method is None :
+                self.send([tag + b" BAD unknown command"])
+                continue
+            untagged = []
+            try :
+                status = method(args, untagged)
+            except (ValueError, IndexError, KeyError) as e :
+                untagged = []
+                status = b"BAD " + str(e).encode('utf-8', 'replace')
+            self.send(untagged + [tag + b" " + status])
+            if name == 'LOGOUT' :
+                return
+
+    def readCommand(self) :
+        """
+        Reads a command line, literals are inlined as quoted strings.
+
+        @return: (tag, upper case command name, arguments)
+        @rtype:  (bytes, str, [bytes])
+        """
+        line = self.readLine()
+        m = _LITERAL_RE.search(line)
+        while m :
+            if not m.group('plus') :
+                self.send([b"+ go ahead"])
+            literal = self.rfile.read(int(m.group('size')))
+            line = line[:m.start()] + quoteImapString(literal) + self.readLine()
+            m = _LITERAL_RE.search(line)
+
+        parts = line.split(b" ", 2)
+        tag = parts[0]
+        name = parts[1].decode('ascii', 'replace').upper() if len(parts) > 1 else ''
+        rest = parts[2] if len(parts) > 2 else b""
+        if name == 'UID' :
+            (subName, sep, rest) = rest.partition(b" ")
+            name = 'UID ' + subName.decode('ascii', 'replace').upper()
+        return (tag, name, tokenizeImapArguments(rest))
+
+    def getCapabilities(self) :
+        return " ".join(self.server.capabilities).encode('ascii')
+
+    def getMessages(self) :
+        return self.server.store.getMessages(self.selected)
+
+    def reportNewMessages(self, untagged) :
+        if self.selected is None :
+            return
+        exists = len(self.getMessages())
+        if exists != self.knownExists :
+            self.knownExists = exists
+            untagged.append(b"* %d EXISTS" % (exists,))
+
+    def getStatusItems(self, mailbox, items) :
+        """
+        @param items: e.g. [b'MESSAGES', b'UNSEEN']
+        @rtype: bytes
+        """
+        store = self.server.store
+        values = {
+            b"MESSAGES" : len(store.getMessages(mailbox)),
+            b"RECENT" : 0,
+            b"UNSEEN" : 0,
+            b"UIDNEXT" : store.getNextUid(mailbox),
+            b"UIDVALIDITY" : store.uidValidity,
+        }
+        pairs = [b"%s %d" % (item.upper(), values[item.upper()]) for item in items]
+        return b"* STATUS " + quoteImapString(mailbox.encode('utf-8')) + b" (" + b" ".join(pairs) + b")"
+
+    #---
+    def do_CAPABILITY(self, args, untagged) :
+        untagged.append(b"* CAPABILITY " + self.getCapabilities())
+        return b"OK CAPABILITY completed"
+
+    def do_NOOP(self, args, untagged) :
+        self.reportNewMessages(untagged)
+        return b"OK NOOP completed"
+
+    def do_LOGIN(self, args, untagged) :
+        if not self.server.isPasswordAccepted(args[1]) :
+            return b"NO [AUTHENTICATIONFAILED] invalid credentials"
+        return b"OK [CAPABILITY " + self.getCapabilities() + b"] LOGIN completed"
+
+    def do_IDLE(self, args, untagged) :
+        """
+        RFC2177: new messages are reported as soon as they are stored,
+        until the client sends DONE.
+        """
+        if self.selected is None :
+            return b"BAD no mailbox selected"
+        # messages stored since the last command are reported before the
+        # continuation, as RFC2177 allows
+        pending = []
+        self.reportNewMessages(pending)
+        self.send(pending + [b"+ idling"])
+        while not self.isInputPending() :
+            pending = []
+            self.reportNewMessages(pending)
+            if pending :
+                self.send(pending)
+                # clients usually answer new messages with DONE right away
+                if self.isInputPending(IDLE_CHECK_SECONDS) :
+                    break
+            else :
+                self.server.store.waitForChange(self.selected, self.knownExists, IDLE_CHECK_SECONDS)
+        if self.readLine().upper() != b"DONE" :
+            return b"BAD expected DONE"
+        return b"OK IDLE terminated"
+
+    def do_LOGOUT(self, args, untagged) :
+        untagged.append(b"* BYE logging out")
+        return b"OK LOGOUT completed"
+
+    def do_SELECT(self, args, untagged, readonly = False) :
+        mailbox = args[0].decode('utf-8')
+        if mailbox.upper() == 'INBOX' :
+            mailbox = 'INBOX'
+        if not self.server.store.hasMailbox(mailbox) :
+            self.selected = None
+            return b"NO [NONEXISTENT] no such mailbox"
+        self.selected = mailbox
+        self.readonly = readonly
+        self.knownExists = len(self.getMessages())
+        store = self.server.store
+        untagged.extend([
+            b"* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)",
+            b"* %d EXISTS" % (self.knownExists,),
+            b"* 0 RECENT",
+            b"* OK [UIDVALIDITY %d] UIDs valid" % (store.uidValidity,),
+            b"* OK [UIDNEXT %d] predicted next UID" % (store.getNextUid(mailbox),),
+        ])
+        return b"OK [READ-ONLY] EXAMINE completed" if readonly else b"OK [READ-WRITE] SELECT completed"
+
+    def do_EXAMINE(self, args, untagged) :
+        return self.do_SELECT(args, untagged, readonly = True)
+
+    def do_CLOSE(self, args, untagged) :
+        self.selected = None
+        return b"OK CLOSE completed"
+
+    do_UNSELECT = do_CLOSE
+
+    def do_LIST(self, args, untagged) :
+        pattern = args[1].decode('utf-8')
+        returnStatus = None
+        if len(args) > 3 and args[2].upper() == b"RETURN" :
+            m = re.search(br'STATUS \(([^)]*)\)', args[3], re.IGNORECASE)
+            if m :
+                returnStatus = m.group(1).split()
+        for name in self.server.store.getMailboxNames() :
+            if pattern not in ('*', '%') and pattern != name :
+                continue
+            untagged.append(b'* LIST (\\HasNoChildren) "/" ' + quoteImapString(name.encode('utf-8')))
+            if returnStatus :
+                untagged.append(self.getStatusItems(name, returnStatus))
+        return b"OK LIST completed"
+
+    do_LSUB = do_LIST
+
+    def do_STATUS(self, args, untagged) :
+        mailbox = args[0].decode('utf-8')
+        if not self.server.store.hasMailbox(mailbox) :
+            return b"NO [NONEXISTENT] no such mailbox"
+        untagged.append(self.getStatusItems(mailbox, args[1].strip(b"()").split()))
+        return b"OK STATUS completed"
+
+    def do_APPEND(self, args, untagged) :
+        mailbox = args[0].decode('utf-8')
+        if not self.server.store.hasMailbox(mailbox) :
+            return b"NO [TRYCREATE] no such mailbox"
+        uid = self.server.store.append(mailbox, args[-1])
+        return b"OK [APPENDUID %d %d] APPEND completed" % (self.server.store.uidValidity, uid)
+
+    def do_SEARCH(self, args, untagged, byUid = False) :
+        if self.selected is None :
+            return b"BAD no mailbox selected"
+        messages = self.getMessages()
+        numbers = [uid for (uid, message) in messages] if byUid \
+                  else list(range(1, len(messages) + 1))
+        if args and args[0].upper() == b"RETURN" :
+            options = args[1].strip(b"()").upper().split() or [b"ALL"]
+            result = [b'* ESEARCH (TAG "%s")' % (self.tag,)]
+            if byUid :
+                result.append(b"UID")
+            if numbers :
+                if b"MIN" in options :
+                    result.append(b"MIN %d" % (numbers[0],))
+                if b"MAX" in options :
+                    result.append(b"MAX %d" % (numbers[-1],))
+                if b"ALL" in options :
+                    result.append(b"ALL %d:%d" % (numbers[0], numbers[-1]))
+            if b"COUNT" in options :
+                result.append(b"COUNT %d" % (len(numbers),))
+            untagged.append(b" ".join(result))
+        else :
+            untagged.append(b" ".join([b"* SEARCH"] + [b"%d" % (n,) for n in numbers]))
+        return b"OK SEARCH completed"
+
+    def do_UID_SEARCH(self, args, untagged) :
+        return self.do_SEARCH(args, untagged, byUid = True)
+
+    def do_FETCH(self, args, untagged, byUid = False) :
+        if self.selected is None :
+            return b"BAD no mailbox selected"
+        messages = self.getMessages()
+        if not messages :
+            return b"OK FETCH completed"
+        largest = messages[-1][0] if byUid else len(messages)
+        inSet = parseSequenceSet(args[0], largest)
+        items = args[1]
+        if items.startswith(b"(") :
+            items = items[1:-1]
+        itemList = tokenizeImapArguments(items)
+        if byUid and b"UID" not in [item.upper() for item in itemList] :
+            itemList.insert(0, b"UID")
+        for seq, (uid, message) in enumerate(messages, 1) :
+            if inSet(uid if byUid else seq) :
+                untagged.append(self.formatFetchResponse(seq, uid, message, itemList))
+        return b"OK FETCH completed"
+
+    def do_UID_FETCH(self, args, untagged) :
+        return self.do_FETCH(args, untagged, byUid = True)
+
+    def formatFetchResponse(self, seq, uid, message, itemList) :
+        """
+        @return: a FETCH response, literals included
+        @rtype:  bytes
+        """
+        (header, body) = splitMessage(message)
+        parts = []
+        for item in itemList :
+            name = item.upper()
+            if name == b"UID" :
+                parts.append(b"UID %d" % (uid,))
+            elif name == b"FLAGS" :
+                parts.append(b"FLAGS (\\Seen)")
+            elif name == b"RFC822.SIZE" :
+                parts.append(b"RFC822.SIZE %d" % (len(message),))
+            elif name == b"INTERNALDATE" :
+                parts.append(b'INTERNALDATE "01-Jan-2020 00:00:00 +0000"')
+            else :
+                section = name.replace(b".PEEK", b"")
+                if section in (b"RFC822", b"BODY[]") :
+                    data = message
+                elif section in (b"RFC822.HEADER", b"BODY[HEADER]") :
+                    data = header
+                elif section in (b"RFC822.TEXT", b"BODY[TEXT]") :
+                    data = body
+                elif section.startswith(b"BODY[HEADER.FIELDS") :
+                    m = re.search(br'\(([^)]*)\)', section)
+                    data = selectHeaderFields(header, m.group(1).split() if m else [])
+                else :
+                    raise ValueError("unsupported fetch item %r" % (item,))
+                parts.append(section + b" {%d}\r\n" % (len(data),) + data)
+        return b"* %d FETCH (" % (seq,) + b" ".join(parts) + b")"
+
+
+#---
+#--- POP3
+class Pop3Handler(_BaseHandler) :
+
+    def serve(self) :
+        self.user = None
+        self.messages = None # maildrop snapshot after login
+        self.deleted = set()
+        self.lockedUser = None
+        try :
+            self.serveCommands()
+        finally :
+            if self.lockedUser is not None :
+                self.server.store.unlockMaildrop(self.lockedUser)
+
+    def serveCommands(self) :
+        self.send([b"+OK fake POP3 server ready"])
+        while True :
+            words = self.readLine().split(b" ")
+            name = words[0].decode('ascii', 'replace').upper()
+            self.server.latency.wait(name)
+            method = getattr(self, 'do_' + name, None)
+            if method is None :
+                self.send([b"-ERR unknown command"])
+                continue
+            try :
+                lines = method(words[1:])
+            except (ValueError, IndexError) as e :
+                lines = [b"-ERR " + str(e).encode('utf-8', 'replace')]
+            self.send(lines)
+            if name == 'QUIT' :
+                return
+
+    def getMessage(self, word) :
+        """
+        @raise IndexError: for unknown or deleted messages
+        """
+        number = int(word)
+        if self.messages is None or number < 1 or number in self.deleted :
+            raise IndexError("no such message")
+        return self.messages[number - 1][1]
+
+    def iterMessages(self) :
+        for number, (uid, message) in enumerate(self.messages or [], 1) :
+            if number not in self.deleted :
+                yield (number, uid, message)
+
+    @staticmethod
+    def multiLine(status, lines) :
+        # byte-stuffing (RFC1939, section 3)
+        return [status] + [b"." + line if line.startswith(b".") else line for line in lines] + [b"."]
+
+    def do_CAPA(self, args) :
+        capabilities = [b"USER", b"TOP", b"UIDL", b"RESP-CODES"]
+        return self.multiLine(b"+OK capability list follows", capabilities)
+
+    def do_USER(self, args) :
+        self.user = args[0]
+        return [b"+OK password required"]
+
+    def do_PASS(self, args) :
+        if self.user is None :
+            return [b"-ERR USER first"]
+        if not self.server.isPasswordAccepted(b" ".join(args)) :
+            return [b"-ERR [AUTH] invalid credentials"]
+        if self.server.lockMaildrop and self.lockedUser is None :
+            if not self.server.store.lockMaildrop(self.user) :
+                return [b"-ERR [IN-USE] maildrop already locked"]
+            self.lockedUser = self.user
+        self.messages = self.server.store.getMessages('INBOX')
+        return [b"+OK maildrop has %d messages" % (len(self.messages),)]
+
+    def do_STAT(self, args) :
+        messages = list(self.iterMessages())
+        size = sum(len(message) for (number, uid, message) in messages)
+        return [b"+OK %d %d" % (len(messages), size)]
+
+    def do_LIST(self, args) :
+        if args :
+            return [b"+OK %s %d" % (args[0], len(self.getMessage(args[0])))]
+        return self.multiLine(b"+OK scan listing follows",
+                              [b"%d %d" % (number, len(message))
+                               for (number, uid, message) in self.iterMessages()])
+
+    def do_UIDL(self, args) :
+        if args :
+            self.getMessage(args[0])
+            return [b"+OK %s %d" % (args[0], self.messages[int(args[0]) - 1][0])]
+        return self.multiLine(b"+OK unique-id listing follows",
+                              [b"%d %d" % (number, uid)
+                               for (number, uid, message) in self.iterMessages()])
+
+    def do_RETR(self, args) :
+        message = self.getMessage(args[0])
+        return self.multiLine(b"+OK %d octets" % (len(message),),
+                              message.rstrip(CRLF).split(CRLF))
+
+    def do_TOP(self, args) :
+        (header, body) = splitMessage(self.getMessage(args[0]))
+        bodyLines = body.split(CRLF)[:int(args[1])]
+        return self.multiLine(b"+OK top of message follows",
+                              header.rstrip(CRLF).split(CRLF) + [b""] + bodyLines)
+
+    def do_DELE(self, args) :
+        self.getMessage(args[0])
+        self.deleted.add(int(args[0])) # the shared store is never changed
+        return [b"+OK message deleted"]
+
+    def do_RSET(self, args) :
+        self.deleted = set()
+        return [b"+OK"]
+
+    def do_NOOP(self, args) :
+        return [b"+OK"]
+
+    def do_QUIT(self, args) :
+        return [b"+OK bye"]
+
+
+#---
+#--- SMTP
+class SmtpHandler(_BaseHandler) :
+
+    def serve(self) :
+        self.heloName = b"unknown"
+        self.resetTransaction()
+        self.send([b"220 localhost fake ESMTP server ready"])
+        while True :
+            line = self.readLine()
+            (verb, sep, rest) = line.partition(b" ")
+            name = verb.decode('ascii', 'replace').upper()
+            self.server.latency.wait(name)
+            method = getattr(self, 'do_' + name, None)
+            if method is None :
+                self.send([b"502 5.5.2 command not recognized"])
+                continue
+            method(rest)
+            if name == 'QUIT' :
+                return
+
+    def resetTransaction(self) :
+        self.mailFrom = None
+        self.recipients = []
+
+    def do_EHLO(self, rest) :
+        self.heloName = rest or self.heloName
+        extensions = [b"PIPELINING", b"SIZE 52428800", b"8BITMIME", b"AUTH PLAIN LOGIN"]
+        if not self.isTls and self.server.sslContext is not None :
+            extensions.insert(0, b"STARTTLS")
+        lines = [b"250-localhost"] + [b"250-" + e for e in extensions[:-1]] + [b"250 " + extensions[-1]]
+        self.send(lines)
+
+    def do_HELO(self, rest) :
+        self.heloName = rest or self.heloName
+        self.send([b"250 localhost"])
+
+    def do_STARTTLS(self, rest) :
+        if self.isTls or self.server.sslContext is None :
+            self.send([b"454 4.7.0 TLS not available"])
+            return
+        self.send([b"220 2.0.0 ready to start TLS"])
+        self.startTls()
+        self.resetTransaction()
+
+    def do_AUTH(self, rest) :
+        words = rest.split()
+        mechanism = words[0].upper() if words else b""
+        if mechanism == b"PLAIN" :
+            response = words[1] if len(words) > 1 else self.askFor(b"")
+            fields = base64.b64decode(response).split(b"\0")
+            password = fields[-1]
+        elif mechanism == b"LOGIN" :
+            if len(words) < 2 :
+                self.askFor(b"VXNlcm5hbWU6") # 'Username:'
+            password = base64.b64decode(self.askFor(b"UGFzc3dvcmQ6")) # 'Password:'
+        else :
+            self.send([b"504 5.5.4 unrecognized authentication type"])
+            return
+        if self.server.isPasswordAccepted(password) :
+            self.send([b"235 2.7.0 authentication successful"])
+        else :
+            self.send([b"535 5.7.8 authentication credentials invalid"])
+
+    def askFor(self, challenge) :
+        self.send([b"334 " + challenge])
+        return self.readLine()
+
+    def do_MAIL(self, rest) :
+        self.mailFrom = rest
+        self.recipients = []
+        self.send([b"250 2.1.0 ok"])
+
+    def do_RCPT(self, rest) :
+        if self.mailFrom is None :
+            self.send([b"503 5.5.1 MAIL first"])
+            return
+        self.recipients.append(rest)
+        self.send([b"250 2.1.5 ok"])
+
+    def do_DATA(self, rest) :
+        if not self.recipients :
+            self.send([b"503 5.5.1 RCPT first"])
+            return
+        self.send([b"354 end data with <CR><LF>.<CR><LF>"])
+        lines = []
+        while True :
+            line = self.readLine()
+            if line == b"." :
+                break
+            lines.append(line[1:] if line.startswith(b"..") else line)
+        dateString = email.utils.formatdate(localtime = True)
+        received = ("Received: from %s (localhost [127.0.0.1]) by fake-smtp with ESMTPSA; %s"
+                    % (self.heloName.decode('ascii', 'replace'), dateString))
+        header = [received.encode('ascii')]
+        headerNames = set(line.split(b":", 1)[0].upper() for line in lines[:lines.index(b"")]) \
+                      if b"" in lines else set()
+        if b"DATE" not in headerNames :
+            header.append(b"Date: " + dateString.encode('ascii')) # as added by submission MTAs
+        message = b"".join(line + CRLF for line in header + lines)
+        self.deliver(message)
+        self.resetTransaction()
+        self.send([b"250 2.0.0 ok: queued"])
+
+    def deliver(self, message) :
+        store = self.server.store
+        if self.server.deliveryDelay > 0 :
+            timer = threading.Timer(self.server.deliveryDelay, store.append, args = ('INBOX', message))
+            timer.daemon = True
+            timer.start()
+        else :
+            store.append('INBOX', message)
+
+    def do_RSET(self, rest) :
+        self.resetTransaction()
+        self.send([b"250 2.0.0 ok"])
+
+    def do_NOOP(self, rest) :
+        self.send([b"250 2.0.0 ok"])
+
+    def do_QUIT(self, rest) :
+        self.send([b"221 2.0.0 bye"])
+
+
+#---
+class FakeServerSuite(object) :
+    """
+    Starts the servers 'imap', 'imaps', 'pop3', 'pop3s' and 'smtp' (with
+    STARTTLS) in background threads.
+    """
+
+    def __init__(self, **keywords) :
+        """
+        @keyword host: default is L{DEFAULT_HOST}
+        @type    host: str
+
+        @keyword ports: server name mapped to port; 0 (the default)
+            picks a free port
+        @type    ports: dict
+
+        @keyword store: default is a new L{MailStore}
+        @type    store: L{MailStore}
+
+        @keyword certFile, keyFile: default is a new self signed
+            certificate (see L{createSelfSignedCertificate})
+        @type    certFile, keyFile: str
+
+        All other keywords (latency, password, deliveryDelay,
+        capabilities, lockMaildrop) are passed to L{FakeServer}.
+        """
+        self.host = keywords.pop('host', DEFAULT_HOST)
+        self.ports = keywords.pop('ports', None) or {}
+        self.store = keywords.pop('store', None) or MailStore()
+        certFile = keywords.pop('certFile', None)
+        keyFile = keywords.pop('keyFile', None)
+        if certFile is None :
+            (certFile, keyFile) = createSelfSignedCertificate(tempfile.mkdtemp())
+        self.sslContext = createServerSSLContext(certFile, keyFile)
+        self.serverKeywords = keywords
+        self.servers = {}
+
+    def start(self) :
+        handlers = {
+            'imap' : (ImapHandler, False),
+            'imaps' : (ImapHandler, True),
+            'pop3' : (Pop3Handler, False),
+            'pop3s' : (Pop3Handler, True),
+            'smtp' : (SmtpHandler, False),
+        }
+        for name in SERVER_NAMES :
+            (handlerClass, implicitTls) = handlers[name]
+            server = FakeServer((self.host, self.ports.get(name, 0)), handlerClass, self.store,
+                                sslContext = self.sslContext,
+                                implicitTls = implicitTls,
+                                **self.serverKeywords)
+            thread = threading.Thread(target = server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers[name] = server
+
+    def stop(self) :
+        for server in self.servers.values() :
+            server.shutdown()
+            server.server_close()
+        self.servers = {}
+
+    def getPort(self, name) :
+        return self.servers[name].server_address[1]
+
+    def getEnvironment(self, **keywords) :
+        """
+        Environment variables for the plugins (with SSL, as they use it
+        by default).
+
+        @keyword user: default is 'monitor'
+        @type    user: str
+
+        @keyword password: default is 'secret'
+        @type    password: str
+
+        @rtype: dict
+        """
+        user = keywords.get('user', 'monitor')
+        password = keywords.get('password', 'secret')
+        host = 'localhost'
+        address = '%s@example.org' % (user,)
+        return {
+            'IMAP_HOST' : host,
+            'IMAP_PORT' : str(self.getPort('imaps')),
+            'POP3_HOST' : host,
+            'POP3_PORT' : str(self.getPort('pop3s')),
+            'SMTP_HOST' : host,
+            'SMTP_PORT' : str(self.getPort('smtp')),
+            'RECEIVING_USERNAME' : user,
+            'RECEIVING_PASSWORD' : password,
+            'RECEIVING_ADDRESS' : address,
+            'SENDING_USERNAME' : user,
+            'SENDING_PASSWORD' : password,
+            'SENDING_ADDRESS' : address,
+        }
+
+
+#---
+def addServerOptions(parser) :
+    """
+    Options shared by fake_servers.py and benchmark.py.
+
+    @type parser: optparse.OptionParser
+    """
+    parser.add_option("--message-count",
+                      dest = "message_count",
+                      help = "Number of generated messages in the INBOX (default: %default).",
+                      action = "store",
+                      type = "int",
+                      default = DEFAULT_MESSAGE_COUNT,
+    )
+    parser.add_option("--message-size",
+                      dest = "message_size",
+                      help = "Size of the generated messages in bytes (default: %default).",
+                      action = "store",
+                      type = "int",
+                      default = DEFAULT_MESSAGE_SIZE,
+    )
+    parser.add_option("--latency",
+                      dest = "latency",
+                      help = "Delay every answer by SECONDS (default: %default).",
+                      action = "store",
+                      type = "float",
+                      metavar = "SECONDS",
+                      default = 0.0,
+    )
+    parser.add_option("--command-latency",
+                      dest = "command_latencies",
+                      help = "Delay the answer of a single command, e.g. 'LOGIN=0.05' or 'UID FETCH=0.01'. May be given several times.",
+                      action = "append",
+                      metavar = "COMMAND=SECONDS",
+                      default = [],
+    )
+    parser.add_option("--delivery-delay",
+                      dest = "delivery_delay",
+                      help = "Mails submitted via SMTP show up in the INBOX after SECONDS (default: %default).",
+                      action = "store",
+                      type = "float",
+                      metavar = "SECONDS",
+                      default = 0.0,
+    )
+    parser.add_option("--password",
+                      dest = "password",
+                      help = "Accept only this password (default: any).",
+                      action = "store",
+                      type = "string",
+                      default = None,
+    )
+    parser.add_option("--capabilities",
+                      dest = "capabilities",
+                      help = "IMAP capabilities, e.g. 'IMAP4rev1' to test the fallbacks for servers without ESEARCH and LIST-STATUS (default: '%s')." % (" ".join(IMAP_CAPABILITIES),),
+                      action = "store",
+                      type = "string",
+                      default = None,
+    )
+    parser.add_option("--lock-maildrop",
+                      dest = "lock_maildrop",
+                      help = "Refuse a second POP3 login of a user while a session of the user is open, like most POP3 servers do.",
+                      action = "store_true",
+                      default = False,
+    )
+    parser.add_option("--certfile",
+                      dest = "cert_file",
+                      help = "Certificate for TLS; default is a new self signed one (needs the 'openssl' command).",
+                      action = "store",
+                      type = "string",
+                      metavar = "FILE",
+                      default = None,
+    )
+    parser.add_option("--keyfile",
+                      dest = "key_file",
+                      help = "Private key belonging to '--certfile'.",
+                      action = "store",
+                      type = "string",
+                      metavar = "FILE",
+                      default = None,
+    )
+
+
+def createSuite(options, **keywords) :
+    """
+    @param options: parsed options (see L{addServerOptions})
+
+    @keyword ports: server name mapped to port
+    @type    ports: dict
+
+    @raise ValueError: on malformed options
+
+    @rtype: L{FakeServerSuite}
+    """
+    latency = Latency(options.latency, parseCommandLatencies(options.command_latencies))
+    store = MailStore(messageCount = options.message_count,
+                      messageSize = options.message_size)
+    capabilities = options.capabilities.split() if options.capabilities else None
+    return FakeServerSuite(ports = keywords.get('ports', None),
+                           store = store,
+                           certFile = options.cert_file,
+                           keyFile = options.key_file,
+                           latency = latency,
+                           password = options.password,
+                           deliveryDelay = options.delivery_delay,
+                           capabilities = capabilities,
+                           lockMaildrop = options.lock_maildrop)
+
+
+def createParser() :
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage = usage)
+    parser.add_option("--host",
+                      dest = "host",
+                      help = "Listen on HOST (default: %default).",
+                      action = "store",
+                      type = "string",
+                      default = DEFAULT_HOST,
+    )
+    for (name, defaultPort) in zip(SERVER_NAMES, [10143, 10993, 10110, 10995, 10025]) :
+        parser.add_option("--%s-port" % (name,),
+                          dest = "%s_port" % (name,),
+                          help = "Port of the %s server (default: %%default, 0 = any free port)." % (name.upper(),),
+                          action = "store",
+                          type = "int",
+                          default = defaultPort,
+        )
+    addServerOptions(parser)
+    return parser
+
+
+def main():
+    parser = createParser()
+    (options, args) = parser.parse_args()
+
+    ports = dict((name, getattr(options, '%s_port' % (name,))) for name in SERVER_NAMES)
+    try :
+        suite = createSuite(options, ports = ports)
+    except ValueError as E :
+        print(E)
+        parser.print_help()
+        return 2
+    suite.host = options.host
+    suite.start()
+
+    for name in SERVER_NAMES :
+        print("%-5s listening on %s:%d" % (name, options.host, suite.getPort(name)))
+    print()
+    print("# environment for the plugins")
+    for (name, value) in sorted(suite.getEnvironment().items()) :
+        print("export %s=%s" % (name, value))
+    sys.stdout.flush()
+
+    try :
+        while True :
+            time.sleep(3600)
+    except KeyboardInterrupt :
+        suite.stop()
+    return 0
+
+if __name__ == "__main__":
+    retCode = main()
+    sys.exit(retCode)
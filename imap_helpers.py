@@ -1,36 +1,483 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-from builtins import map
 
 #---
 #--- Python
 import email
 import email.header
+import imaplib
 import mail_helpers
+import re
+import socket
+import ssl
+import time
 
 #---
+#--- Plugin Stuff
+import net_helpers
+import timing_helpers
+
+#---
+_ESEARCH_MAX_RE = re.compile(br'\bMAX (?P<uid>\d+)', re.IGNORECASE)
+_FETCH_UID_RE = re.compile(br'\bUID (?P<uid>\d+)', re.IGNORECASE)
+_EXISTS_RE = re.compile(br'^\* \d+ EXISTS', re.IGNORECASE)
+_STATUS_RE = re.compile(r'^(?P<name>"(?:[^"\\]|\\.)*"|\S+) \((?P<items>[^)]*)\)')
+_LITERAL_SIZE_RE = re.compile(r'\{\d+\}$')
+
+#: items requested by STATUS / LIST-STATUS
+STATUS_ITEMS = ['MESSAGES', 'UNSEEN', 'UIDNEXT']
+
+#---
+class ImapPipeline(object) :
+    """
+    Sends several tagged commands with a single write before reading the
+    first response, then matches the tagged responses to the commands.
+    N commands cost about one round trip instead of N. Works with every
+    imaplib.IMAP4 connection.
+
+    Commands with literals (APPEND, AUTHENTICATE) and commands that
+    depend on the state change of a previous command (e.g. FETCH after
+    SELECT) cannot be pipelined.
+
+    A scripted connection shows that the commands leave in one write and
+    every command gets its own tagged response:
+
+        >>> class ScriptedIMAP4(imaplib.IMAP4) :
+        ...     def open(self, *args, **keywords) :
+        ...         self.writes = []
+        ...         self.answers = [b"* OK [CAPABILITY IMAP4rev1] ready\\r\\n"]
+        ...     def send(self, data) :
+        ...         self.writes.append(data)
+        ...         for line in data.splitlines() :
+        ...             (tag, name) = line.split()[:2]
+        ...             status = b"NO" if name == b"LOGIN" else b"OK"
+        ...             self.answers.append(tag + b" " + status + b" " + name + b"\\r\\n")
+        ...     def readline(self) :
+        ...         return self.answers.pop(0)
+        >>> conn = ScriptedIMAP4('localhost')
+        >>> pipeline = ImapPipeline(conn)
+        >>> pipeline.add('NOOP')
+        >>> pipeline.add('CAPABILITY')
+        >>> pipeline.add('LOGIN', 'monitor', '"secret"')
+        >>> writesBefore = len(conn.writes)
+        >>> [typ for (typ, data) in pipeline.run()]
+        ['OK', 'OK', 'NO']
+        >>> len(conn.writes) - writesBefore
+        1
+        >>> for line in conn.writes[-1].splitlines() :
+        ...     print(line.decode('ascii').split(' ', 1)[1])
+        NOOP
+        CAPABILITY
+        LOGIN monitor "secret"
+    """
+
+    def __init__(self, conn, **keywords) :
+        """
+        @keyword timer: if given, the phase of a command is marked as soon
+            as its tagged response has been read
+        @type    timer: L{timing_helpers.PhaseTimer}
+        """
+        self.conn = conn
+        self.timer = keywords.get('timer', None)
+        self._commands = []
+
+    def add(self, name, *args, **keywords) :
+        """
+        @keyword phase: name of the phase recorded by the timer
+        @type    phase: str
+        """
+        self._commands.append((name, args, keywords.get('phase', None)))
+
+    def run(self) :
+        """
+        @return: (typ, data) of the tagged response for every command in
+            the order they were added; untagged responses are collected
+            in conn.untagged_responses (see imaplib.IMAP4.response)
+        @rtype:  [(str, list)]
+        """
+        conn = self.conn
+        commands = self._commands
+        self._commands = []
+
+        sendBuffer = []
+        conn.send = sendBuffer.append # collect instead of sending
+        try :
+            tags = [conn._command(name, *args) for (name, args, phase) in commands]
+        finally :
+            del conn.send
+        conn.send(b"".join(sendBuffer))
+
+        results = []
+        for (name, args, phase), tag in zip(commands, tags) :
+            try :
+                results.append(conn._command_complete(name, tag))
+            except conn.error as e :
+                results.append(('BAD', [str(e)]))
+            if phase is not None and self.timer is not None :
+                self.timer.mark(phase)
+        return results
+
+
+class TimedIMAP4(imaplib.IMAP4) :
+    """
+    IMAP4 connection (with or without SSL) that records the phases
+    'resolve', 'connect', 'tls', 'greeting', 'capability' and 'login'
+    in a L{timing_helpers.PhaseTimer}.
+    """
+
+    def __init__(self, host, **keywords) :
+        """
+        @keyword use_ssl: default is True
+        @type    use_ssl: bool
+
+        @keyword port: default is 993 with SSL or 143 without
+        @type    port: int
+
+        @keyword timer: default is a new L{timing_helpers.PhaseTimer}
+        @type    timer: L{timing_helpers.PhaseTimer}
+
+        @keyword login: (user, password) -- if given, LOGIN is pipelined
+            with the initial CAPABILITY, so both take a single round trip.
+            L{login} has to be called anyway, it reports the result. The
+            'login' phase then only contains the time the server needed.
+        @type    login: (str, str)
+
+        @keyword timeout: socket timeout in seconds; default is
+            socket.getdefaulttimeout()
+        @type    timeout: float
+
+        @keyword sessionCache: resume TLS sessions of former connections
+            (default is L{net_helpers.SESSION_CACHE}, None disables it);
+            self.tlsResumed tells if the handshake was abbreviated
+        @type    sessionCache: L{net_helpers.TLSSessionCache}
+
+        @keyword resolver: default is L{net_helpers.RESOLVER_CACHE}
+        @type    resolver: L{net_helpers.ResolverCache}
+
+        @keyword address: connect to this IP address of host, e.g. one
+            backend of a round-robin name (see
+            L{net_helpers.createTimedConnection})
+        @type    address: str
+        """
+        self.use_ssl = keywords.get('use_ssl', True)
+        self.timer = keywords.get('timer', None) or timing_helpers.PhaseTimer()
+        self._greetingPending = True
+        self._pipelinedLogin = keywords.get('login', None)
+        self._pipelinedLoginResult = None
+        self._timeout = keywords.get('timeout', None)
+        self._sessionCache = keywords.get('sessionCache', net_helpers.SESSION_CACHE)
+        self._resolver = keywords.get('resolver', net_helpers.RESOLVER_CACHE)
+        self.address = keywords.get('address', None)
+        self.tlsResumed = None
+        defaultPort = imaplib.IMAP4_SSL_PORT if self.use_ssl else imaplib.IMAP4_PORT
+        port = keywords.get('port', None) or defaultPort
+        imaplib.IMAP4.__init__(self, host, port)
+        if self._pipelinedLoginResult is None :
+            self.timer.mark('capability')
+
+    def capability(self) :
+        if self._pipelinedLogin is None :
+            return imaplib.IMAP4.capability(self)
+
+        (user, password) = self._pipelinedLogin
+        self._pipelinedLogin = None
+        pipeline = ImapPipeline(self, timer = self.timer)
+        pipeline.add('CAPABILITY', phase = 'capability')
+        pipeline.add('LOGIN', user, self._quote(password), phase = 'login')
+        ((capTyp, capData), self._pipelinedLoginResult) = pipeline.run()
+        return self._untagged_response(capTyp, capData, 'CAPABILITY')
+
+    def login(self, user, password) :
+        if self._pipelinedLoginResult is None :
+            self.timer.skip()
+            result = imaplib.IMAP4.login(self, user, password)
+            self.timer.mark('login')
+            return result
+
+        (typ, dat) = self._pipelinedLoginResult
+        self._pipelinedLoginResult = None
+        if typ != 'OK' :
+            raise self.error(dat[-1])
+        self.state = 'AUTH'
+        return (typ, dat)
+
+    def open(self, host = '', port = imaplib.IMAP4_PORT, timeout = None) :
+        self.host = host
+        self.port = port
+        self.sock = net_helpers.createTimedConnection(host, port,
+                                                      timer = self.timer,
+                                                      use_ssl = self.use_ssl,
+                                                      timeout = timeout or self._timeout,
+                                                      sessionCache = self._sessionCache,
+                                                      resolver = self._resolver,
+                                                      address = self.address)
+        self.tlsResumed = net_helpers.isSessionReused(self.sock)
+        self.file = self.sock.makefile('rb')
+
+    def _get_response(self) :
+        resp = imaplib.IMAP4._get_response(self)
+        if self._greetingPending :
+            self._greetingPending = False
+            self.timer.mark('greeting')
+            if self.use_ssl and self._sessionCache is not None :
+                self._sessionCache.remember(self.address or self.host, self.port, self.sock)
+        return resp
+
+
+class ImapSession(object) :
+    """
+    Authenticated connection that is kept open between probes of a
+    long-lived process. A NOOP keeps the session alive and its round trip
+    time is a cheap liveness latency; connect and login only have to be
+    measured (and paid for by the authentication backend) now and then.
+    """
+
+    def __init__(self, host, user, password, **keywords) :
+        """
+        @keyword use_ssl: default is True
+        @type    use_ssl: bool
+
+        @keyword port: default is 993 with SSL or 143 without
+        @type    port: int
+
+        @keyword timeout: socket timeout in seconds
+        @type    timeout: float
+        """
+        self.host = host
+        self.user = user
+        self.password = password
+        self.keywords = keywords
+        self.conn = None
+        self.timer = None
+
+    def isOpen(self) :
+        return self.conn is not None
+
+    def connect(self) :
+        """
+        Opens a new connection; an open session is closed before.
+
+        @return: the phases up to 'capability'
+        @rtype:  L{timing_helpers.PhaseTimer}
+        """
+        self.close()
+        self.timer = timing_helpers.PhaseTimer()
+        self.conn = TimedIMAP4(self.host, timer = self.timer, **self.keywords)
+        return self.timer
+
+    def login(self) :
+        """
+        @raise imaplib.IMAP4.error: the session is closed then
+
+        @return: duration of LOGIN in milliseconds
+        @rtype:  float
+        """
+        try :
+            self.conn.login(self.user, self.password)
+        except Exception :
+            self.close()
+            raise
+        return self.timer.GetDuration('login')
+
+    def noop(self) :
+        """
+        @raise Exception: if the session is dead, it is closed then
+
+        @return: round trip time of NOOP in milliseconds
+        @rtype:  float
+        """
+        timer = timing_helpers.PhaseTimer()
+        try :
+            (typ, data) = self.conn.noop()
+            if typ != 'OK' :
+                raise self.conn.error("NOOP failed: %s" % (data,))
+        except Exception :
+            try :
+                self.conn.shutdown()
+            except Exception :
+                pass
+            self.conn = None
+            raise
+        return timer.mark('noop')
+
+    def close(self) :
+        if self.conn is None :
+            return
+        try :
+            self.conn.logout()
+        except Exception :
+            pass
+        self.conn = None
+
+
 def iterMailboxNames(conn) :
     """
     @param conn: The IMAP4-Connection
     @type  conn: imaplib.IMAP4 | imaplib.IMAP4_SSL
     """
     (listCode, listResult) = conn.list() # Unterschied zu IMAP4.lsub ?
-    for mbString in listResult :
-        if mbString is None :
+    for mbString in joinLiterals(listResult) :
+        yield parseListLine(mbString)
+
+
+def joinLiterals(data) :
+    """
+    imaplib returns a response line with a literal (e.g. a mailbox name
+    with special characters) as (line up to the literal, literal)
+    followed by the rest of the line. This joins them into one line with
+    the literal as a quoted string.
+
+        >>> joinLiterals([b'"INBOX" (MESSAGES 1)', (b'{6}', b'a "b"c'), b' (MESSAGES 2)', None])
+        ['"INBOX" (MESSAGES 1)', '"a \\\\"b\\\\"c" (MESSAGES 2)']
+
+    @param data: untagged responses as returned by imaplib
+    @type  data: list
+
+    @rtype: [str]
+    """
+    lines = []
+    pending = None
+    for item in data :
+        if item is None :
+            continue
+        if isinstance(item, tuple) :
+            (head, literal) = [part if isinstance(part, str) else part.decode('utf-8') for part in item]
+            pending = (pending or '') + _LITERAL_SIZE_RE.sub('', head) + quoteMailboxName(literal)
             continue
-        mbParts = mbString.split('"/"')
-        mbNameWithQuotes = mbParts[-1].strip()
-        firstPartStripped = mbParts[0].strip()
-        firstPart = firstPartStripped[1:-1]
-        markers = list(m.lower().strip() for m in firstPart.split(' '))
-        isQuoted = mbNameWithQuotes.startswith('"') or mbNameWithQuotes.startswith("'")
-        if isQuoted :
-            mbName = mbNameWithQuotes[1:-1]
-        else :
-            mbName = mbNameWithQuotes
-        yield mbName, markers
-        continue
+        if not isinstance(item, str) :
+            item = item.decode('utf-8')
+        if pending is not None :
+            (item, pending) = (pending + item, None)
+        lines.append(item)
+    if pending is not None :
+        lines.append(pending)
+    return lines
+
+
+def parseListLine(mbString) :
+    """
+    @param mbString: data of an untagged LIST response,
+        e.g. '(\\HasNoChildren) "/" "INBOX"'
+    @type  mbString: bytes | str
+
+    @return: (mbName, markers)
+    @rtype:  (str, [str])
+
+        >>> parseListLine('(\\\\HasNoChildren) "/" "a \\\\"b\\\\"c"')
+        ('a "b"c', ['\\\\hasnochildren'])
+    """
+    if not isinstance(mbString, str) :
+        mbString = mbString.decode('utf-8')
+    mbParts = mbString.split('"/"')
+    mbNameWithQuotes = mbParts[-1].strip()
+    firstPartStripped = mbParts[0].strip()
+    firstPart = firstPartStripped[1:-1]
+    markers = list(m.lower().strip() for m in firstPart.split(' '))
+    isQuoted = mbNameWithQuotes.startswith('"') or mbNameWithQuotes.startswith("'")
+    if isQuoted :
+        mbName = mbNameWithQuotes[1:-1]
+    else :
+        mbName = mbNameWithQuotes
+    if mbNameWithQuotes.startswith('"') :
+        # same name as in the STATUS responses (see parseStatusLine)
+        mbName = mbName.replace('\\"', '"').replace('\\\\', '\\')
+    return (mbName, markers)
+
+
+def quoteMailboxName(mbName) :
+    """
+    @rtype: str
+    """
+    return '"%s"' % (mbName.replace('\\', '\\\\').replace('"', '\\"'),)
+
+
+def parseStatusLine(statusString) :
+    """
+    @param statusString: data of an untagged STATUS response,
+        e.g. '"INBOX" (MESSAGES 3 UNSEEN 0 UIDNEXT 4)'
+    @type  statusString: bytes | str
+
+    @return: (mbName, {'MESSAGES' : 3, 'UNSEEN' : 0, 'UIDNEXT' : 4})
+        or None if the response cannot be parsed
+    @rtype:  (str, dict)
+
+        >>> name, status = parseStatusLine(b'"Sent \\\\"old\\\\"" (MESSAGES 3 UNSEEN 0 UIDNEXT 4)')
+        >>> name, sorted(status.items())
+        ('Sent "old"', [('MESSAGES', 3), ('UIDNEXT', 4), ('UNSEEN', 0)])
+        >>> parseStatusLine('INBOX (messages 1)')
+        ('INBOX', {'MESSAGES': 1})
+        >>> parseStatusLine('(MESSAGES 2)') is None # the name was a literal
+        True
+    """
+    if not isinstance(statusString, str) :
+        statusString = statusString.decode('utf-8')
+    m = _STATUS_RE.match(statusString.strip())
+    if m is None :
+        return None
+    mbName = m.group('name')
+    if mbName.startswith('"') :
+        mbName = mbName[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+    itemParts = m.group('items').split()
+    status = dict((k.upper(), int(v)) for (k, v) in zip(itemParts[0::2], itemParts[1::2]))
+    return (mbName, status)
+
+
+def iterMailboxesWithStatus(conn) :
+    """
+    Lists all mailboxes together with their L{STATUS_ITEMS} without
+    selecting them. Uses 'LIST ... RETURN (STATUS (...))' (RFC5819) if the
+    server supports LIST-STATUS, otherwise LIST and pipelined STATUS
+    commands.
+
+    Mailbox names may come as quoted strings or as literals:
+
+        >>> class ListStatusConn(object) :
+        ...     capabilities = ('IMAP4REV1', 'LIST-STATUS')
+        ...     responses = {
+        ...         'LIST' : [b'(\\\\HasNoChildren) "/" INBOX',
+        ...                   (b'(\\\\HasNoChildren) "/" {6}', b'a "b"c'), b'',
+        ...                   b'(\\\\Noselect) "/" "Archiv"'],
+        ...         'STATUS' : [b'"INBOX" (MESSAGES 2 UNSEEN 1 UIDNEXT 3)',
+        ...                     (b'{6}', b'a "b"c'), b' (MESSAGES 0 UNSEEN 0 UIDNEXT 1)'],
+        ...     }
+        ...     def _simple_command(self, *args) :
+        ...         return ('OK', [None])
+        ...     def response(self, code) :
+        ...         return ('OK', self.responses[code])
+        >>> for (mbName, markers, status) in iterMailboxesWithStatus(ListStatusConn()) :
+        ...     print(mbName, status and status['MESSAGES'])
+        INBOX 2
+        a "b"c 0
+        Archiv None
+
+    @return: generator[(mbName, markers, status)] -- status is None for
+        mailboxes that cannot be selected
+    """
+    statusItems = "(%s)" % (" ".join(STATUS_ITEMS),)
+    if 'LIST-STATUS' in conn.capabilities :
+        (typ, data) = conn._simple_command('LIST', '""', '*',
+                                           'RETURN', '(STATUS %s)' % (statusItems,))
+        (listCode, listResult) = conn.response('LIST')
+        mailboxes = [parseListLine(mbString) for mbString in joinLiterals(listResult)]
+    else :
+        mailboxes = list(iterMailboxNames(conn))
+        selectable = [mbName for (mbName, markers) in mailboxes
+                      if '\\noselect' not in markers]
+        pipeline = ImapPipeline(conn)
+        for mbName in selectable :
+            pipeline.add('STATUS', quoteMailboxName(mbName), statusItems)
+        pipeline.run()
+
+    (statusCode, statusResult) = conn.response('STATUS')
+    statusMap = {}
+    for statusString in joinLiterals(statusResult) :
+        parsed = parseStatusLine(statusString)
+        if parsed is not None :
+            statusMap[parsed[0]] = parsed[1]
+
+    for (mbName, markers) in mailboxes :
+        yield (mbName, markers, statusMap.get(mbName, None))
 
 
 
@@ -51,6 +498,38 @@ def decodeMailboxName(mbNameEncoded) :
         mbName = mbName.replace(fromString, toString)
     return mbName # .decode('utf-8')
 
+def getFetchItems(**keywords) :
+    """
+    @keyword headerFields: If given only these header fields are fetched
+        (e.g. ['DATE', 'SUBJECT']) instead of the whole message. BODY.PEEK
+        does not set the \\Seen flag.
+    @type    headerFields: [str]
+
+    @rtype: str
+    """
+    headerFields = keywords.get('headerFields', None)
+    if headerFields :
+        return u'(BODY.PEEK[HEADER.FIELDS (%s)])' % (u" ".join(headerFields),)
+    return u'(RFC822)'
+
+
+def parseFetchedMail(rawMail, **keywords) :
+    """
+    @param rawMail: the literal of a FETCH response
+        (see L{getFetchItems})
+
+    @keyword headerFields: see L{getFetchItems}
+    @type    headerFields: [str]
+
+    @rtype: email.message.Message
+    """
+    if keywords.get('headerFields', None) :
+        return mail_helpers.parseHeaderBlock(rawMail)
+    if not isinstance(rawMail, str) :
+        rawMail = rawMail.decode('utf-8')
+    return email.message_from_string(rawMail)
+
+
 def iterMailboxContent(conn, mbName, **keywords) :
     """
     @keyword uniqueIdentifier: If True (default) use UID instead of sequentialID
@@ -58,6 +537,10 @@ def iterMailboxContent(conn, mbName, **keywords) :
 
     @keyword newestFirst: If True sort from newest to oldest. Default is False
     @type    newestFirst: bool
+
+    @keyword headerFields: If given only these header fields are fetched
+        and parsed (see L{getFetchItems})
+    @type    headerFields: [str]
     """
     useUID = keywords.get('uniqueIdentifier', True)
     f = iterMailboxContent_uniqueID if useUID else iterMailboxContent_sequentialID
@@ -70,6 +553,9 @@ def iterMailboxContent_sequentialID(conn, mbName, **keywords) :
     @keyword newestFirst: If True sort from newest to oldest. Default is False
     @type    newestFirst: bool
 
+    @keyword headerFields: see L{getFetchItems}
+    @type    headerFields: [str]
+
     @precondition: Mailbox must be SELECTED
     @return: generator[(id, rawMail)]
     """
@@ -86,41 +572,364 @@ def iterMailboxContent_sequentialID(conn, mbName, **keywords) :
         sidIterator = sid_list
 
     for sid in sidIterator :
-        mailResult, mailData = conn.fetch(sid, "(RFC822)") # feth the body
+        mailResult, mailData = conn.fetch(sid, getFetchItems(**keywords)) # feth the body
         rawMail = mailData[0][1]
-        emailObj = email.message_from_string(rawMail)
+        emailObj = parseFetchedMail(rawMail, **keywords)
         yield ("sid.%s" % (sid,), emailObj)
         break
 
 
 
+def getNewestUID(conn) :
+    """
+    Finds the UID of the newest message without transferring the UIDs of
+    all messages: 'UID SEARCH RETURN (MAX) ALL' if the server supports
+    ESEARCH (RFC4731), otherwise 'FETCH * (UID)'.
+
+    @precondition: Mailbox must be SELECTED
+    @return: None for an empty mailbox
+    @rtype:  bytes
+    """
+    if 'ESEARCH' in conn.capabilities :
+        conn.uid(u'search', u'RETURN', u'(MAX)', u'ALL')
+        (typ, esearchData) = conn.response('ESEARCH')
+        for line in esearchData :
+            m = _ESEARCH_MAX_RE.search(line or b'')
+            if m :
+                return m.group('uid')
+        return None
+
+    try :
+        (fetchResult, fetchData) = conn.fetch(u'*', u'(UID)')
+    except conn.error :
+        return None # no message with sequence number '*'
+    for line in fetchData :
+        m = _FETCH_UID_RE.search(line or b'')
+        if m :
+            return m.group('uid')
+    return None
+
+
+def uidFetchMany(conn, uids, fetchItems) :
+    """
+    Fetches several messages with a single 'UID FETCH uid1,uid2,...'.
+
+    @param uids: e.g. [b'3', b'17']
+    @type  uids: [bytes | str]
+
+    @param fetchItems: e.g. the result of L{getFetchItems}
+    @type  fetchItems: str
+
+    @return: uid (as in C{uids}) mapped to the literal of its response
+    @rtype:  dict
+    """
+    if not uids :
+        return {}
+    uidStrings = dict((u if isinstance(u, str) else u.decode('ascii'), u) for u in uids)
+    (fetchResult, fetchData) = conn.uid(u'fetch', u",".join(uidStrings), fetchItems)
+    literals = parseUidFetchData(fetchData)
+    return dict((uidStrings[uid], literal) for (uid, literal) in literals.items()
+                if uid in uidStrings)
+
+
+def parseUidFetchData(fetchData) :
+    """
+    @param fetchData: FETCH responses that contain the UID and one literal
+
+    @return: uid (as str) mapped to the literal of its response
+    @rtype:  dict
+    """
+    result = {}
+    for item in fetchData :
+        if not isinstance(item, tuple) :
+            continue
+        m = _FETCH_UID_RE.search(item[0])
+        if m is None :
+            continue
+        uid = m.group('uid')
+        if not isinstance(uid, str) :
+            uid = uid.decode('ascii')
+        result[uid] = item[1]
+    return result
+
+
+def getUidNext(conn, mailbox = 'INBOX') :
+    """
+    Selects the mailbox read-only.
+
+    @return: the UID the next message delivered to the mailbox will get,
+        None if the server does not tell
+    @rtype:  int
+    """
+    conn.select(mailbox, readonly = True)
+    (typ, data) = conn.response('UIDNEXT')
+    if not data or data[0] is None :
+        return None
+    return int(data[-1])
+
+
+def fetchNewHeaders(conn, uidNext, headerNames) :
+    """
+    Looks for messages that arrived since uidNext was read, in a single
+    round trip: NOOP (the server reports new messages) pipelined with
+    'UID FETCH uidNext:*' of the header fields.
+
+    @precondition: Mailbox must be SELECTED
+
+    @param headerNames: e.g. ['SUBJECT', 'MESSAGE-ID']
+    @type  headerNames: [str]
+
+    @return: uid (as int) mapped to the parsed header fields
+    @rtype:  dict of email.message.Message
+    """
+    pipeline = ImapPipeline(conn)
+    pipeline.add('NOOP')
+    pipeline.add('UID', 'FETCH', '%d:*' % (uidNext,),
+                 '(BODY.PEEK[HEADER.FIELDS (%s)])' % (" ".join(headerNames),))
+    ((noopTyp, noopData), (fetchTyp, fetchData)) = pipeline.run()
+    if fetchTyp != 'OK' :
+        raise conn.error(fetchData[-1])
+    (typ, fetchData) = conn.response('FETCH')
+    headers = {}
+    for (uid, literal) in parseUidFetchData(fetchData).items() :
+        # 'n:*' always contains the last message, even if it is older
+        if int(uid) >= uidNext :
+            headers[int(uid)] = mail_helpers.parseHeaderBlock(literal)
+    return headers
+
+
+def fetchNewHeaderValues(conn, uidNext, headerName) :
+    """
+    Like L{fetchNewHeaders} for a single header field.
+
+    @precondition: Mailbox must be SELECTED
+
+    @return: uid (as int) mapped to the value of the header field (None
+        if the message does not have it)
+    @rtype:  dict
+    """
+    return dict((uid, header[headerName])
+                for (uid, header) in fetchNewHeaders(conn, uidNext, [headerName]).items())
+
+
+class MailboxWatcher(object) :
+    """
+    Waits for changes of the selected mailbox. With IDLE (RFC2177) the
+    server pushes EXISTS as soon as a message arrives and its arrival is
+    timestamped right away. Servers without IDLE are polled (see
+    L{fetchNewHeaderValues}); the interval starts short and doubles after
+    every poll, so early arrivals are seen quickly and long waits cost
+    few round trips.
+    """
+
+    def __init__(self, conn, **keywords) :
+        """
+        @keyword useIdle: default is True if the server advertises IDLE
+        @type    useIdle: bool
+
+        @keyword minPollInterval: first poll interval in seconds
+            (default is 0.02)
+        @type    minPollInterval: float
+
+        @keyword maxPollInterval: upper bound of the poll interval in
+            seconds (default is 1.0)
+        @type    maxPollInterval: float
+        """
+        self.conn = conn
+        useIdle = keywords.get('useIdle', None)
+        self.useIdle = supportsIdle(conn) if useIdle is None else useIdle
+        self.minPollInterval = keywords.get('minPollInterval', 0.02)
+        self.maxPollInterval = keywords.get('maxPollInterval', 1.0)
+        self._pollInterval = self.minPollInterval
+        #: L{timing_helpers.clock} of the last EXISTS pushed during IDLE
+        self.changedAt = None
+
+    def wait(self, deadline) :
+        """
+        Returns when the mailbox may have changed: after an EXISTS (IDLE)
+        or when the next poll is due.
+
+        @param deadline: L{timing_helpers.clock} value
+        @type  deadline: float
+
+        @return: False if the deadline passed without a change
+        @rtype:  bool
+        """
+        if self.useIdle :
+            return self._idle(deadline)
+
+        now = timing_helpers.clock()
+        if now >= deadline :
+            return False
+        time.sleep(min(self._pollInterval, deadline - now))
+        self._pollInterval = min(self._pollInterval * 2, self.maxPollInterval)
+        return True
+
+    def _idle(self, deadline) :
+        """
+            >>> class ScriptedConnection(object) :
+            ...     error = Exception
+            ...     lines = [b'* 5 EXISTS', b'* 1 RECENT', b'+ idling', b'A001 OK IDLE terminated']
+            ...     def _new_tag(self) : return b'A001'
+            ...     def send(self, data) : pass
+            ...     def _get_line(self) : return self.lines.pop(0)
+            >>> watcher = MailboxWatcher(ScriptedConnection(), useIdle = True)
+            >>> watcher.wait(timing_helpers.clock() + 1), watcher.changedAt is not None
+            (True, True)
+        """
+        conn = self.conn
+        tag = conn._new_tag()
+        conn.send(tag + b' IDLE' + imaplib.CRLF)
+        self.changedAt = None
+        line = conn._get_line()
+        while not line.startswith(b'+') :
+            # untagged responses may come before the continuation (RFC2177),
+            # e.g. the EXISTS of the message that is waited for
+            if not line.startswith(b'* ') :
+                raise conn.error(line)
+            if _EXISTS_RE.match(line) and self.changedAt is None :
+                self.changedAt = timing_helpers.clock()
+            line = conn._get_line()
+
+        while self.changedAt is None :
+            line = self._readLineUntil(deadline)
+            if line is None :
+                break # deadline passed
+            if line.startswith(tag + b' ') :
+                raise conn.error(line) # server ended IDLE
+            if _EXISTS_RE.match(line) :
+                self.changedAt = timing_helpers.clock()
+
+        conn.send(b'DONE' + imaplib.CRLF)
+        line = conn._get_line()
+        while not line.startswith(tag + b' ') :
+            line = conn._get_line()
+        if not line[len(tag):].strip().upper().startswith(b'OK') :
+            raise conn.error(line)
+        return self.changedAt is not None
+
+    def _readLineUntil(self, deadline) :
+        """
+        @return: the next line, None if nothing arrived before the deadline
+        """
+        conn = self.conn
+        remaining = deadline - timing_helpers.clock()
+        if remaining <= 0 :
+            return None
+        previousTimeout = conn.sock.gettimeout()
+        conn.sock.settimeout(remaining)
+        try :
+            return conn._get_line()
+        except (socket.timeout, ssl.SSLError) as e :
+            # Python 2 reports the timeout of a TLS socket as SSLError
+            if not isinstance(e, socket.timeout) and 'timed out' not in str(e) :
+                raise
+            # a file object of a socket cannot be read after a timeout;
+            # the server was silent, so no buffered data is lost
+            conn.file = conn.sock.makefile('rb')
+            return None
+        finally :
+            conn.sock.settimeout(previousTimeout)
+
+
+def supportsIdle(conn) :
+    """
+    Many servers advertise IDLE only after the login, but imaplib keeps
+    the capabilities of the greeting. They are asked again in that case.
+
+    @rtype: bool
+    """
+    if 'IDLE' in conn.capabilities :
+        return True
+    (typ, data) = conn.capability()
+    return typ == 'OK' and b'IDLE' in data[-1].upper().split()
+
+
+def waitForHeaderValue(conn, uidNext, headerName, value, **keywords) :
+    """
+    Waits until a message arrives in the selected mailbox whose header
+    field headerName has the given value, e.g. a unique token of a test
+    message. Uses IDLE if the server supports it, polling otherwise (see
+    L{MailboxWatcher}).
+
+    @param uidNext: result of L{getUidNext} before the message was sent
+    @type  uidNext: int
+
+    @keyword timeout: give up after this many seconds (default is 60)
+    @type    timeout: float
+
+    @keyword pollInterval: upper bound of the poll interval in seconds
+        (default is 1.0)
+    @type    pollInterval: float
+
+    @keyword useIdle: see L{MailboxWatcher}
+    @type    useIdle: bool
+
+    @return: L{timing_helpers.clock} when the server reported the message
+        (IDLE) or when a poll found it, None if it did not arrive in time
+    @rtype:  float
+    """
+    timeout = keywords.get('timeout', 60.0)
+    deadline = timing_helpers.clock() + timeout
+    watcher = MailboxWatcher(conn,
+                             useIdle = keywords.get('useIdle', None),
+                             maxPollInterval = keywords.get('pollInterval', 1.0))
+    while True :
+        values = fetchNewHeaderValues(conn, uidNext, headerName)
+        now = timing_helpers.clock()
+        if value in [(v or '').strip() for v in values.values()] :
+            return watcher.changedAt or now
+        if not watcher.wait(deadline) :
+            return None
+
+
 def iterMailboxContent_uniqueID(conn, mbName, **keywords) :
     """
     @keyword newestFirst: If True sort from newest to oldest. Default is False
     @type    newestFirst: bool
 
+    @keyword headerFields: see L{getFetchItems}
+    @type    headerFields: [str]
+
     @precondition: Mailbox must be SELECTED
     @return: generator[(id, rawMail)]
     """
-    # Unique IDs (UID)
-    uidResult, uidData = conn.uid(u'search', None, u"ALL")
-    uid_list = uidData[0].split()
-
     # order by date
     newestFirst = keywords.get('newestFirst', False)
     if newestFirst :
-        uidIterator = reversed(uid_list)
+        # only the newest message is yielded, see 'break' below
+        newestUID = getNewestUID(conn)
+        uidIterator = [newestUID] if newestUID is not None else []
     else :
-        uidIterator = uid_list
+        # Unique IDs (UID)
+        uidResult, uidData = conn.uid(u'search', None, u"ALL")
+        uidIterator = uidData[0].split()
 
     for uid in uidIterator :
-        mailResult, mailData = conn.uid(u'fetch', uid, u'(RFC822)')
+        mailResult, mailData = conn.uid(u'fetch', uid, getFetchItems(**keywords))
         rawMail = mailData[0][1]
-        emailObj = email.message_from_string(rawMail.decode('utf-8'))
+        emailObj = parseFetchedMail(rawMail, **keywords)
         yield (u"uid.%s" % (uid,), emailObj)
         break
 
 
+def timeSelectAndFetch(conn, timer, mailbox = 'INBOX') :
+    """
+    Records the phases 'select' (read-only) and 'fetch' (envelope data of
+    the newest message). 'fetch' is skipped on an empty mailbox.
+
+    @type timer: L{timing_helpers.PhaseTimer}
+    """
+    timer.skip()
+    (okSelect, msgCountList) = conn.select(mailbox, readonly = True)
+    timer.mark('select')
+
+    msgCount = int(msgCountList[0])
+    if msgCount > 0 :
+        conn.fetch(str(msgCount), '(UID INTERNALDATE RFC822.SIZE)')
+        timer.mark('fetch')
+
+
 def iterMailboxDisplayNames(conn) :
     return (decodeMailboxName(mbNameEncoded)
             for mbNameEncoded, markers in iterMailboxNames(conn))
@@ -129,15 +938,15 @@ def printMailboxesWithItemCount(conn) :
     """
     List details for all mailboxes
     """
-    maxNameLen = max([20] + list(map(len, iterMailboxDisplayNames(conn))))
+    mailboxes = list(iterMailboxesWithStatus(conn))
+    maxNameLen = max([20] + [len(decodeMailboxName(mbName)) for (mbName, markers, status) in mailboxes])
     print()
-    headFormatString = "  %%-%is | #count | marked | SPECIAL-USE | other attributes" % (maxNameLen,)
-    lineFormatString = "  %%(mbDisplayName)-%is | %%(msgCount)5s  | %%(markerString)6s | %%(specialUse)-11s | %%(attributeString)s " % (maxNameLen,)
+    headFormatString = "  %%-%is | #count | unseen | marked | SPECIAL-USE | other attributes" % (maxNameLen,)
+    lineFormatString = "  %%(mbDisplayName)-%is | %%(msgCount)5s  | %%(unseenCount)5s  | %%(markerString)6s | %%(specialUse)-11s | %%(attributeString)s " % (maxNameLen,)
     print(headFormatString % ("Mailbox",))
-    print("  %s-+--------+--------+-%s-+-%s" % ("-"*20,"-"*11,"-"*20))
-    for mbNameEncoded, markers in iterMailboxNames(conn) :
+    print("  %s-+--------+--------+--------+-%s-+-%s" % ("-"*20,"-"*11,"-"*20))
+    for mbNameEncoded, markers, status in mailboxes :
         mbDisplayName = decodeMailboxName(mbNameEncoded)
-        (Okselect, msgCountList) = conn.select(mbNameEncoded, readonly = True)
 
         isMarked = '\\marked' in markers
         markerString = "MARKED" if isMarked else "  NO  "
@@ -162,7 +971,8 @@ def printMailboxesWithItemCount(conn) :
             attributeSet.discard(an)
 
         attributeString = ", ".join(("'%s'" % an for an in sorted(attributeSet)))
-        msgCount = msgCountList[0]
+        msgCount = status.get('MESSAGES', '?') if status else '-'
+        unseenCount = status.get('UNSEEN', '?') if status else '-'
 
         if 0 :
             acl = M.myrights(mbNameEncoded) # works only with ACL
@@ -361,3 +1171,8 @@ def printCapabilities(conn, capabilities) :
 #            print
 #            print xcapName
 #            print conn.xatom(xcapName)
+
+
+if __name__ == "__main__" :
+    import doctest
+    doctest.testmod()
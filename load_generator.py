@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load generator for the whole mail pipeline: submits N test messages via
+SMTP at a given rate over a pool of authenticated sessions and collects
+them via IMAP, to find out how many messages per second the path
+SMTP -> filters -> IMAP sustains.
+
+    python load_generator.py -n 1000 -r 50 -c 8
+
+Every message gets a subject of L{mail_helpers.composeSubjectLine} (the
+time its submission started) and a L{LOAD_RUN_HEADER} with the id of the
+run, so messages of other runs and of the plugins are ignored. The
+INBOX is watched with IDLE if the server supports it (polled otherwise)
+while the messages are submitted.
+
+The servers and accounts are read from the same environment variables
+as the plugins (SMTP_HOST, SMTP_PORT, SENDING_USERNAME, SENDING_PASSWORD,
+SENDING_ADDRESS, IMAP_HOST, IMAP_PORT, RECEIVING_USERNAME,
+RECEIVING_PASSWORD, RECEIVING_ADDRESS). With --fake the local stand-in
+servers of fake_servers.py are started and used instead:
+
+    python load_generator.py --fake -n 500 -r 0 --delivery-delay 0.2
+
+The messages are not deleted afterwards, so use a dedicated account.
+
+Reported are the submission and delivery rate, the percentiles of the
+submission time (MAIL FROM until the final 250) and of the delivery
+latency (start of the submission until the message was seen in the
+INBOX), and the messages that failed or got lost.
+"""
+
+from __future__ import print_function
+
+#---
+#--- Python
+import datetime
+import imaplib
+import optparse
+import os
+import smtplib
+import socket
+import sys
+import threading
+import time
+import uuid
+
+#---
+#--- Plugin Stuff
+import fake_servers
+import imap_helpers
+import mail_helpers
+import pool_helpers
+import smtp_helpers
+import stats_helpers
+import timing_helpers
+
+#---
+LOAD_RUN_HEADER = 'X-Munin-Load-Run'
+
+DEFAULT_MESSAGES = 100
+DEFAULT_RATE = 10.0
+DEFAULT_CONNECTIONS = 4
+DEFAULT_TIMEOUT_SECONDS = 60.0
+DEFAULT_POLL_INTERVAL_SECONDS = 0.25
+
+SOCKET_TIMEOUT_SECONDS = 30
+
+#: the collector looks at the INBOX at least this often while messages
+#: are still being submitted
+COLLECTOR_WAKEUP_SECONDS = 1.0
+
+#---
+#--- Submission
+class SmtpSessionPool(object) :
+    """
+    One authenticated SMTP session per worker thread of
+    L{pool_helpers.mapBounded}. A session is opened on first use and
+    replaced after an error.
+    """
+
+    def __init__(self, environment, **keywords) :
+        """
+        @param environment: see L{getEnvironment}
+        @type  environment: dict
+
+        @keyword use_starttls: default is True
+        @type    use_starttls: bool
+        """
+        self.environment = environment
+        self.use_starttls = keywords.get('use_starttls', True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions = []
+
+    def get(self) :
+        """
+        @raise smtplib.SMTPException, socket.error: if the session cannot
+            be opened
+
+        @rtype: L{smtp_helpers.TimedSMTP}
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None :
+            return conn
+
+        environment = self.environment
+        port = int(environment.get('SMTP_PORT') or smtp_helpers.SMTP_SUBMISSION_PORT)
+        conn = smtp_helpers.TimedSMTP(environment['SMTP_HOST'], port,
+                                      timeout = SOCKET_TIMEOUT_SECONDS)
+        try :
+            smtp_helpers.startSession(conn,
+                                      environment['SENDING_USERNAME'],
+                                      environment['SENDING_PASSWORD'],
+                                      use_starttls = self.use_starttls)
+        except :
+            conn.close()
+            raise
+        self._local.conn = conn
+        with self._lock :
+            self._sessions.append(conn)
+        return conn
+
+    def discard(self) :
+        """
+        Closes the session of the calling thread, e.g. after an error.
+        """
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is None :
+            return
+        with self._lock :
+            self._sessions.remove(conn)
+        conn.close()
+
+    def close(self) :
+        with self._lock :
+            sessions = self._sessions
+            self._sessions = []
+        for conn in sessions :
+            try :
+                conn.quit()
+            except (smtplib.SMTPException, socket.error) :
+                conn.close()
+
+
+def submitMessages(pool, runId, count, rate, maxWorkers) :
+    """
+    Submits the messages 0..count-1. Message i is due i/rate seconds
+    after the start; a message that is late (all sessions busy) is sent
+    as soon as a session is free.
+
+    @type pool: L{SmtpSessionPool}
+
+    @param rate: messages per second, 0 for as fast as possible
+    @type  rate: float
+
+    @return: per message (start of the submission, milliseconds from
+        MAIL FROM until the final reply or None, error message or None)
+    @rtype:  [(datetime.datetime, float, str)]
+    """
+    environment = pool.environment
+    fromAddress = environment['SENDING_ADDRESS']
+    toAddress = environment['RECEIVING_ADDRESS']
+    start = timing_helpers.clock()
+
+    def submit(seq) :
+        if rate > 0 :
+            delay = start + seq / float(rate) - timing_helpers.clock()
+            if delay > 0 :
+                time.sleep(delay)
+        now = datetime.datetime.now()
+        message = smtp_helpers.composeTestMessage(fromAddress, toAddress,
+                                                  mail_helpers.composeSubjectLine(now),
+                                                  headers = {LOAD_RUN_HEADER : "%s %d" % (runId, seq)})
+        timer = timing_helpers.PhaseTimer()
+        try :
+            conn = pool.get()
+            conn.timer = timer
+            smtp_helpers.submitMessage(conn, fromAddress, [toAddress], message)
+        except (smtplib.SMTPException, socket.error) as e :
+            pool.discard()
+            return (now, None, str(e) or e.__class__.__name__)
+        return (now, timer.GetTotal(timing_helpers.SMTP_MESSAGE_PHASES), None)
+
+    return pool_helpers.mapBounded(submit, range(count), maxWorkers = maxWorkers)
+
+
+#---
+#--- Collection
+class DeliveryCollector(threading.Thread) :
+    """
+    Watches the INBOX while the messages are submitted and records when
+    each message of the run shows up (see L{imap_helpers.MailboxWatcher}).
+    Call L{finish} when all messages are submitted, then join().
+    """
+
+    def __init__(self, conn, uidNext, runId, **keywords) :
+        """
+        @param conn: logged in, the INBOX selected
+        @type  conn: L{imap_helpers.TimedIMAP4}
+
+        @param uidNext: result of L{imap_helpers.getUidNext} before the
+            first message was submitted
+        @type  uidNext: int
+
+        @keyword useIdle: see L{imap_helpers.MailboxWatcher}
+        @type    useIdle: bool
+
+        @keyword pollInterval: upper bound of the poll interval in seconds
+            (default is L{DEFAULT_POLL_INTERVAL_SECONDS})
+        @type    pollInterval: float
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.conn = conn
+        self.uidNext = uidNext
+        self.runId = runId
+        self.useIdle = keywords.get('useIdle', None)
+        self.pollInterval = keywords.get('pollInterval', DEFAULT_POLL_INTERVAL_SECONDS)
+        #: sequence number mapped to (subject timestamp, arrival)
+        self.arrivals = {}
+        self.error = None
+        self._expected = None
+        self._deadline = None
+
+    def finish(self, expected, timeout) :
+        """
+        @param expected: sequence numbers of the submitted messages
+        @type  expected: [int]
+
+        @param timeout: give up this many seconds after now
+        @type  timeout: float
+        """
+        self._expected = set(expected)
+        self._deadline = timing_helpers.clock() + timeout
+
+    def isComplete(self) :
+        expected = self._expected
+        return expected is not None and expected.issubset(self.arrivals)
+
+    def run(self) :
+        try :
+            self.collect()
+        except Exception as e :
+            self.error = e
+
+    def collect(self) :
+        watcher = imap_helpers.MailboxWatcher(self.conn,
+                                              useIdle = self.useIdle,
+                                              maxPollInterval = self.pollInterval)
+        while True :
+            self.fetchArrivals()
+            if self.isComplete() :
+                return
+            deadline = self._deadline
+            wakeup = timing_helpers.clock() + COLLECTOR_WAKEUP_SECONDS
+            if deadline is not None :
+                if timing_helpers.clock() >= deadline :
+                    return
+                wakeup = min(wakeup, deadline)
+            watcher.wait(wakeup)
+
+    def fetchArrivals(self) :
+        # With a steady stream of messages an EXISTS pushed during IDLE
+        # may stand for several of them, so the time of the fetch is taken
+        # (IDLE wakes the collector right away, so it is one round trip late)
+        headers = imap_helpers.fetchNewHeaders(self.conn, self.uidNext,
+                                               ['SUBJECT', LOAD_RUN_HEADER])
+        arrival = datetime.datetime.now()
+        for (uid, header) in headers.items() :
+            self.uidNext = max(self.uidNext, uid + 1)
+            fields = (header[LOAD_RUN_HEADER] or '').split()
+            if len(fields) != 2 or fields[0] != self.runId :
+                continue # not a message of this run
+            try :
+                sent = mail_helpers.decomposeSubjectLine((header['SUBJECT'] or '').strip())
+            except ValueError :
+                continue
+            self.arrivals.setdefault(int(fields[1]), (sent, arrival))
+
+
+#---
+#--- Report
+def printSummary(title, unit, values) :
+    summary = stats_helpers.summarize(values)
+    columns = ["%9.3f" % (summary[key],) if summary[key] is not None else "%9s" % ("-",)
+               for key in ['mean', 'p50', 'p90', 'p99', 'max']]
+    print("%-22s %s" % ("%s (%s)" % (title, unit), " ".join(columns)))
+
+
+def printReport(submissions, arrivals, elapsedSeconds) :
+    """
+    @param submissions: result of L{submitMessages}
+    @param arrivals: L{DeliveryCollector.arrivals}
+
+    @param elapsedSeconds: from the first submission until the collector
+        was done
+    @type  elapsedSeconds: float
+    """
+    submitted = [seq for (seq, (sent, ms, error)) in enumerate(submissions) if error is None]
+    failed = len(submissions) - len(submitted)
+    delivered = [seq for seq in submitted if seq in arrivals]
+    lost = len(submitted) - len(delivered)
+
+    firstSent = min(sent for (sent, ms, error) in submissions) if submissions else None
+    lastSent = max(sent for (sent, ms, error) in submissions) if submissions else None
+    lastArrival = max(arrivals[seq][1] for seq in delivered) if delivered else None
+
+    def rate(count, start, end) :
+        if start is None or end is None or count < 2 :
+            return None
+        seconds = (end - start).total_seconds()
+        return count / seconds if seconds > 0 else None
+
+    def formatRate(value) :
+        return "%.1f messages/s" % (value,) if value is not None else "-"
+
+    print("messages               %d" % (len(submissions),))
+    print("submitted              %d" % (len(submitted),))
+    print("failed                 %d" % (failed,))
+    print("delivered              %d" % (len(delivered),))
+    print("lost                   %d" % (lost,))
+    print("duration               %.2f s" % (elapsedSeconds,))
+    print("submission rate        %s" % (formatRate(rate(len(submitted), firstSent, lastSent)),))
+    print("delivery rate          %s" % (formatRate(rate(len(delivered), firstSent, lastArrival)),))
+    print()
+    print("%-22s %9s %9s %9s %9s %9s" % ("", "mean", "p50", "p90", "p99", "max"))
+    printSummary("submission", "ms", [submissions[seq][1] for seq in submitted])
+    printSummary("delivery latency", "s", [(arrival - sent).total_seconds()
+                                           for (sent, arrival) in (arrivals[seq] for seq in delivered)])
+
+
+#---
+def getEnvironment() :
+    """
+    @raise KeyError: if a variable is missing
+
+    @return: servers and accounts as the plugins read them
+    @rtype:  dict
+    """
+    environment = {}
+    for name in ['SMTP_HOST', 'SENDING_USERNAME', 'SENDING_PASSWORD', 'SENDING_ADDRESS',
+                 'IMAP_HOST', 'RECEIVING_USERNAME', 'RECEIVING_PASSWORD', 'RECEIVING_ADDRESS'] :
+        environment[name] = os.environ[name]
+    for name in ['SMTP_PORT', 'IMAP_PORT'] :
+        environment[name] = os.environ.get(name, None)
+    return environment
+
+
+def runLoad(environment, options) :
+    """
+    @return: exit code, 0 if every message was delivered
+    @rtype:  int
+    """
+    runId = uuid.uuid4().hex
+    imapPort = int(environment['IMAP_PORT']) if environment.get('IMAP_PORT') else None
+    try :
+        conn = imap_helpers.TimedIMAP4(environment['IMAP_HOST'], port = imapPort,
+                                       timeout = SOCKET_TIMEOUT_SECONDS)
+        conn.login(environment['RECEIVING_USERNAME'], environment['RECEIVING_PASSWORD'])
+        uidNext = imap_helpers.getUidNext(conn)
+    except (imaplib.IMAP4.error, socket.error) as E :
+        print("Cannot log in at the IMAP server %s: %s" % (environment['IMAP_HOST'], E), file=sys.stderr)
+        return 2
+    if uidNext is None :
+        print("IMAP server does not report UIDNEXT, cannot collect the messages.", file=sys.stderr)
+        return 2
+
+    collector = DeliveryCollector(conn, uidNext, runId,
+                                  useIdle = None if options.use_idle else False,
+                                  pollInterval = options.poll_interval)
+    collector.start()
+
+    pool = SmtpSessionPool(environment, use_starttls = options.use_starttls)
+    timer = timing_helpers.PhaseTimer()
+    try :
+        submissions = submitMessages(pool, runId, options.messages, options.rate,
+                                     options.connections)
+    finally :
+        pool.close()
+    collector.finish([seq for (seq, (sent, ms, error)) in enumerate(submissions) if error is None],
+                     options.timeout)
+    collector.join()
+    elapsedSeconds = timer.mark('total') / 1000.0
+
+    try :
+        conn.logout()
+    except (imaplib.IMAP4.error, socket.error) :
+        pass
+
+    errors = [error for (sent, ms, error) in submissions if error is not None]
+    if errors :
+        print("first submission error: %s" % (errors[0],), file=sys.stderr)
+    if collector.error is not None :
+        print("collecting the messages failed: %s" % (collector.error,), file=sys.stderr)
+
+    printReport(submissions, collector.arrivals, elapsedSeconds)
+    delivered = [seq for seq in collector.arrivals if seq < len(submissions)]
+    return 0 if len(delivered) == len(submissions) else 1
+
+
+def createParser() :
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage = usage)
+    parser.add_option("-n", "--messages",
+                      dest = "messages",
+                      help = "Number of messages to submit (default: %default).",
+                      action = "store",
+                      type = "int",
+                      metavar = "N",
+                      default = DEFAULT_MESSAGES,
+    )
+    parser.add_option("-r", "--rate",
+                      dest = "rate",
+                      help = "Submit RATE messages per second, 0 for as fast as the connections allow (default: %default).",
+                      action = "store",
+                      type = "float",
+                      metavar = "RATE",
+                      default = DEFAULT_RATE,
+    )
+    parser.add_option("-c", "--connections",
+                      dest = "connections",
+                      help = "Submit over N SMTP sessions at the same time (default: %default).",
+                      action = "store",
+                      type = "int",
+                      metavar = "N",
+                      default = DEFAULT_CONNECTIONS,
+    )
+    parser.add_option("-t", "--timeout",
+                      dest = "timeout",
+                      help = "Wait at most SECONDS after the last submission for the messages (default: %default).",
+                      action = "store",
+                      type = "float",
+                      metavar = "SECONDS",
+                      default = DEFAULT_TIMEOUT_SECONDS,
+    )
+    parser.add_option("--poll-interval",
+                      dest = "poll_interval",
+                      help = "Poll the INBOX at least every SECONDS if the server does not support IDLE (default: %default).",
+                      action = "store",
+                      type = "float",
+                      metavar = "SECONDS",
+                      default = DEFAULT_POLL_INTERVAL_SECONDS,
+    )
+    parser.add_option("--no-idle",
+                      dest = "use_idle",
+                      help = "Poll the INBOX even if the server supports IDLE.",
+                      action = "store_false",
+                      default = True,
+    )
+    parser.add_option("--no-starttls",
+                      dest = "use_starttls",
+                      help = "Submit without STARTTLS, e.g. on a trusted local port.",
+                      action = "store_false",
+                      default = True,
+    )
+    parser.add_option("--fake",
+                      dest = "fake",
+                      help = "Start the local stand-in servers of fake_servers.py and use them.",
+                      action = "store_true",
+                      default = False,
+    )
+    group = optparse.OptionGroup(parser, "Local stand-in servers (with --fake)")
+    fake_servers.addServerOptions(group)
+    parser.add_option_group(group)
+    return parser
+
+
+def main():
+    parser = createParser()
+    (options, args) = parser.parse_args()
+    if options.messages < 1 or options.connections < 1 or options.rate < 0 :
+        parser.print_help()
+        return 2
+
+    suite = None
+    if options.fake :
+        try :
+            suite = fake_servers.createSuite(options)
+        except ValueError as E :
+            print(E)
+            parser.print_help()
+            return 2
+        suite.start()
+        environment = suite.getEnvironment(password = options.password or 'secret')
+    else :
+        try :
+            environment = getEnvironment()
+        except KeyError as E :
+            print("Missing environment variable %s" % (E,))
+            parser.print_help()
+            return 2
+
+    try :
+        return runLoad(environment, options)
+    finally :
+        if suite is not None :
+            suite.stop()
+
+if __name__ == "__main__":
+    retCode = main()
+    sys.exit(retCode)
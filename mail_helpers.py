@@ -2,9 +2,12 @@
 
 #---
 #--- Python
+import calendar
 import datetime
 import email
+import email.feedparser
 import email.header
+import email.parser
 import re
 
 #---
@@ -38,29 +41,210 @@ def iterEmailHeaders(emailObj, **keywords) :
 
         yield (headerType, headerTrunc)
 
+def parseHeaderBlock(rawHeaders) :
+    """
+    Parses only the header block of a mail, the body (if any) is kept as
+    an unparsed string.
+
+    @param rawHeaders: e.g. the result of an IMAP
+        BODY.PEEK[HEADER.FIELDS (...)] or a POP3 TOP n 0
+    @type  rawHeaders: bytes | str
+
+    @rtype: email.message.Message
+    """
+    if isinstance(rawHeaders, str) :
+        return email.parser.HeaderParser().parsestr(rawHeaders)
+    # Python 3: keeps non-UTF-8 header bytes as surrogate escapes
+    return email.parser.BytesHeaderParser().parsebytes(rawHeaders)
+
+
+def createFeedParser() :
+    """
+    Parser that builds a message from chunks of bytes as they arrive, so
+    the raw mail never has to be joined or decoded as a whole.
+    Python 2 has no BytesFeedParser, its FeedParser takes byte strings.
+
+    @return: call feed(bytes) for every chunk and close() for the message
+    @rtype:  email.feedparser.BytesFeedParser
+    """
+    parserClass = getattr(email.feedparser, 'BytesFeedParser', email.feedparser.FeedParser)
+    return parserClass()
+
+
 def iterReceivedHeadLines(emailObj) :
     for headerType, headerValueRaw in list(emailObj.items()) :
+        if headerType.upper() != 'RECEIVED' :
+            continue
         headerValueAndEncoding =  email.header.decode_header(headerValueRaw)
         headerValue = headerValueAndEncoding[0][0]
         headerEncoding = headerValueAndEncoding[0][1]
-        if headerType.upper() == 'RECEIVED' :
-            yield headerValue
+        yield headerValue
+
+#---
+#--- Received header (RFC5321 section 4.4)
+RECEIVED_CLAUSES = ['from', 'by', 'via', 'with', 'id', 'for']
+
+_RECEIVED_TOKEN_RE = re.compile(r'[()]|[^\s()]+')
+_RECEIVED_DATE_RE = re.compile(r'(?:[A-Za-z]{3},)?\s*(\d{1,2})\s+([A-Za-z]{3})\s+(\d{2,4})\s+'
+                               r'(\d{1,2}):(\d{2})(?::(\d{2}))?(?:\s+([+-]\d{4}|[A-Za-z]+))?')
+_MONTHS = dict((name, number) for (number, name) in
+               enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                          'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], 1))
+#: offsets of the obsolete zone names (RFC5322 section 4.3)
+_ZONES = {'ut' : 0, 'gmt' : 0, 'z' : 0,
+          'est' : -300, 'edt' : -240, 'cst' : -360, 'cdt' : -300,
+          'mst' : -420, 'mdt' : -360, 'pst' : -480, 'pdt' : -420}
+
+#: the hops of many mails share their timestamps (same second, same relay),
+#: so parsed dates are kept up to this number of entries
+DATE_CACHE_SIZE = 4096
+_dateCache = {}
+
+def tokenizeReceivedValue(line) :
+    """
+    Splits the part of a Received header before the ';' into its clauses
+    in a single pass. Keywords inside comments, e.g.
+    '(Postfix, from userid 1000)', do not start a clause.
+
+    Doctests::
+
+        >>> sorted(tokenizeReceivedValue('from a (b by c) by d with ESMTP id 1').items())
+        [('by', 'd'), ('from', 'a (b by c)'), ('id', '1'), ('with', 'ESMTP')]
+
+    @return: clause name (see L{RECEIVED_CLAUSES}) -> text of the clause
+        including its comments
+    @rtype:  dict
+    """
+    clauses = {}
+    depth = 0
+    clause = None
+    clauseStart = 0
+    for match in _RECEIVED_TOKEN_RE.finditer(line) :
+        token = match.group()
+        if token == '(' :
+            depth += 1
+        elif token == ')' :
+            depth = max(0, depth - 1)
+        elif depth == 0 and token.lower() in RECEIVED_CLAUSES :
+            if clause is not None :
+                clauses[clause] = line[clauseStart:match.start()].strip()
+            clause = token.lower()
+            clauseStart = match.end()
+    if clause is not None :
+        clauses[clause] = line[clauseStart:].strip()
+    return clauses
+
 
 def parseReceivedValue(receivedValue) :
     """
+    Doctests::
+
+        >>> d = parseReceivedValue('from mx.example.org (mx [192.0.2.1])\\n\\tby mail.example.org with ESMTPS id 4711\\n\\tfor <a@example.org>; Mon,  9 Nov 2015 16:08:10 +0100 (CET)')
+        >>> d['from'], d['by'], d['with'], d['for'], d['at'], d['timestamp']
+        ('mx.example.org (mx [192.0.2.1])', 'mail.example.org', 'ESMTPS', '<a@example.org>', '2015-11-09T16:08:10', 1447081690.0)
+
+    @return: the clauses of L{RECEIVED_CLAUSES} (None if missing),
+        'atString' (the date), 'at' (the date in ISO format, or atString
+        if it cannot be parsed) and 'timestamp' (seconds since the epoch
+        in UTC, None if unknown)
+    @rtype:  dict
     """
-    line = " ".join(l.strip() for l in receivedValue.split('\n')).strip()
-    regexp = re.compile("from (?P<from>.+) by (?P<by>.+)( with (?P<with>.+)?)( for (?P<for>.+))?; (?P<atString>.+)")
-    m = regexp.match(line)
-    receivedDict =m.groupdict()
-    atString = receivedDict["atString"]
+    line = " ".join(receivedValue.split())
+    (clausePart, separator, atString) = line.rpartition(';')
+    if not separator :
+        (clausePart, atString) = (atString, '')
+    receivedDict = dict.fromkeys(RECEIVED_CLAUSES)
+    receivedDict.update(tokenizeReceivedValue(clausePart))
+    receivedDict["atString"] = atString.strip()
     try :
-        receivedDict["at"] = parseReceivedAt(atString).isoformat()
-    except Exception :
-        receivedDict["at"] = atString
+        (at, timestamp) = parseReceivedDate(receivedDict["atString"])
+        receivedDict["at"] = at.isoformat()
+        receivedDict["timestamp"] = timestamp
+    except ValueError :
+        receivedDict["at"] = receivedDict["atString"]
+        receivedDict["timestamp"] = None
     return receivedDict
 
 
+def iterReceivedHops(emailObj) :
+    """
+    The hops of a mail in the order they were passed, i.e. the Received
+    headers from bottom to top.
+
+    @return: results of L{parseReceivedValue}
+    @rtype:  iterator
+    """
+    receivedValues = list(iterReceivedHeadLines(emailObj))
+    for receivedValue in reversed(receivedValues) :
+        yield parseReceivedValue(receivedValue)
+
+
+def getReceivedHopDelays(emailObj) :
+    """
+    Time the mail spent between consecutive hops, e.g. in the content
+    filter or until the LMTP delivery. A mail with n Received headers
+    has n - 1 delays.
+
+    @return: seconds in delivery order, None where a date is unknown
+    @rtype:  [float]
+    """
+    timestamps = [hop["timestamp"] for hop in iterReceivedHops(emailObj)]
+    delays = []
+    for (earlier, later) in zip(timestamps, timestamps[1:]) :
+        if earlier is None or later is None :
+            delays.append(None)
+        else :
+            delays.append(later - earlier)
+    return delays
+
+
+def parseReceivedDate(dateString) :
+    """
+    Parses dates like 'Mon, 09 Nov 2015 16:08:10 +0100 (CET)' with a
+    precompiled pattern instead of strptime. Results are cached.
+
+    @raise ValueError: if the string is not a date
+
+    @return: the local time of the string and seconds since the epoch in
+        UTC (None if the zone is unknown)
+    @rtype:  (datetime.datetime, float)
+    """
+    result = _dateCache.get(dateString, None)
+    if result is not None :
+        return result
+
+    match = _RECEIVED_DATE_RE.match(dateString)
+    if match is None :
+        raise ValueError("not a date: %r" % (dateString,))
+    (day, monthName, year, hour, minute, second, zone) = match.groups()
+    month = _MONTHS.get(monthName.lower(), None)
+    if month is None :
+        raise ValueError("unknown month: %r" % (dateString,))
+    year = int(year)
+    if year < 100 :
+        year += 2000 if year < 50 else 1900
+    at = datetime.datetime(year, month, int(day), int(hour), int(minute), int(second or 0))
+
+    offsetMinutes = None
+    if zone is None :
+        pass
+    elif zone[0] in '+-' :
+        offsetMinutes = int(zone[1:3]) * 60 + int(zone[3:5])
+        if zone[0] == '-' :
+            offsetMinutes = -offsetMinutes
+    else :
+        offsetMinutes = _ZONES.get(zone.lower(), None)
+    timestamp = None
+    if offsetMinutes is not None :
+        timestamp = float(calendar.timegm(at.timetuple()) - offsetMinutes * 60)
+
+    result = (at, timestamp)
+    if len(_dateCache) >= DATE_CACHE_SIZE :
+        _dateCache.clear()
+    _dateCache[dateString] = result
+    return result
+
+
 def parseMailDate(dateString) :
     # f = "%a, %d %b %Y %H:%M:%S %z"
     # # Python 2.7.10: ValueError: 'z' is a bad directive
@@ -80,12 +264,36 @@ def parseReceivedAt(dateString) :
         datetime.datetime(2015, 11, 9, 16, 8, 10)
 
     """
-    # f = "%a, %d %b %Y %H:%M:%S %z"
-    # # Python 2.7.10: ValueError: 'z' is a bad directive
-    # in format '%a, %d %b %Y %H:%M:%S %z'
-    valueWithoutTZ = dateString[:25]
-    f = "%a, %d %b %Y %H:%M:%S"
-    return datetime.datetime.strptime(valueWithoutTZ, f)
+    return parseReceivedDate(dateString)[0]
+
+
+#---
+#--- Subject of the test messages
+SUBJECT_PREFIX = "Testmessage "
+SUBJECT_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+def composeSubjectLine(now) :
+    """
+    @param now: the current timestamp
+    @type  now: datetime.datetime
+    """
+    # unlike isoformat() always with microseconds, even if they are 0
+    timestamp = now.strftime(SUBJECT_TIMESTAMP_FORMAT)
+    return "%s%s" % (SUBJECT_PREFIX, timestamp)
+
+
+def decomposeSubjectLine(subjectLine) :
+    """
+    @param subject: content of the subject field
+    @type  subject: str
+
+    @raise ValueError: on bad formatted subject line
+
+    @rtype: datetime.datetime
+    """
+    timestamp = subjectLine[len(SUBJECT_PREFIX):]
+    ts = datetime.datetime.strptime(timestamp, SUBJECT_TIMESTAMP_FORMAT)
+    return ts
 
 
 def getFromAddress(fromField) :
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Text formats of Prometheus: OpenMetrics
+(https://github.com/OpenObservability/OpenMetrics/blob/main/specification/OpenMetrics.md)
+and the older Prometheus text format 0.0.4, for scrapers that do not ask
+for OpenMetrics.
+"""
+
+from __future__ import print_function
+from builtins import object
+
+#---
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+#---
+def escapeLabelValue(value) :
+    """
+        >>> print(escapeLabelValue('a"b\\\\c'))
+        a\\"b\\\\c
+
+    @rtype: str
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatSampleValue(value) :
+    """
+        >>> formatSampleValue(3), formatSampleValue(0.25)
+        ('3', '0.25')
+
+    @rtype: str
+    """
+    if isinstance(value, int) :
+        return str(value)
+    return repr(float(value))
+
+
+def acceptsOpenMetrics(acceptHeader) :
+    """
+    @param acceptHeader: the Accept header of the scrape request
+    @type  acceptHeader: str
+    """
+    return 'application/openmetrics-text' in (acceptHeader or '')
+
+
+class MetricFamily(object) :
+    """
+    A metric with its samples, e.g. a gauge with one sample per label set.
+    """
+
+    def __init__(self, name, metricType, helpText) :
+        """
+        @param name: without the '_total' of counters
+        @type  name: str
+
+        @param metricType: 'gauge' or 'counter'
+        @type  metricType: str
+        """
+        self.name = name
+        self.metricType = metricType
+        self.helpText = helpText
+        self.samples = []
+
+    def add(self, labels, value) :
+        """
+        @param labels: label name mapped to value
+        @type  labels: dict
+        """
+        self.samples.append((labels, value))
+
+    def format(self, openMetrics = True) :
+        """
+        @rtype: [str]
+        """
+        sampleName = self.name + '_total' if self.metricType == 'counter' else self.name
+        # the old format names the counter family like its samples
+        familyName = self.name if openMetrics else sampleName
+        lines = [
+            "# TYPE %s %s" % (familyName, self.metricType),
+            "# HELP %s %s" % (familyName, self.helpText),
+        ]
+        for (labels, value) in self.samples :
+            labelText = ",".join('%s="%s"' % (name, escapeLabelValue(labels[name]))
+                                 for name in sorted(labels))
+            lines.append("%s{%s} %s" % (sampleName, labelText, formatSampleValue(value)))
+        return lines
+
+
+def formatMetrics(families, openMetrics = True) :
+    """
+    @type families: [L{MetricFamily}]
+
+    @param openMetrics: False for the Prometheus text format 0.0.4
+    @type  openMetrics: bool
+
+    @rtype: str
+    """
+    lines = []
+    for family in families :
+        lines.extend(family.format(openMetrics))
+    if openMetrics :
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__" :
+    import doctest
+    doctest.testmod()
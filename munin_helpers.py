@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 
+from __future__ import print_function
+
+#---
+#--- Python
+import re
+
 #---
 #--- Munin Constants (http://munin-monitoring.org/wiki/HowToWritePlugins)
 
@@ -7,3 +13,172 @@ MUNIN_VALUE_CANNOT_LOGIN = -100.0
 MUNIN_VALUE_CANNOT_CONNECT = -200.0
 MUNIN_VALUE_MINIMUM = min(MUNIN_VALUE_CANNOT_LOGIN, MUNIN_VALUE_CANNOT_CONNECT)
 
+#: the values that stand for a failed probe, with a short reason
+MUNIN_VALUE_ERRORS = {
+    MUNIN_VALUE_CANNOT_CONNECT : 'cannot_connect',
+    MUNIN_VALUE_CANNOT_LOGIN : 'cannot_login',
+}
+
+_FIELD_NAME_INVALID_RE = re.compile(r'[^A-Za-z0-9_]')
+
+#---
+def getFieldName(text) :
+    """
+    Turns text (e.g. an IP address) into a valid field name, the same way
+    Munin's clean_fieldname does.
+
+    @rtype: str
+    """
+    fieldName = _FIELD_NAME_INVALID_RE.sub('_', text)
+    if not fieldName or not (fieldName[0].isalpha() or fieldName[0] == '_') :
+        fieldName = '_' + fieldName
+    return fieldName
+
+def iterFieldValues(text) :
+    """
+    Parses the output of a plugin run (fetch, not config).
+
+        >>> list(iterFieldValues("a.value 1.50\\nmultigraph g\\nb.value U\\nc.value 1500000000:-200.00\\n"))
+        [(None, 'a', 1.5), ('g', 'b', None), ('g', 'c', -200.0)]
+
+    @return: (name of the multigraph or None, field name, value or None
+        if unknown); the timestamp of 'epoch:value' is dropped
+    @rtype:  generator
+    """
+    graphName = None
+    for line in text.splitlines() :
+        words = line.split()
+        if len(words) != 2 :
+            continue
+        if words[0] == 'multigraph' :
+            graphName = words[1]
+            continue
+        if not words[0].endswith('.value') :
+            continue
+        fieldName = words[0][:-len('.value')]
+        try :
+            value = float(words[1].split(':')[-1])
+        except ValueError :
+            value = None
+        yield (graphName, fieldName, value)
+
+#---
+#--- Multigraph (http://guide.munin-monitoring.org/en/latest/plugin/multigraphing.html)
+
+def formatValue(theValue) :
+    """
+    @param theValue: None is reported as unknown
+    @type  theValue: float
+
+    @rtype: str
+    """
+    if theValue is None :
+        return "U"
+    return "%.2f" % (theValue,)
+
+
+def printMultigraph(graphName) :
+    print("multigraph %s" % (graphName,))
+
+
+def printPhaseGraphConfig(graphTitle, phases, phaseLabels) :
+    """
+    Prints the config of a graph that stacks the duration of the phases.
+    """
+    print("graph_title %s" % (graphTitle,))
+    print("graph_vlabel ms")
+    print("graph_args --base 1000 --lower-limit 0")
+    print("graph_scale no")
+    print("graph_order %s" % (" ".join(phases),))
+    for phase in phases :
+        print("%s.label %s" % (phase, phaseLabels[phase]))
+        print("%s.draw AREASTACK" % (phase,))
+        print("%s.min 0" % (phase,))
+
+
+def printPhaseGraphValues(timer, phases) :
+    """
+    @type timer: L{timing_helpers.PhaseTimer}
+    """
+    for phase in phases :
+        print("%s.value %s" % (phase, formatValue(timer.GetDuration(phase))))
+
+
+#: fields of a latency distribution graph (see L{stats_helpers.summarize})
+SUMMARY_FIELDS = ['min', 'p50', 'p90', 'p99', 'max']
+
+SUMMARY_LABELS = {
+    'min' : "minimum",
+    'p50' : "median",
+    'p90' : "90th percentile",
+    'p99' : "99th percentile",
+    'max' : "maximum",
+}
+
+def printSummaryGraphConfig(graphTitle, sampleCount, unit = "ms") :
+    """
+    Prints the config of a graph that shows the distribution of several
+    samples of one run as lines from the minimum up to the maximum.
+
+    @param sampleCount: number of samples per run, part of the info text
+    @type  sampleCount: int
+    """
+    print("graph_title %s" % (graphTitle,))
+    print("graph_vlabel %s" % (unit,))
+    print("graph_args --base 1000 --lower-limit 0")
+    print("graph_scale no")
+    print("graph_info Distribution of %d samples per run." % (sampleCount,))
+    print("graph_order %s failed" % (" ".join(SUMMARY_FIELDS),))
+    for fieldName in SUMMARY_FIELDS :
+        print("%s.label %s" % (fieldName, SUMMARY_LABELS[fieldName]))
+        print("%s.min 0" % (fieldName,))
+    # the percentiles only cover the samples that succeeded
+    print("failed.label failed samples")
+    print("failed.min 0")
+
+
+def printSummaryGraphValues(summary) :
+    """
+    @param summary: result of L{stats_helpers.summarize} or
+        L{stats_helpers.LatencyHistogram.summarize}
+    @type  summary: dict
+    """
+    for fieldName in SUMMARY_FIELDS :
+        print("%s.value %s" % (fieldName, formatValue(summary[fieldName])))
+    failed = summary.get('failed')
+    print("failed.value %s" % ("U" if failed is None else failed,))
+
+
+#: fields of a TLS handshake graph (see L{stats_helpers.TLSHandshakeStats})
+TLS_FIELDS = [
+    ('tls_resumed', "resumed handshakes (%)"),
+    ('tls_time_full', "full handshake (ms)"),
+    ('tls_time_resumed', "resumed handshake (ms)"),
+]
+
+def printTLSGraphConfig(graphTitle) :
+    """
+    Prints the config of a graph that shows how many TLS handshakes
+    resumed a session and how long full and resumed handshakes took.
+    """
+    print("graph_title %s" % (graphTitle,))
+    print("graph_vlabel ms / %")
+    print("graph_args --base 1000 --lower-limit 0")
+    print("graph_scale no")
+    for (fieldName, fieldLabel) in TLS_FIELDS :
+        print("%s.label %s" % (fieldName, fieldLabel))
+        print("%s.min 0" % (fieldName,))
+
+
+def printTLSGraphValues(values) :
+    """
+    @param values: result of L{stats_helpers.TLSHandshakeStats.getValues}
+    @type  values: dict
+    """
+    for (fieldName, fieldLabel) in TLS_FIELDS :
+        print("%s.value %s" % (fieldName, formatValue(values[fieldName])))
+
+
+if __name__ == "__main__" :
+    import doctest
+    doctest.testmod()
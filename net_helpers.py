@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+#---
+#--- Python
+import json
+import os
+import socket
+import ssl
+import threading
+import time
+
+#---
+#--- Plugin Stuff
+import pool_helpers
+import timing_helpers
+
+#---
+#: Python 3.6+ can resume TLS sessions (SSLSocket.session)
+SESSION_RESUMPTION_SUPPORTED = hasattr(ssl.SSLSocket, 'session')
+
+#---
+def createSSLContext() :
+    """
+    Like imaplib and poplib the certificate of the server is not verified,
+    we only measure. So the CA certificates are not loaded either, which
+    would take longer than the handshake itself.
+
+    @rtype: ssl.SSLContext
+    """
+    protocol = getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23)
+    context = ssl.SSLContext(protocol)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+_sharedSSLContext = None
+_sharedSSLContextLock = threading.Lock()
+
+def getSharedSSLContext() :
+    """
+    A TLS session can only be resumed with the context that created it,
+    so all connections of a process share this one.
+
+    @rtype: ssl.SSLContext
+    """
+    global _sharedSSLContext
+    with _sharedSSLContextLock :
+        if _sharedSSLContext is None :
+            _sharedSSLContext = createSSLContext()
+        return _sharedSSLContext
+
+
+class TLSSessionCache(object) :
+    """
+    TLS sessions of the last connection to every (host, port), so the
+    next connection can skip the full handshake. The sessions live in
+    memory only: the ssl module cannot serialize them, so they are shared
+    by the connections of a long-lived process (collector, account lists,
+    benchmark), not between two runs of a plugin. Thread safe.
+    """
+
+    def __init__(self) :
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    def get(self, host, port, context) :
+        """
+        @param context: only sessions created by this context can be resumed
+        @type  context: ssl.SSLContext
+
+        @return: None if there is no session or resumption is not supported
+        @rtype:  ssl.SSLSession
+        """
+        with self._lock :
+            (sessionContext, session) = self._sessions.get((host, port), (None, None))
+        return session if sessionContext is context else None
+
+    def remember(self, host, port, sock) :
+        """
+        Stores the session of an established connection. With TLS 1.3
+        the server sends the session ticket after the handshake, so call
+        this after the first response (e.g. the greeting) has been read.
+
+        @type sock: ssl.SSLSocket
+        """
+        session = getattr(sock, 'session', None)
+        if session is None :
+            return
+        with self._lock :
+            self._sessions[(host, port)] = (sock.context, session)
+
+    def clear(self) :
+        with self._lock :
+            self._sessions = {}
+
+
+#: cache used by default by all connections of this process
+SESSION_CACHE = TLSSessionCache()
+
+
+def isSessionReused(sock) :
+    """
+    @return: True if the TLS handshake resumed a session, None if unknown
+        (no TLS or Python 2)
+    @rtype:  bool
+    """
+    return getattr(sock, 'session_reused', None)
+
+
+#---
+#--- Name resolution
+#: socket.getaddrinfo() does not tell the TTL of the DNS records, so
+#: cached addresses expire after a fixed time
+DEFAULT_DNS_TTL_SECONDS = 300
+
+class ResolverCache(object) :
+    """
+    Results of socket.getaddrinfo() for every (host, port), kept for
+    C{ttl} seconds, so a slow resolver is only asked once per TTL. The
+    IMAP, POP3 and SMTP connections of a process share it. With C{path}
+    the entries are also written to a JSON file, so consecutive runs of a
+    plugin share them as well. Thread safe.
+    """
+
+    def __init__(self, **keywords) :
+        """
+        @keyword ttl: lifetime of an entry in seconds (default is
+            L{DEFAULT_DNS_TTL_SECONDS}); 0 disables the cache
+        @type    ttl: float
+
+        @keyword path: JSON file the entries are loaded from and stored to
+        @type    path: str
+        """
+        ttl = keywords.get('ttl', None)
+        self.ttl = DEFAULT_DNS_TTL_SECONDS if ttl is None else ttl
+        self.path = keywords.get('path', None)
+        self._lock = threading.Lock()
+        self._entries = {}
+        if self.path :
+            self.load()
+
+    def resolve(self, host, port) :
+        """
+        @return: addrInfos as returned by socket.getaddrinfo() and if they
+            were taken from the cache
+        @rtype:  (list, bool)
+        """
+        key = "%s|%s" % (host, port)
+        now = time.time()
+        with self._lock :
+            (expires, addrInfos) = self._entries.get(key, (0, None))
+        if addrInfos is not None and expires > now :
+            return (addrInfos, True)
+
+        addrInfos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        if self.ttl > 0 :
+            with self._lock :
+                self._entries[key] = (now + self.ttl, addrInfos)
+            if self.path :
+                self.save()
+        return (addrInfos, False)
+
+    def load(self) :
+        """
+        Reads the unexpired entries of the file; a missing or damaged file
+        is treated as an empty cache.
+        """
+        try :
+            with open(self.path) as f :
+                stored = json.load(f)
+        except (IOError, OSError, ValueError) :
+            return
+        now = time.time()
+        entries = {}
+        try :
+            for (key, (expires, addrInfos)) in stored.items() :
+                if expires > now :
+                    entries[key] = (expires, [(family, sockType, proto, canonName, tuple(sockAddr))
+                                              for (family, sockType, proto, canonName, sockAddr) in addrInfos])
+        except (AttributeError, TypeError, ValueError) :
+            return
+        with self._lock :
+            self._entries.update(entries)
+
+    def save(self) :
+        """
+        Writes the entries to a temporary file which then replaces the
+        file, so concurrent plugin runs never read half a file. Failures
+        are ignored, the cache then only lives in memory.
+        """
+        with self._lock :
+            stored = dict((key, (expires, [(int(family), int(sockType), proto, canonName, list(sockAddr))
+                                           for (family, sockType, proto, canonName, sockAddr) in addrInfos]))
+                          for (key, (expires, addrInfos)) in self._entries.items())
+        tempPath = "%s.%d" % (self.path, os.getpid())
+        try :
+            with open(tempPath, 'w') as f :
+                json.dump(stored, f)
+            os.rename(tempPath, self.path)
+        except (IOError, OSError) :
+            pass
+
+    def clear(self) :
+        with self._lock :
+            self._entries = {}
+
+
+#: cache used by default by all connections of this process
+RESOLVER_CACHE = ResolverCache()
+
+
+def configureResolverCache(**keywords) :
+    """
+    Replaces L{RESOLVER_CACHE}, e.g. to persist it in a file.
+
+    @keyword ttl, path: see L{ResolverCache}
+
+    @rtype: L{ResolverCache}
+    """
+    global RESOLVER_CACHE
+    RESOLVER_CACHE = ResolverCache(**keywords)
+    return RESOLVER_CACHE
+
+
+def getAddresses(host, port, **keywords) :
+    """
+    All addresses (A and AAAA records) of host, e.g. the backends of a
+    round-robin name.
+
+    @keyword resolver: default is L{RESOLVER_CACHE}; None resolves directly
+    @type    resolver: L{ResolverCache}
+
+    @return: IP addresses without duplicates, in the order of the resolver
+    @rtype:  [str]
+    """
+    resolver = keywords.get('resolver', RESOLVER_CACHE)
+    if resolver is not None :
+        (addrInfos, cached) = resolver.resolve(host, port)
+    else :
+        addrInfos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    addresses = []
+    for (family, sockType, proto, canonName, sockAddr) in addrInfos :
+        if sockAddr[0] not in addresses :
+            addresses.append(sockAddr[0])
+    return addresses
+
+
+def createTimedConnection(host, port, **keywords) :
+    """
+    Connects to host:port like socket.create_connection() and wraps the
+    socket with SSL/TLS. Name resolution, TCP connect and TLS handshake
+    are recorded as the phases 'resolve', 'connect' and 'tls'.
+
+    @keyword timer: receives the phases
+    @type    timer: L{timing_helpers.PhaseTimer}
+
+    @keyword use_ssl: default is True
+    @type    use_ssl: bool
+
+    @keyword sslContext: default is L{getSharedSSLContext}()
+    @type    sslContext: ssl.SSLContext
+
+    @keyword sessionCache: resume the TLS session of the last connection
+        to host:port (address:port if C{address} is given) if there is one
+        in the cache (default is
+        L{SESSION_CACHE}); None disables resumption
+    @type    sessionCache: L{TLSSessionCache}
+
+    @keyword timeout: socket timeout in seconds; default is
+        socket.getdefaulttimeout()
+    @type    timeout: float
+
+    @keyword resolver: default is L{RESOLVER_CACHE}; None resolves directly
+    @type    resolver: L{ResolverCache}
+
+    @keyword address: connect to this IP address of host instead of
+        resolving it, e.g. to reach one backend of a round-robin name;
+        the host name is still used for SNI
+    @type    address: str
+
+    @rtype: socket.socket | ssl.SSLSocket
+    """
+    timer = keywords['timer']
+    use_ssl = keywords.get('use_ssl', True)
+    timeout = keywords.get('timeout', None)
+    if timeout is None :
+        timeout = socket.getdefaulttimeout()
+    address = keywords.get('address', None)
+    resolver = keywords.get('resolver', RESOLVER_CACHE)
+
+    if address is not None :
+        addrInfos = socket.getaddrinfo(address, port, 0, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)
+    elif resolver is not None :
+        (addrInfos, cached) = resolver.resolve(host, port)
+    else :
+        addrInfos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    timer.mark('resolve')
+
+    sock = None
+    lastError = None
+    for (family, sockType, proto, canonName, sockAddr) in addrInfos :
+        sock = socket.socket(family, sockType, proto)
+        sock.settimeout(timeout)
+        try :
+            sock.connect(sockAddr)
+            break
+        except socket.error as e :
+            lastError = e
+            sock.close()
+            sock = None
+    if sock is None :
+        raise lastError
+    timer.mark('connect')
+
+    if use_ssl :
+        context = keywords.get('sslContext', None) or getSharedSSLContext()
+        sessionCache = keywords.get('sessionCache', SESSION_CACHE)
+        session = None
+        if sessionCache is not None and SESSION_RESUMPTION_SUPPORTED :
+            session = sessionCache.get(address or host, port, context)
+        if session is not None :
+            sock = context.wrap_socket(sock, server_hostname = host, session = session)
+        else :
+            sock = context.wrap_socket(sock, server_hostname = host)
+        timer.mark('tls')
+
+    return sock
+
+
+def measureAddresses(host, port, **keywords) :
+    """
+    Connects to all addresses of host at the same time and measures TCP
+    connect and TLS handshake of each, to compare the backends behind a
+    round-robin name. Sessions are not resumed, so every backend is
+    measured with a full handshake.
+
+    @keyword use_ssl, timeout, resolver: see L{createTimedConnection}
+
+    @return: address -> connect and TLS handshake in milliseconds, None if
+        the address could not be reached
+    @rtype:  dict
+    """
+    use_ssl = keywords.get('use_ssl', True)
+    timeout = keywords.get('timeout', None)
+    addresses = getAddresses(host, port, resolver = keywords.get('resolver', RESOLVER_CACHE))
+
+    def measure(address) :
+        timer = timing_helpers.PhaseTimer()
+        try :
+            sock = createTimedConnection(host, port,
+                                         timer = timer,
+                                         use_ssl = use_ssl,
+                                         timeout = timeout,
+                                         address = address,
+                                         sessionCache = None)
+        except socket.error :
+            return None
+        sock.close()
+        return timer.GetTotal(['connect', 'tls'])
+
+    return dict(zip(addresses, pool_helpers.mapBounded(measure, addresses)))
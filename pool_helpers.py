@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from builtins import range
+
+#---
+#--- Python
+import queue
+import threading
+
+#---
+DEFAULT_MAX_WORKERS = 16
+
+#---
+def mapBounded(func, items, **keywords) :
+    """
+    Calls C{func(item)} for every item. At most C{maxWorkers} calls are
+    running at the same time, so the total run time is determined by the
+    slowest items instead of the sum of all of them.
+
+    @param func: will be called from worker threads, so it must not touch
+        shared state without locking
+    @type  func: callable
+
+    @keyword maxWorkers: upper bound of concurrent calls
+        (default is L{DEFAULT_MAX_WORKERS})
+    @type    maxWorkers: int
+
+    @raise Exception: the first exception raised by C{func}, after all
+        other items have been processed
+
+    @return: results in the same order as C{items}
+    @rtype:  list
+    """
+    itemList = list(items)
+    maxWorkers = keywords.get('maxWorkers', DEFAULT_MAX_WORKERS)
+    numWorkers = max(1, min(maxWorkers, len(itemList)))
+
+    results = [None] * len(itemList)
+    errors = []
+    workQueue = queue.Queue()
+    for index, item in enumerate(itemList) :
+        workQueue.put((index, item))
+
+    def worker() :
+        while True :
+            try :
+                (index, item) = workQueue.get_nowait()
+            except queue.Empty :
+                return
+            try :
+                results[index] = func(item)
+            except Exception as E :
+                errors.append((index, E))
+
+    threads = [threading.Thread(target = worker) for i in range(numWorkers)]
+    for t in threads :
+        t.daemon = True
+        t.start()
+    for t in threads :
+        t.join()
+
+    if errors :
+        raise sorted(errors, key = lambda e : e[0])[0][1]
+    return results
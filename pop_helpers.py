@@ -3,9 +3,102 @@
 #---
 #--- Pyhton
 from __future__ import print_function
-import email
-import email.header
-from builtins import bytes
+import poplib
+
+#---
+#--- Plugin Stuff
+import mail_helpers
+import net_helpers
+import timing_helpers
+
+#---
+POP3_PORT = 110
+POP3_SSL_PORT = 995
+
+#---
+class TimedPOP3(poplib.POP3) :
+    """
+    POP3 connection (with or without SSL) that records the phases
+    'resolve', 'connect', 'tls' and 'greeting' of the connection setup in
+    a L{timing_helpers.PhaseTimer}.
+    """
+
+    def __init__(self, host, **keywords) :
+        """
+        @keyword use_ssl: default is True
+        @type    use_ssl: bool
+
+        @keyword port: default is 995 with SSL or 110 without
+        @type    port: int
+
+        @keyword timer: default is a new L{timing_helpers.PhaseTimer}
+        @type    timer: L{timing_helpers.PhaseTimer}
+
+        @keyword sessionCache: resume TLS sessions of former connections
+            (default is L{net_helpers.SESSION_CACHE}, None disables it);
+            self.tlsResumed tells if the handshake was abbreviated
+        @type    sessionCache: L{net_helpers.TLSSessionCache}
+
+        @keyword resolver: default is L{net_helpers.RESOLVER_CACHE}
+        @type    resolver: L{net_helpers.ResolverCache}
+
+        @keyword address: connect to this IP address of host, e.g. one
+            backend of a round-robin name (see
+            L{net_helpers.createTimedConnection})
+        @type    address: str
+        """
+        # poplib.POP3.__init__ cannot be reused: Python 2 connects inline
+        self.use_ssl = keywords.get('use_ssl', True)
+        self.timer = keywords.get('timer', None) or timing_helpers.PhaseTimer()
+        defaultPort = POP3_SSL_PORT if self.use_ssl else POP3_PORT
+        self.host = host
+        self.port = keywords.get('port', None) or defaultPort
+        self._tls_established = self.use_ssl
+        self.address = keywords.get('address', None)
+        sessionCache = keywords.get('sessionCache', net_helpers.SESSION_CACHE)
+        self.sock = net_helpers.createTimedConnection(host, self.port,
+                                                      timer = self.timer,
+                                                      use_ssl = self.use_ssl,
+                                                      sessionCache = sessionCache,
+                                                      resolver = keywords.get('resolver', net_helpers.RESOLVER_CACHE),
+                                                      address = self.address)
+        self.tlsResumed = net_helpers.isSessionReused(self.sock)
+        self.file = self.sock.makefile('rb')
+        self._debugging = 0
+        self.welcome = self._getresp()
+        self.timer.mark('greeting')
+        if self.use_ssl and sessionCache is not None :
+            sessionCache.remember(self.address or host, self.port, self.sock)
+
+    def close(self) :
+        """
+        Closes the connection without QUIT (Python 2 has no POP3.close).
+        """
+        for f in [self.file, self.sock] :
+            try :
+                f.close()
+            except Exception :
+                pass
+
+
+def getCapabilities(conn) :
+    """
+    Sends CAPA (RFC2449). Servers without CAPA yield an empty dict.
+
+    @return: capability name mapped to its arguments,
+        e.g. {'TOP': [], 'SASL': ['PLAIN', 'LOGIN']}
+    @rtype:  dict
+    """
+    try :
+        (response, lines, octets) = conn._longcmd('CAPA')
+    except poplib.error_proto :
+        return {}
+    capabilities = {}
+    for line in lines :
+        parts = line.decode('ascii', 'replace').split()
+        if parts :
+            capabilities[parts[0].upper()] = parts[1:]
+    return capabilities
 
 def listMessages(conn) :
     """
@@ -19,12 +112,102 @@ def listMessages(conn) :
 
     return list(p.split(b' ') for p in msgList)
 
+def timeStatAndTop(conn, timer) :
+    """
+    Records the phases 'stat' and 'top' (headers of the newest message).
+    'top' is skipped on an empty mailbox.
+
+    @type timer: L{timing_helpers.PhaseTimer}
+    """
+    timer.skip()
+    (numMessages, sizeOfMailbox) = conn.stat()
+    timer.mark('stat')
+
+    if numMessages > 0 :
+        conn.top(numMessages, 0)
+        timer.mark('top')
+
+
+def fetchHeaders(conn, sid, **keywords) :
+    """
+    Retrieves only the header block of a message with 'TOP sid 0'.
+    Falls back to RETR if the server does not support TOP.
+
+    @param sid: message number
+    @type  sid: str | int
+
+    @keyword capabilities: result of L{getCapabilities}; if given and TOP
+        is not advertised RETR is used right away
+    @type    capabilities: dict
+
+    @rtype: email.message.Message
+    """
+    capabilities = keywords.get('capabilities', None)
+    responseTuple = None
+    if capabilities is None or 'TOP' in capabilities :
+        try :
+            responseTuple = conn.top(sid, 0) # (response, ['line', ...], octets)
+        except poplib.error_proto :
+            pass
+    if responseTuple is None :
+        responseTuple = conn.retr(sid)
+    messageLines = responseTuple[1]
+    return mail_helpers.parseHeaderBlock(b"\r\n".join(messageLines) + b"\r\n")
+
+
+def getNewestHeaders(conn, **keywords) :
+    """
+    Headers of the newest message. Uses STAT instead of LIST, so the cost
+    does not depend on the number or size of the messages.
+
+    @keyword capabilities: see L{fetchHeaders}
+    @type    capabilities: dict
+
+    @return: (id, emailObj) or None for an empty mailbox
+    @rtype:  (str, email.message.Message)
+    """
+    (numMessages, sizeOfMailbox) = conn.stat()
+    if numMessages == 0 :
+        return None
+    emailObj = fetchHeaders(conn, numMessages, **keywords)
+    return (u"sid.%s" % (numMessages,), emailObj)
+
+
+def retrieveMessage(conn, sid) :
+    """
+    Sends 'RETR sid' and feeds every line into the parser as soon as it
+    is read, instead of collecting all lines like poplib.POP3.retr does.
+    The bytes are not decoded, so mails in any charset can be parsed.
+
+    @param sid: message number
+    @type  sid: str | int
+
+    @raise poplib.error_proto: if the server rejects RETR
+
+    @rtype: email.message.Message
+    """
+    parser = mail_helpers.createFeedParser()
+    conn._putcmd('RETR %s' % (sid,))
+    conn._getresp()
+    (line, octets) = conn._getline()
+    while line != b'.' :
+        if line.startswith(b'..') :
+            line = line[1:] # dot-stuffing (RFC1939)
+        parser.feed(line + b'\n')
+        (line, octets) = conn._getline()
+    return parser.close()
+
+
 def iterMessages(conn, msgList, **keywords) :
     """
     @param msgList: result from L{listMessages}
 
     @keyword newestFirst: If True sort from newest to oldest. Default is False
     @type    newestFirst: bool
+
+    @keyword headersOnly: If True only the header block of every message
+        is retrieved (see L{fetchHeaders}). Default is False
+    @type    headersOnly: bool
     """
     numMessages = msgList # len(M.list()[1])
 
@@ -35,17 +218,15 @@ def iterMessages(conn, msgList, **keywords) :
     else :
         msgIterator = msgList
 
+    headersOnly = keywords.get('headersOnly', False)
+
     for (sid, msgSize) in msgIterator :
         #print(repr(sid))
-        responseTuple = conn.retr(sid.decode('utf-8')) # (response, ['line', ...], octets).
-        # ('+OK', ['Return-Path: prvs=06403...', ..., '...'], 4382])
-        success = responseTuple[0]
-        messageLines = responseTuple[1]
-#        print(repr(message))
- #       continue
-        rawMail = u"\n".join(line.decode('utf-8') for line in messageLines)
-        octets2 = responseTuple[2]
-
-        emailObj = email.message_from_string(rawMail)
+        if headersOnly :
+            emailObj = fetchHeaders(conn, sid.decode('utf-8'), **keywords)
+            yield (u"sid.%s" % (sid,), emailObj)
+            continue
+
+        emailObj = retrieveMessage(conn, sid.decode('ascii'))
 
         yield (u"sid.%s" % (sid,), emailObj)
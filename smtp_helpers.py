@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+#---
+#--- Python
+from email.mime.text import MIMEText
+import re
+import smtplib
+
+#---
+#--- Plugin Stuff
+import net_helpers
+import timing_helpers
+
+#---
+SMTP_PORT = 25
+SMTP_SUBMISSION_PORT = 587
+
+_LINE_END_RE = re.compile(br'\r\n|\r|\n')
+_LEADING_DOT_RE = re.compile(br'(?m)^\.')
+
+#---
+class TimedSMTP(smtplib.SMTP) :
+    """
+    SMTP connection that records the phases 'resolve', 'connect' and
+    'greeting' in a L{timing_helpers.PhaseTimer}. The host name is looked
+    up in the same L{net_helpers.ResolverCache} as the IMAP and POP3
+    connections. See L{startSession} and L{submitMessage} for the phases
+    of the dialog.
+    """
+
+    def __init__(self, host = '', port = 0, **keywords) :
+        """
+        @keyword timer: default is a new L{timing_helpers.PhaseTimer}
+        @type    timer: L{timing_helpers.PhaseTimer}
+
+        @keyword resolver: default is L{net_helpers.RESOLVER_CACHE}
+        @type    resolver: L{net_helpers.ResolverCache}
+
+        @keyword sessionCache: resume TLS sessions of former connections
+            after STARTTLS (default is L{net_helpers.SESSION_CACHE}, None
+            disables it); self.tlsResumed tells if the handshake was
+            abbreviated
+        @type    sessionCache: L{net_helpers.TLSSessionCache}
+
+        Other keywords (local_hostname, timeout) are passed to smtplib.SMTP.
+        """
+        self.timer = keywords.pop('timer', None) or timing_helpers.PhaseTimer()
+        self._resolver = keywords.pop('resolver', net_helpers.RESOLVER_CACHE)
+        self._sessionCache = keywords.pop('sessionCache', net_helpers.SESSION_CACHE)
+        self._serverAddress = None
+        self._rememberSession = False
+        self.tlsResumed = None
+        smtplib.SMTP.__init__(self, host, port, **keywords)
+
+    def connect(self, *args, **keywords) :
+        result = smtplib.SMTP.connect(self, *args, **keywords)
+        self.timer.mark('greeting')
+        return result
+
+    def _get_socket(self, host, port, timeout) :
+        # smtplib passes a sentinel object if no timeout was given
+        if not isinstance(timeout, (int, float)) :
+            timeout = None
+        self._serverAddress = (host, port)
+        return net_helpers.createTimedConnection(host, port,
+                                                 timer = self.timer,
+                                                 use_ssl = False,
+                                                 timeout = timeout,
+                                                 resolver = self._resolver)
+
+    def starttls(self) :
+        """
+        Like smtplib.SMTP.starttls, but with the shared context of
+        L{net_helpers.getSharedSSLContext} (no certificate verification,
+        TLS sessions can be resumed). EHLO has to be sent again afterwards.
+
+        @raise smtplib.SMTPException: if the server does not offer STARTTLS
+        """
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('starttls') :
+            raise smtplib.SMTPException("STARTTLS extension not supported by server.")
+        (code, reply) = self.docmd('STARTTLS')
+        if code == 220 :
+            (host, port) = self._serverAddress
+            context = net_helpers.getSharedSSLContext()
+            session = None
+            if self._sessionCache is not None and net_helpers.SESSION_RESUMPTION_SUPPORTED :
+                session = self._sessionCache.get(host, port, context)
+            if session is not None :
+                self.sock = context.wrap_socket(self.sock, server_hostname = host, session = session)
+            else :
+                self.sock = context.wrap_socket(self.sock, server_hostname = host)
+            self.tlsResumed = net_helpers.isSessionReused(self.sock)
+            self._rememberSession = self._sessionCache is not None
+            # forget everything learned before the TLS negotiation (RFC3207)
+            self.file = None
+            self.helo_resp = None
+            self.ehlo_resp = None
+            self.esmtp_features = {}
+            self.does_esmtp = 0
+        return (code, reply)
+
+    def ehlo(self, *args, **keywords) :
+        result = smtplib.SMTP.ehlo(self, *args, **keywords)
+        if self._rememberSession :
+            # with TLS 1.3 the session ticket follows the handshake
+            self._rememberSession = False
+            (host, port) = self._serverAddress
+            self._sessionCache.remember(host, port, self.sock)
+        return result
+
+
+def quoteMessage(message) :
+    """
+    Prepares a message for the DATA command: CRLF line ends, leading dots
+    doubled (RFC5321 section 4.5.2) and the terminating line.
+
+    @type message: bytes | str
+
+    @rtype: bytes
+    """
+    if not isinstance(message, bytes) :
+        message = message.encode('utf-8')
+    data = _LINE_END_RE.sub(b'\r\n', message)
+    data = _LEADING_DOT_RE.sub(b'..', data)
+    if not data.endswith(b'\r\n') :
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+def startSession(conn, user = None, password = None, **keywords) :
+    """
+    Greets the server and authenticates. Records the phases 'ehlo',
+    'starttls' (including the EHLO that has to follow) and 'auth'.
+
+    @type conn: L{TimedSMTP}
+
+    @param user, password: no AUTH if user is None
+    @type  user, password: str
+
+    @keyword use_starttls: default is True
+    @type    use_starttls: bool
+
+    @raise smtplib.SMTPException: if the server refuses a step
+    """
+    timer = conn.timer
+    timer.skip()
+    (code, reply) = conn.ehlo()
+    if code != 250 :
+        raise smtplib.SMTPHeloError(code, reply)
+    timer.mark('ehlo')
+
+    if keywords.get('use_starttls', True) :
+        (code, reply) = conn.starttls()
+        if code != 220 :
+            raise smtplib.SMTPResponseException(code, reply)
+        conn.ehlo()
+        timer.mark('starttls')
+
+    if user is not None :
+        conn.login(user, password)
+        timer.mark('auth')
+
+
+def submitMessage(conn, fromAddress, toAddresses, message) :
+    """
+    Sends one message on an authenticated session, the session can be
+    used for the next message afterwards. Records the phases 'mail',
+    'rcpt', 'data' (until the 354 reply) and 'message' (until the final
+    250 reply).
+
+    @type conn: L{TimedSMTP}
+
+    @type toAddresses: [str]
+
+    @param message: the complete message
+    @type  message: bytes | str
+
+    @raise smtplib.SMTPException: if the server refuses a step
+
+    @return: the final reply
+    @rtype:  (int, bytes)
+    """
+    timer = conn.timer
+    timer.skip()
+    (code, reply) = conn.mail(fromAddress)
+    if code != 250 :
+        conn.rset()
+        raise smtplib.SMTPSenderRefused(code, reply, fromAddress)
+    timer.mark('mail')
+
+    for toAddress in toAddresses :
+        (code, reply) = conn.rcpt(toAddress)
+        if code not in (250, 251) :
+            conn.rset()
+            raise smtplib.SMTPRecipientsRefused({toAddress : (code, reply)})
+    timer.mark('rcpt')
+
+    (code, reply) = conn.docmd('DATA')
+    if code != 354 :
+        conn.rset()
+        raise smtplib.SMTPDataError(code, reply)
+    timer.mark('data')
+
+    conn.send(quoteMessage(message))
+    (code, reply) = conn.getreply()
+    if code != 250 :
+        raise smtplib.SMTPDataError(code, reply)
+    timer.mark('message')
+    return (code, reply)
+
+
+def composeTestMessage(fromAddress, toAddress, subject, **keywords) :
+    """
+    @keyword headers: additional header fields
+    @type    headers: dict
+
+    @rtype: str
+    """
+    msg = MIMEText("This is an automatic generated test message.\n\nPlease contact david-lukas.mueller@itz.uni-halle.de for details.")
+    msg['Subject'] = subject
+    msg['From'] = fromAddress
+    msg['To'] = toAddress
+    for (name, value) in sorted(keywords.get('headers', {}).items()) :
+        msg[name] = value
+    return msg.as_string()
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Spooling of plugin results, as munin-async does it: 'acquire' runs the
+probe and appends its values with the time of the measurement
+('field.value epoch:value') to a spool file, 'spoolfetch EPOCH' prints
+everything measured after EPOCH together with the config of the graphs.
+
+    munin-run check_imap4 acquire          # e.g. every minute from cron
+    munin-run check_imap4 spoolfetch 0     # all spooled samples
+
+So Munin's fetch never waits for a slow mail server, and samples taken
+more often than Munin fetches are not lost.
+"""
+
+from __future__ import print_function
+from builtins import object
+
+#---
+#--- Python
+import fcntl
+import os
+import sys
+import tempfile
+import time
+
+try :
+    from StringIO import StringIO # Python 2, takes str and unicode
+except ImportError :
+    from io import StringIO
+
+#---
+ENV_SPOOL_DIRECTORY = 'MUNIN_PLUGSTATE' #: set by munin-node for the state of the plugins
+ENV_SPOOL_FILE = 'SPOOL_FILE'
+ENV_MAX_AGE = 'SPOOL_MAX_AGE'
+
+DEFAULT_MAX_AGE_SECONDS = 86400
+
+SPOOL_COMMANDS = ['acquire', 'spoolfetch']
+
+#---
+def isActive(argv = None) :
+    """
+    @return: True if the plugin was called with 'acquire' or 'spoolfetch'
+    @rtype:  bool
+    """
+    if argv is None :
+        argv = sys.argv
+    return len(argv) > 1 and argv[1] in SPOOL_COMMANDS
+
+
+def getSpoolPath(argv) :
+    """
+    @return: content of the environment variable 'SPOOL_FILE' or a file
+        named after the plugin in the directory of 'MUNIN_PLUGSTATE'
+        (the temporary directory if not set)
+    @rtype:  str
+    """
+    spoolPath = os.environ.get(ENV_SPOOL_FILE, None)
+    if spoolPath :
+        return spoolPath
+    directory = os.environ.get(ENV_SPOOL_DIRECTORY, None) or tempfile.gettempdir()
+    return os.path.join(directory, "%s.spool" % (os.path.basename(argv[0]),))
+
+
+def iterSections(text, defaultGraph) :
+    """
+    Splits Munin output (config or values) into the sections of the
+    graphs; output without 'multigraph' lines belongs to defaultGraph.
+
+        >>> list(iterSections("a.value 1\\nmultigraph g\\nb.value 2\\n", 'p'))
+        [('p', ['a.value 1']), ('g', ['b.value 2'])]
+
+    @rtype: generator of (str, [str])
+    """
+    graphName = defaultGraph
+    lines = []
+    for line in text.splitlines() :
+        words = line.split()
+        if len(words) == 2 and words[0] == 'multigraph' :
+            if lines :
+                yield (graphName, lines)
+            (graphName, lines) = (words[1], [])
+        elif line.strip() :
+            lines.append(line)
+    if lines :
+        yield (graphName, lines)
+
+
+def getValueTimestamp(line) :
+    """
+    @return: epoch of a line 'field.value epoch:value', None for other lines
+    @rtype:  int
+    """
+    words = line.split()
+    if len(words) != 2 or not words[0].endswith('.value') or ':' not in words[1] :
+        return None
+    try :
+        return int(words[1].split(':')[0])
+    except ValueError :
+        return None
+
+
+def addTimestamps(lines, timestamp) :
+    """
+        >>> addTimestamps(['a.value 1.50', 'b.value 1400000000:2'], 1500000000)
+        ['a.value 1500000000:1.50', 'b.value 1400000000:2']
+
+    @rtype: [str]
+    """
+    result = []
+    for line in lines :
+        words = line.split()
+        if len(words) == 2 and words[0].endswith('.value') and ':' not in words[1] :
+            line = "%s %d:%s" % (words[0], timestamp, words[1])
+        result.append(line)
+    return result
+
+
+def formatSections(sections) :
+    """
+    @type sections: [(str, [str])]
+
+    @rtype: str
+    """
+    return "".join("multigraph %s\n%s\n" % (graphName, "\n".join(lines))
+                   for (graphName, lines) in sections)
+
+
+#---
+#--- Spool file
+class SpoolFile(object) :
+    """
+    The values of all acquired samples, one multigraph section per sample
+    and graph, and the config of the latest sample in a second file.
+    Samples older than maxAge are dropped when the next one is appended.
+
+        >>> import shutil
+        >>> directory = tempfile.mkdtemp()
+        >>> spool = SpoolFile(os.path.join(directory, 'check_imap4.spool'), maxAge = 600)
+        >>> config = "graph_title IMAP\\nlogin.label login\\n"
+        >>> spool.append(config, "login.value 10.00\\n", 1000, 'check_imap4')
+        >>> spool.append(config, "login.value 12.00\\n", 1300, 'check_imap4')
+        >>> print(spool.readSince(1000, 'check_imap4'), end = '')
+        multigraph check_imap4
+        graph_title IMAP
+        login.label login
+        login.value 1300:12.00
+        >>> spool.append(config, "login.value 14.00\\n", 1700, 'check_imap4') # drops 1000
+        >>> print(spool.readSince(0, 'check_imap4'), end = '')
+        multigraph check_imap4
+        graph_title IMAP
+        login.label login
+        login.value 1300:12.00
+        login.value 1700:14.00
+        >>> spool.readSince(1700, 'check_imap4')
+        ''
+        >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, path, **keywords) :
+        """
+        @keyword maxAge: seconds (default is L{DEFAULT_MAX_AGE_SECONDS})
+        @type    maxAge: float
+        """
+        self.path = path
+        self.configPath = path + ".config"
+        self.maxAge = keywords.get('maxAge', DEFAULT_MAX_AGE_SECONDS)
+
+    def _read(self, path) :
+        try :
+            with open(path) as f :
+                return f.read()
+        except (IOError, OSError) :
+            return ""
+
+    def _replace(self, path, text) :
+        # concurrent readers never see half a file
+        tempPath = "%s.%d" % (path, os.getpid())
+        with open(tempPath, 'w') as f :
+            f.write(text)
+        os.rename(tempPath, path)
+
+    def append(self, config, values, timestamp, defaultGraph) :
+        """
+        @param config, values: output of the plugin
+        @type  config, values: str
+
+        @param timestamp: time of the measurement
+        @type  timestamp: int
+
+        @raise IOError, OSError: if the spool cannot be written
+        """
+        sections = [(graphName, addTimestamps(lines, timestamp))
+                    for (graphName, lines) in iterSections(values, defaultGraph)]
+        with open(self.path + ".lock", 'w') as lockFile :
+            # one acquire at a time, so no sample gets lost
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            self._replace(self.configPath, formatSections(iterSections(config, defaultGraph)))
+            oldest = timestamp - self.maxAge
+            kept = [(graphName, lines) for (graphName, lines) in iterSections(self._read(self.path), defaultGraph)
+                    if (getValueTimestamp(lines[0]) or 0) > oldest]
+            self._replace(self.path, formatSections(kept + sections))
+
+    def readSince(self, since, defaultGraph) :
+        """
+        @return: the config and all values measured after since, one
+            section per graph
+        @rtype:  str
+        """
+        values = {}
+        order = []
+        for (graphName, lines) in iterSections(self._read(self.path), defaultGraph) :
+            newLines = [line for line in lines if (getValueTimestamp(line) or 0) > since]
+            if not newLines :
+                continue
+            if graphName not in values :
+                values[graphName] = []
+                order.append(graphName)
+            values[graphName].extend(newLines)
+        config = dict(iterSections(self._read(self.configPath), defaultGraph))
+        return formatSections([(graphName, config.get(graphName, []) + values[graphName])
+                               for graphName in order])
+
+
+#---
+def capture(pluginMain) :
+    """
+    @return: (exit code, what the plugin printed)
+    @rtype:  (int, str)
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try :
+        retCode = pluginMain()
+        return (retCode, sys.stdout.getvalue())
+    finally :
+        sys.stdout = stdout
+
+
+def main(pluginMain, argv = None) :
+    """
+    Handles 'acquire' and 'spoolfetch EPOCH'. For 'acquire' the plugin
+    runs without that argument, once for its config and once for the
+    values.
+
+    @param pluginMain: the main function of the plugin
+    @type  pluginMain: callable
+
+    @return: final exit code
+    @rtype:  int
+    """
+    if argv is None :
+        argv = sys.argv
+    pluginName = os.path.basename(argv[0])
+    try :
+        maxAge = float(os.environ.get(ENV_MAX_AGE, None) or DEFAULT_MAX_AGE_SECONDS)
+    except ValueError :
+        print("usage: environment variable %s must be a number of seconds" % (ENV_MAX_AGE,), file=sys.stderr)
+        return 2
+    spool = SpoolFile(getSpoolPath(argv), maxAge = maxAge)
+
+    if argv[1] == 'spoolfetch' :
+        try :
+            since = int(argv[2]) if len(argv) > 2 else 0
+        except ValueError :
+            print("usage: %s spoolfetch EPOCH" % (pluginName,), file=sys.stderr)
+            return 2
+        sys.stdout.write(spool.readSince(since, pluginName))
+        return 0
+
+    savedArgv = sys.argv
+    try :
+        sys.argv = [argv[0]] + argv[2:] + ['config']
+        (retCode, config) = capture(pluginMain)
+        sys.argv = [argv[0]] + argv[2:]
+        timestamp = int(time.time())
+        (retCode, values) = capture(pluginMain)
+    finally :
+        sys.argv = savedArgv
+
+    try :
+        spool.append(config, values, timestamp, pluginName)
+    except (IOError, OSError) as e :
+        print("Cannot write spool file %s: %s" % (spool.path, e), file=sys.stderr)
+        return 1
+    return retCode
+
+
+if __name__ == "__main__" :
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+#---
+#--- Python
+import math
+import threading
+
+#---
+def percentile(sortedValues, fraction) :
+    """
+    Nearest-rank percentile.
+
+    @param sortedValues: ascending, not empty
+    @type  sortedValues: [float]
+
+    @param fraction: e.g. 0.99 for the 99th percentile
+    @type  fraction: float
+
+    @rtype: float
+    """
+    index = int(round(fraction * (len(sortedValues) - 1)))
+    return sortedValues[max(0, min(index, len(sortedValues) - 1))]
+
+
+def summarize(values) :
+    """
+    @return: count, mean, min, p50, p90, p99 and max of the values;
+        all but count are None if there are no values
+    @rtype:  dict
+    """
+    sortedValues = sorted(values)
+    summary = {'count' : len(sortedValues)}
+    for key in ['mean', 'min', 'p50', 'p90', 'p99', 'max'] :
+        summary[key] = None
+    if sortedValues :
+        summary['mean'] = sum(sortedValues) / float(len(sortedValues))
+        summary['min'] = sortedValues[0]
+        summary['p50'] = percentile(sortedValues, 0.50)
+        summary['p90'] = percentile(sortedValues, 0.90)
+        summary['p99'] = percentile(sortedValues, 0.99)
+        summary['max'] = sortedValues[-1]
+    return summary
+
+
+#---
+#--- Histogram
+DEFAULT_HISTOGRAM_LOWEST = 0.01
+DEFAULT_HISTOGRAM_HIGHEST = 3600000.0
+DEFAULT_HISTOGRAM_PRECISION = 0.01
+
+class LatencyHistogram(object) :
+    """
+    Counts values in buckets whose width grows logarithmically (like an
+    HdrHistogram), so every percentile is within a fixed relative error
+    of the exact value, whatever the scale, while only the counts of the
+    non-empty buckets are kept. Minimum and maximum are exact.
+
+        >>> h = LatencyHistogram()
+        >>> for ms in range(1, 101) :
+        ...     h.record(ms)
+        >>> h.count, h.minimum, h.maximum
+        (100, 1, 100)
+        >>> abs(h.percentile(0.90) - 90) <= 90 * DEFAULT_HISTOGRAM_PRECISION
+        True
+    """
+
+    def __init__(self, **keywords) :
+        """
+        @keyword lowest: values up to this one share the first bucket
+            (default is L{DEFAULT_HISTOGRAM_LOWEST})
+        @type    lowest: float
+
+        @keyword highest: larger values share the last bucket (default is
+            L{DEFAULT_HISTOGRAM_HIGHEST}, one hour in milliseconds)
+        @type    highest: float
+
+        @keyword precision: relative error of the percentiles (default is
+            L{DEFAULT_HISTOGRAM_PRECISION})
+        @type    precision: float
+        """
+        self.lowest = keywords.get('lowest', DEFAULT_HISTOGRAM_LOWEST)
+        self.highest = keywords.get('highest', DEFAULT_HISTOGRAM_HIGHEST)
+        self.precision = keywords.get('precision', DEFAULT_HISTOGRAM_PRECISION)
+        # a bucket is reported by its geometric middle, so it may be
+        # (1 + precision) ** 2 times as wide as its lower bound
+        self._logGrowth = 2 * math.log(1 + self.precision)
+        self._lastBucket = self.getBucket(self.highest)
+        self.clear()
+
+    def clear(self) :
+        self._counts = {}
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def getBucket(self, value) :
+        """
+        @rtype: int
+        """
+        if value <= self.lowest :
+            return 0
+        return int(math.log(value / self.lowest) / self._logGrowth) + 1
+
+    def getBucketValue(self, bucket) :
+        """
+        @return: the value that represents all values of the bucket
+        @rtype:  float
+        """
+        if bucket == 0 :
+            return self.lowest
+        return self.lowest * math.exp((bucket - 0.5) * self._logGrowth)
+
+    def record(self, value, count = 1) :
+        bucket = min(self.getBucket(value), self._lastBucket)
+        self._counts[bucket] = self._counts.get(bucket, 0) + count
+        self.count += count
+        self.total += value * count
+        if self.minimum is None or value < self.minimum :
+            self.minimum = value
+        if self.maximum is None or value > self.maximum :
+            self.maximum = value
+
+    def recordFailure(self, count = 1) :
+        """
+        Counts a sample that could not be taken (e.g. a refused login).
+        """
+        self.failures += count
+
+    def merge(self, other) :
+        """
+        Adds the counts of another histogram with the same layout.
+
+        @type other: L{LatencyHistogram}
+        """
+        for (bucket, count) in other._counts.items() :
+            self._counts[bucket] = self._counts.get(bucket, 0) + count
+        self.count += other.count
+        self.failures += other.failures
+        self.total += other.total
+        for value in [other.minimum, other.maximum] :
+            if value is None :
+                continue
+            if self.minimum is None or value < self.minimum :
+                self.minimum = value
+            if self.maximum is None or value > self.maximum :
+                self.maximum = value
+
+    def percentile(self, fraction) :
+        """
+        Nearest-rank percentile, like L{percentile} on the sorted values.
+
+        @return: None if nothing was recorded
+        @rtype:  float
+        """
+        if not self.count :
+            return None
+        rank = int(round(fraction * (self.count - 1))) + 1
+        seen = 0
+        for bucket in sorted(self._counts) :
+            seen += self._counts[bucket]
+            if seen >= rank :
+                break
+        # the exact extremes are better than the middle of their buckets
+        return max(self.minimum, min(self.getBucketValue(bucket), self.maximum))
+
+    def summarize(self) :
+        """
+        @return: the same keys as L{summarize} and the number of
+            'failed' samples
+        @rtype:  dict
+        """
+        summary = {'count' : self.count, 'failed' : self.failures}
+        for key in ['mean', 'min', 'p50', 'p90', 'p99', 'max'] :
+            summary[key] = None
+        if self.count :
+            summary['mean'] = self.total / self.count
+            summary['min'] = self.minimum
+            summary['p50'] = self.percentile(0.50)
+            summary['p90'] = self.percentile(0.90)
+            summary['p99'] = self.percentile(0.99)
+            summary['max'] = self.maximum
+        return summary
+
+
+class TLSHandshakeStats(object) :
+    """
+    Handshake times of several TLS connections, split into full and
+    resumed handshakes (see L{net_helpers.TLSSessionCache}). Thread safe,
+    so the workers of an account list can share one.
+
+        >>> s = TLSHandshakeStats()
+        >>> s.record(False, 40.0)
+        >>> s.record(True, 10.0)
+        >>> s.record(True, 14.0)
+        >>> s.record(None, 20.0) # Python 2 cannot tell
+        >>> values = s.getValues()
+        >>> round(values['tls_resumed'], 2), values['tls_time_full'], values['tls_time_resumed']
+        (66.67, 40.0, 12.0)
+    """
+
+    def __init__(self) :
+        self._lock = threading.Lock()
+        self.full = LatencyHistogram()
+        self.resumed = LatencyHistogram()
+
+    def record(self, resumed, handshakeDelay) :
+        """
+        @param resumed: True if the session was resumed, None if unknown
+        @type  resumed: bool
+
+        @param handshakeDelay: milliseconds, None without TLS
+        @type  handshakeDelay: float
+        """
+        if resumed is None or handshakeDelay is None :
+            return
+        with self._lock :
+            (self.resumed if resumed else self.full).record(handshakeDelay)
+
+    def recordConnection(self, conn) :
+        """
+        @type conn: L{imap_helpers.TimedIMAP4} | L{pop_helpers.TimedPOP3}
+        """
+        self.record(conn.tlsResumed, conn.timer.GetDuration('tls'))
+
+    def getValues(self) :
+        """
+        @return: 'tls_resumed' (percentage of resumed handshakes) and the
+            mean handshake time 'tls_time_full' and 'tls_time_resumed',
+            None if unknown
+        @rtype:  dict
+        """
+        with self._lock :
+            total = self.full.count + self.resumed.count
+            return {
+                'tls_resumed' : 100.0 * self.resumed.count / total if total else None,
+                'tls_time_full' : self.full.summarize()['mean'],
+                'tls_time_resumed' : self.resumed.summarize()['mean'],
+            }
+
+
+def recordSamples(histogram, measure, count) :
+    """
+    Calls measure() count times one after another and records the
+    results. Negative results (e.g. L{munin_helpers.MUNIN_VALUE_CANNOT_LOGIN})
+    and None are failures, they are counted by
+    L{LatencyHistogram.recordFailure}.
+
+    @type histogram: L{LatencyHistogram}
+
+    @return: number of failures
+    @rtype:  int
+    """
+    failures = 0
+    for i in range(count) :
+        value = measure()
+        if value is None or value < 0 :
+            histogram.recordFailure()
+            failures += 1
+        else :
+            histogram.record(value)
+    return failures
+
+
+if __name__ == "__main__" :
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from builtins import object
+
+#---
+#--- Python
+import time
+
+#---
+#: monotonic high resolution clock (Python 2 has to stick to time.time)
+clock = getattr(time, 'perf_counter', time.time)
+
+#---
+#--- Phases of a probe
+PHASE_LABELS = {
+    'resolve'    : "name resolution",
+    'connect'    : "TCP connect",
+    'tls'        : "TLS handshake",
+    'greeting'   : "server greeting",
+    'capability' : "CAPABILITY",
+    'login'      : "LOGIN",
+    'select'     : "SELECT",
+    'fetch'      : "FETCH",
+    'stat'       : "STAT",
+    'top'        : "TOP",
+    'noop'       : "NOOP",
+    'ehlo'       : "EHLO",
+    'starttls'   : "STARTTLS",
+    'auth'       : "AUTH",
+    'mail'       : "MAIL FROM",
+    'rcpt'       : "RCPT TO",
+    'data'       : "DATA",
+    'message'    : "message until final reply",
+    'quit'       : "QUIT",
+}
+
+IMAP_PHASES = ['resolve', 'connect', 'tls', 'greeting', 'capability', 'login', 'select', 'fetch']
+POP3_PHASES = ['resolve', 'connect', 'tls', 'greeting', 'capability', 'login', 'stat', 'top']
+SMTP_PHASES = ['resolve', 'connect', 'greeting', 'ehlo', 'starttls', 'auth', 'mail', 'rcpt', 'data', 'message', 'quit']
+
+#: phases of a single message on an established SMTP session
+SMTP_MESSAGE_PHASES = ['mail', 'rcpt', 'data', 'message']
+
+#: phases counted as 'connect' by the plugins
+CONNECT_PHASES = ['resolve', 'connect', 'tls', 'greeting', 'capability']
+
+#: like CONNECT_PHASES but without the name resolution, which is not the
+#: fault of the server
+SERVER_CONNECT_PHASES = ['connect', 'tls', 'greeting', 'capability']
+
+#---
+class PhaseTimer(object) :
+    """
+    Records the duration of consecutive phases. Every call of L{mark}
+    ends the current phase and starts the next one.
+    """
+
+    def __init__(self) :
+        self.restart()
+
+    def restart(self) :
+        self._durations = {}
+        self._last = clock()
+
+    def skip(self) :
+        """
+        Ignores the time elapsed since the last mark, e.g. time spent
+        on work that does not belong to the next phase.
+        """
+        self._last = clock()
+
+    def mark(self, phase) :
+        """
+        @param phase: name of the phase that just ended
+        @type  phase: str
+
+        @return: duration of the phase in milliseconds
+        @rtype:  float
+        """
+        now = clock()
+        duration = (now - self._last) * 1000
+        self._durations[phase] = duration
+        self._last = now
+        return duration
+
+    def GetDuration(self, phase) :
+        """
+        @return: milliseconds or None if the phase was not reached
+        @rtype:  float
+        """
+        return self._durations.get(phase, None)
+
+    def GetTotal(self, phases) :
+        """
+        @return: sum of all reached phases in milliseconds
+        @rtype:  float
+        """
+        return sum(self._durations.get(phase, 0.0) for phase in phases)